@@ -0,0 +1,6 @@
+def unread_dialogs(request):
+    if not request.user.is_authenticated:
+        return {}
+
+    # The badge is resolved once per request
+    return {"unread_dialogs_exist": request.user.unread_dialogs_exist}
@@ -43,6 +43,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "common.context_processors.unread_dialogs",
             ],
         },
     },
@@ -69,7 +70,28 @@ FS_MAX_MESSAGE_LENGTH = 400
 FS_DIALOG_INTEGRITY_TIMEOUT = 20*60
 FS_DIALOGS_INTEGRITY_TIMEOUT = 20*60
 FS_UNREAD_DIALOGS_TIMEOUT = 20*60
+FS_DELETED_USERS_TIMEOUT = 5*60
 FS_NEW_MESSAGES_PERIOD = 60*60
 FS_REDIS_DB = 0
+FS_REDIS_MAX_CONNECTIONS = 50
+FS_REDIS_SOCKET_TIMEOUT = 5
+FS_REDIS_SOCKET_CONNECT_TIMEOUT = 5
+FS_REDIS_HEALTH_CHECK_INTERVAL = 30
+FS_LOCAL_CACHE = False
+FS_LOCAL_CACHE_MAX_SIZE = 10000
+FS_LOCAL_CACHE_TIMEOUT = 5
+FS_DIALOG_MESSAGES_PAGE_SIZE = 50
+FS_MESSAGES_CHUNK_SIZE = 200
+FS_CONNECTION_TTL = 60
+FS_CONNECTION_HEARTBEAT_INTERVAL = 20
+FS_MAX_SESSIONS_PER_USER = 5
+# In write-behind mode every message has to be saved through the queue,
+# because ids are given by a Redis sequence
+FS_WRITE_BEHIND = False
+FS_WRITE_BEHIND_BATCH_SIZE = 500
+FS_WRITE_BEHIND_FLUSH_INTERVAL = 0.2
+FS_WRITE_BEHIND_MAX_QUEUE_SIZE = 10000
+FS_WRITE_BEHIND_LOCK_TIMEOUT = 30
+FS_BINARY_PROTOCOL = False
 
 FS_TIME_FORMAT = "%Y.%m.%d %H:%M:%S"
@@ -168,11 +168,219 @@ describe("socketOnMessageHandler", () => {
             message2["is_unread"] = true;
             data["messages"] = [message1, message2];
 
+            dialog.socketOnMessageHandler({data: JSON.stringify(data)});
+            expect(dialog.m.sendMarkDialogAsRead).toHaveBeenCalledTimes(0);
+
+            dialog.socketOnMessageHandler({data: JSON.stringify({
+                "command": "get_messages_done", "chunks": 1
+            })});
+            expect(dialog.m.sendMarkDialogAsRead).toHaveBeenCalledTimes(1);
+        });
+
+        test("chunks", () => {
+            dialogHolder.appendChild(dialog.m.createMessageNode(message1));
+
+            dialog.socketOnMessageHandler({data: JSON.stringify({
+                "command": "get_messages", "chunk": 0, "messages": [message2]
+            })});
+            dialog.socketOnMessageHandler({data: JSON.stringify({
+                "command": "get_messages", "chunk": 1, "messages": [message1]
+            })});
+            expect(dialogHolder.children.length).toBe(2);
+            expect(dialogHolder.children[0].textContent).toContain("text2");
+            expect(dialogHolder.children[1].textContent).toContain("text1");
+        });
+    });
+
+    describe("get_missing_messages", () => {
+        const data = {
+            "command": "get_missing_messages",
+            "messages": [
+                {
+                    "id": 2, "text": "text2", "hash": 400,
+                    "user_owns_message": false, "time": "2021.02.02 00:27",
+                    "is_unread": true
+                },
+                {
+                    "id": 3, "text": "text3", "hash": 300,
+                    "user_owns_message": true, "time": "2021.02.02 00:28",
+                    "is_unread": false
+                }
+            ],
+            "is_complete": true,
+            "integrity_hash": 900
+        };
+
+        test("appending", () => {
+            document.hasFocus = jest.fn(() => {return false;});
+            dialogHolder.appendChild(dialog.m.createMessageNode({
+                "id": 1, "text": "text1", "hash": 200,
+                "user_owns_message": true, "time": "2021.02.02 00:26",
+                "is_unread": false
+            }));
+            dialogHolder.appendChild(
+                dialog.m.createMessageNode(data["messages"][0])
+            );
+
+            dialog.socketOnMessageHandler({data: JSON.stringify(data)});
+            expect(
+                Array.from(dialogHolder.children).map(
+                    messageNode => messageNode.dataset.id
+                )
+            ).toEqual(["1", "2", "3"]);
+            expect(dialog.m.unreadMessagesExist).toBe(false);
+            expect(dialog.socket.send).toHaveBeenCalledTimes(0);
+        });
+
+        test("incomplete", () => {
+            jest.spyOn(dialog.m, "checkIntegrity");
+            document.hasFocus = jest.fn(() => {return true;});
+            dialog.m.sendMarkDialogAsRead = jest.fn();
+            data["is_complete"] = false;
+
             dialog.socketOnMessageHandler({data: JSON.stringify(data)});
             expect(dialog.m.sendMarkDialogAsRead).toHaveBeenCalledTimes(1);
+            expect(dialog.m.checkIntegrity.mock.calls[0]).toEqual(
+                [900, "sync"]
+            );
         });
     });
 
+    describe("get_integrity_buckets", () => {
+        const message = {
+            "id": 1, "text": "text1", "hash": 200, "bucket": "20210101",
+            "user_owns_message": true, "time": "2021.01.01 00:26",
+            "is_unread": false
+        };
+
+        test("mismatch", () => {
+            dialogHolder.appendChild(dialog.m.createMessageNode(message));
+            const data = {
+                "command": "get_integrity_buckets",
+                "buckets": {"20210101": 200, "20210102": 300},
+                "integrity_hash": 500
+            };
+
+            dialog.socketOnMessageHandler({data: JSON.stringify(data)});
+            expect(dialog.socket.send.mock.calls[0][0]).toBe(
+                JSON.stringify({
+                    "command": "give_buckets_messages",
+                    "buckets": ["20210102"]
+                })
+            );
+        });
+
+        test("hash offset", () => {
+            jest.spyOn(dialog.m, "checkIntegrity");
+            dialog.m.hashOffset = 300;
+            dialogHolder.appendChild(dialog.m.createMessageNode(message));
+            const data = {
+                "command": "get_integrity_buckets",
+                "buckets": {"20201231": 300, "20210101": 200},
+                "integrity_hash": 500
+            };
+
+            dialog.socketOnMessageHandler({data: JSON.stringify(data)});
+            expect(dialog.socket.send).toHaveBeenCalledTimes(0);
+            expect(dialog.m.checkIntegrity.mock.calls[0]).toEqual(
+                [500, "full"]
+            );
+        });
+
+        test("many buckets", () => {
+            dialogHolder.appendChild(dialog.m.createMessageNode(message));
+            const buckets = {"20210101": 200};
+            for (let i = 10; i < 21; i++) {
+                buckets[`202102${i}`] = i;
+            }
+            const data = {
+                "command": "get_integrity_buckets",
+                "buckets": buckets,
+                "integrity_hash": 500
+            };
+
+            dialog.socketOnMessageHandler({data: JSON.stringify(data)});
+            expect(dialog.socket.send.mock.calls[0][0]).toBe(
+                JSON.stringify({"command": "give_messages"})
+            );
+        });
+
+        test("match", () => {
+            jest.spyOn(dialog.m, "checkIntegrity");
+            dialogHolder.appendChild(dialog.m.createMessageNode(message));
+            const data = {
+                "command": "get_integrity_buckets",
+                "buckets": {"20210101": 200},
+                "integrity_hash": 200
+            };
+
+            dialog.socketOnMessageHandler({data: JSON.stringify(data)});
+            expect(dialog.m.checkIntegrity.mock.calls[0]).toEqual(
+                [200, "full"]
+            );
+            expect(dialog.socket.send).toHaveBeenCalledTimes(0);
+        });
+    });
+
+    test("get_buckets_messages", () => {
+        jest.spyOn(dialog.m, "checkIntegrity");
+        document.hasFocus = jest.fn(() => {return false;});
+        const messages = [
+            {
+                "id": 1, "text": "text1", "hash": 100, "bucket": "20210101",
+                "user_owns_message": true, "time": "2021.01.01 00:26",
+                "is_unread": false
+            },
+            {
+                "id": 2, "text": "text2", "hash": 200, "bucket": "20210102",
+                "user_owns_message": true, "time": "2021.01.02 00:26",
+                "is_unread": false
+            },
+            {
+                "id": 3, "text": "text3", "hash": 300, "bucket": "20210102",
+                "user_owns_message": false, "time": "2021.01.02 00:27",
+                "is_unread": true
+            },
+            {
+                "id": 4, "text": "text4", "hash": 400, "bucket": "20210103",
+                "user_owns_message": true, "time": "2021.01.03 00:26",
+                "is_unread": false
+            }
+        ];
+        dialogHolder.appendChild(dialog.m.createMessageNode(messages[0]));
+        dialogHolder.appendChild(dialog.m.createMessageNode(
+            {...messages[1], "id": 5, "hash": 500}
+        ));
+        dialogHolder.appendChild(dialog.m.createMessageNode(messages[3]));
+        const data = {
+            "command": "get_buckets_messages",
+            "buckets": ["20210102"],
+            "messages": [messages[1], messages[2]],
+            "integrity_hash": 1000
+        };
+
+        dialog.socketOnMessageHandler({data: JSON.stringify(data)});
+        expect(
+            Array.from(dialogHolder.children).map(
+                messageNode => messageNode.dataset.id
+            )
+        ).toEqual(["1", "2", "3", "4"]);
+        expect(dialog.m.unreadMessagesExist).toBe(true);
+        expect(dialog.m.checkIntegrity.mock.calls[0]).toEqual(
+            [1000, "full"]
+        );
+        expect(dialog.socket.send).toHaveBeenCalledTimes(0);
+    });
+
+    test("mark_dialog_as_read", () => {
+        dialog.m.unreadMessagesExist = true;
+        const ev = {data: JSON.stringify({"command": "mark_dialog_as_read"})};
+
+        dialog.socketOnMessageHandler(ev);
+        expect(dialog.m.unreadMessagesExist).toBe(false);
+        expect(dialog.socket.send).toHaveBeenCalledTimes(0);
+    });
+
     test("check_integrity", () => {
         dialog.m.checkIntegrity = jest.fn();
         const ev = {data: JSON.stringify({
@@ -184,6 +392,20 @@ describe("socketOnMessageHandler", () => {
         expect(dialog.m.checkIntegrity.mock.calls[0][0]).toBe(100);
     });
 
+    test("check_integrity with unread messages", () => {
+        dialog.m.checkIntegrity = jest.fn();
+        dialog.m.sendMarkDialogAsRead = jest.fn();
+        document.hasFocus = jest.fn(() => {return true;});
+        dialog.m.unreadMessagesExist = true;
+        const ev = {data: JSON.stringify({
+            "command": "check_integrity",
+            "integrity_hash": 100
+        })};
+
+        dialog.socketOnMessageHandler(ev);
+        expect(dialog.m.sendMarkDialogAsRead).toHaveBeenCalledTimes(1);
+    });
+
     test("go_home", () => {
         const oldValue = window.location;
         delete window.location;
@@ -249,3 +471,90 @@ test("checkIntegrity", () => {
         JSON.stringify({"command": "give_messages"})
     );
 });
+
+test("checkIntegrity with hash offset", () => {
+    const message = {
+        "text": "text", "hash": 200,
+        "user_owns_message": true, "time": "2021.01.01 00:37"
+    };
+    dialogHolder.appendChild(dialog.m.createMessageNode(message));
+    dialog.m.hashOffset = 300;
+
+    dialog.m.checkIntegrity(500);
+    expect(dialog.socket.send).toHaveBeenCalledTimes(0);
+});
+
+test("renderInitialMessages", () => {
+    const message = {
+        "id": 1, "text": "text1", "hash": 200, "bucket": "20210101",
+        "user_owns_message": false, "time": "2021.01.01 00:37",
+        "is_unread": true
+    };
+    document.body.insertAdjacentHTML(
+        "beforeend",
+        '<script id="initial-messages" type="application/json">'
+        + JSON.stringify({"messages": [message], "hash_offset": 300})
+        + "</script>"
+    );
+
+    loadModule();
+    dialogHolder = document.getElementById("dialog-messages");
+    expect(dialogHolder.children.length).toBe(1);
+    expect(dialogHolder.children[0].dataset.id).toBe("1");
+    expect(dialog.m.hashOffset).toBe(300);
+    expect(dialog.m.unreadMessagesExist).toBe(true);
+
+    dialog.m.checkIntegrity(500);
+    expect(dialog.socket.send).toHaveBeenCalledTimes(0);
+});
+
+test("checkIntegrity sync", () => {
+    const message = {
+        "id": 7, "text": "text", "hash": 200,
+        "user_owns_message": true, "time": "2021.01.01 00:37"
+    };
+    dialogHolder.appendChild(dialog.m.createMessageNode(message));
+    message["id"] = 5;
+    dialogHolder.appendChild(dialog.m.createMessageNode(message));
+
+    expect(dialog.m.getLastMessageId()).toBe(7);
+
+    dialog.m.checkIntegrity(500);
+    expect(dialog.socket.send.mock.calls[0][0]).toBe(
+        JSON.stringify({"command": "sync_messages", "last_message_id": 7})
+    );
+
+    dialog.m.checkIntegrity(500, "full");
+    expect(dialog.socket.send.mock.calls[1][0]).toBe(
+        JSON.stringify({"command": "give_messages"})
+    );
+});
+
+test("checkIntegrity buckets", () => {
+    const message = {
+        "id": 7, "text": "text", "hash": 200, "bucket": "20210101",
+        "user_owns_message": true, "time": "2021.01.01 00:37"
+    };
+    dialogHolder.appendChild(dialog.m.createMessageNode(message));
+
+    dialog.m.checkIntegrity(500, "buckets");
+    expect(dialog.socket.send.mock.calls[0][0]).toBe(
+        JSON.stringify({"command": "give_integrity_buckets"})
+    );
+});
+
+test("getIntegrityBuckets", () => {
+    const message = {
+        "id": 7, "text": "text", "hash": 2 ** 48 - 1, "bucket": "20210101",
+        "user_owns_message": true, "time": "2021.01.01 00:37"
+    };
+    dialogHolder.appendChild(dialog.m.createMessageNode(message));
+    message["hash"] = 3;
+    dialogHolder.appendChild(dialog.m.createMessageNode(message));
+    message["bucket"] = "20210102";
+    dialogHolder.appendChild(dialog.m.createMessageNode(message));
+
+    expect(dialog.m.getIntegrityBuckets()).toEqual(
+        {"20210101": 2, "20210102": 3}
+    );
+});
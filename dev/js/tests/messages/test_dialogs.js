@@ -123,6 +123,44 @@ describe("socketOnMessageHandler", () => {
         expect(document.body).toMatchSnapshot();
     });
 
+    test("get_changed_dialogs", () => {
+        standartSetUpDialogs();
+        jest.spyOn(dialogs.m, "checkIntegrity");
+        jest.spyOn(dialogs.m, "updateDialogsLink");
+        const data = {
+            "command": "get_changed_dialogs",
+            "dialogs": [
+                {
+                    "id": 3, "hash": 700, "is_unread": true,
+                    "text": "new text"
+                },
+                {
+                    "id": 1, "hash": 300, "is_unread": true,
+                    "text": "some text"
+                }
+            ],
+            "deleted_dialogs_ids": [2],
+            "sync_token": "20210101000000000000",
+            "integrity_hash": 1001
+        };
+
+        dialogs.socketOnMessageHandler({data: JSON.stringify(data)});
+        expect(
+            Array.from(dialogsHolder.children).map(dialogNode => dialogNode.id)
+        ).toEqual(["3", "1"]);
+        expect(
+            document.getElementById("1").firstChild.classList.contains(
+                "is-unread"
+            )
+        ).toBe(true);
+        expect(dialogs.m.syncToken).toBe("20210101000000000000");
+        expect(dialogs.m.updateDialogsLink).toHaveBeenCalledTimes(1);
+        expect(dialogs.m.checkIntegrity.mock.calls[0]).toEqual([1001, false]);
+        expect(dialogs.socket.send.mock.calls[0][0]).toBe(
+            JSON.stringify({"command": "give_dialogs"})
+        );
+    });
+
     test("mark_dialog_as_read", () => {
         standartSetUpDialogs();
         jest.spyOn(dialogs.m, "checkIntegrity");
@@ -217,3 +255,44 @@ describe("updateDialogsLink", () => {
         expect(dialogsLink).toMatchSnapshot();
     });
 });
+
+test("renderInitialDialogs", () => {
+    const dialog = {
+        "id": 2, "hash": 500, "is_unread": true,
+        "text": "some text"
+    };
+    document.body.insertAdjacentHTML(
+        "beforeend",
+        '<script id="initial-dialogs" type="application/json">'
+        + JSON.stringify({"dialogs": [dialog], "sync_token": "token"})
+        + "</script>"
+    );
+
+    loadModule();
+    dialogsHolder = document.getElementById("dialogs");
+    expect(dialogsHolder.children.length).toBe(1);
+    expect(dialogsHolder.children[0].id).toBe("2");
+    expect(dialogs.m.syncToken).toBe("token");
+    expect(dialogsLink.classList.contains("unread-dialogs-exist")).toBe(true);
+
+    dialogs.m.checkIntegrity(501);
+    expect(dialogs.socket.send).toHaveBeenCalledTimes(0);
+});
+
+test("checkIntegrity sync", () => {
+    standartSetUpDialogs();
+    dialogs.m.syncToken = "20210101000000000000";
+
+    dialogs.m.checkIntegrity(500);
+    expect(dialogs.socket.send.mock.calls[0][0]).toBe(
+        JSON.stringify({
+            "command": "sync_dialogs",
+            "since": "20210101000000000000"
+        })
+    );
+
+    dialogs.m.checkIntegrity(500, false);
+    expect(dialogs.socket.send.mock.calls[1][0]).toBe(
+        JSON.stringify({"command": "give_dialogs"})
+    );
+});
@@ -24,3 +24,73 @@ test("GetWsUrl", () => {
 
     window.location = oldValue;
 });
+
+test("combineHashes", () => {
+    expect(utils.combineHashes([])).toBe(0);
+    expect(utils.combineHashes(["100", 200])).toBe(300);
+    expect(
+        utils.combineHashes([utils.HASH_MODULUS - 1, "3"])
+    ).toBe(2);
+});
+
+describe("CustomWebSocket sendCommand", () => {
+    test("json", () => {
+        const customWS = new utils.CustomWebSocket("ws://a.com/", jest.fn());
+        customWS.send = jest.fn();
+        customWS.sendCommand({"command": "give_dialogs"});
+
+        expect(customWS.send.mock.calls[0][0]).toBe(
+            JSON.stringify({"command": "give_dialogs"})
+        );
+    });
+
+    test("binary", () => {
+        const customWS = new utils.CustomWebSocket("ws://a.com/", jest.fn());
+        customWS.send = jest.fn();
+        Object.defineProperty(
+            customWS, "protocol", {value: utils.BINARY_PROTOCOL}
+        );
+        customWS.sendCommand({"command": "give_dialogs"});
+
+        expect(
+            utils.decodeMsgpack(customWS.send.mock.calls[0][0])
+        ).toEqual({"command": "give_dialogs"});
+    });
+});
+
+test("msgpack", () => {
+    const data = {
+        "command": "get_messages",
+        "ints": [0, 127, 128, 70000, 2 ** 40, -1, -33, -40000],
+        "hash": 2 ** 47 + 5,
+        "float": 1.5,
+        "strings": ["", "é".repeat(40), "x".repeat(300)],
+        "values": [true, false, null],
+        "map": Object.fromEntries([...Array(20).keys()].map((i) => [i, i]))
+    };
+
+    expect(utils.decodeMsgpack(utils.encodeMsgpack(data))).toEqual(data);
+    // {"a": [1]} packed by msgpack-python
+    expect(
+        utils.decodeMsgpack(new Uint8Array([0x81, 0xa1, 0x61, 0x91, 0x01]))
+    ).toEqual({"a": [1]});
+});
+
+test("fromColumns", () => {
+    expect(utils.fromColumns({})).toEqual([]);
+    expect(utils.fromColumns({"id": [1, 2], "text": ["a", "b"]})).toEqual([
+        {"id": 1, "text": "a"},
+        {"id": 2, "text": "b"}
+    ]);
+});
+
+test("parseCommand", () => {
+    const data = {"command": "get_dialogs", "dialogs": [{"id": 1}]};
+    expect(utils.parseCommand(JSON.stringify(data))).toEqual(data);
+
+    const binaryData = utils.encodeMsgpack({
+        "command": "get_dialogs",
+        "dialogs": {"id": [1]}
+    });
+    expect(utils.parseCommand(binaryData.buffer)).toEqual(data);
+});
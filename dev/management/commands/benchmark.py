@@ -0,0 +1,246 @@
+import json
+import statistics
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from messages import cache
+from messages.managers import DialogIntegrityManager
+from messages.managers import get_conversation_id
+from messages.managers import hash_buckets
+from messages.models import Dialog
+from messages.models import Message
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+# Ids of users are positive, so generated rows and keys can't
+# belong to real users
+USER_ID = -1
+INTERLOCUTOR_ID = -2
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures hot paths of the messages managers over generated "
+        "datasets and compares them with a baseline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="100,1000,10000",
+            help="Sizes of datasets"
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of timed calls of every benchmark"
+        )
+        parser.add_argument(
+            "--redis",
+            choices=["auto", "fake", "real"],
+            default="auto",
+            help="Use fakeredis or the configured Redis database"
+        )
+        parser.add_argument(
+            "--baseline",
+            help="Fail if results are worse than ones in this file"
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=0.25,
+            help="Allowed relative regression of time and memory"
+        )
+        parser.add_argument(
+            "--output",
+            help="Write results to this file"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError as e:
+            raise CommandError(
+                "Invalid sizes: {}".format(options["sizes"])
+            ) from e
+
+        redis = options["redis"]
+        if redis in ["auto", "fake"]:
+            if fakeredis is None:
+                raise CommandError(
+                    "fakeredis isn't installed, use --redis real "
+                    "to run benchmarks against the configured Redis"
+                )
+            redis_cache = fakeredis.FakeRedis(decode_responses=True)
+        else:
+            redis_cache = cache.get_sync_redis_cache()
+
+        results = {}
+        with patch.object(cache, "_sync_redis_cache", redis_cache):
+            for size in sizes:
+                # Generated rows are rolled back
+                with transaction.atomic():
+                    for name, result in run_benchmarks(
+                        size,
+                        options["repeat"]
+                    ):
+                        results["{}[{}]".format(name, size)] = result
+                        self.stdout.write(
+                            "{:<44} {:>10.3f}ms {:>5} queries "
+                            "{:>9.1f}KiB".format(
+                                "{}[{}]".format(name, size),
+                                result["time"] * 1000,
+                                result["queries"],
+                                result["peak_memory"] / 1024
+                            )
+                        )
+                    transaction.set_rollback(True)
+            if redis == "real":
+                # Keys of generated users are left otherwise
+                i_manager = DialogIntegrityManager(USER_ID, INTERLOCUTOR_ID)
+                i_manager.sync.drop()
+
+        if options["output"] is not None:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+
+        if options["baseline"] is not None:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+            regressions = compare(results, baseline, options["threshold"])
+            if len(regressions) != 0:
+                raise CommandError(
+                    "Regressions:\n{}".format("\n".join(regressions))
+                )
+
+
+def run_benchmarks(size, repeat):
+    now = timezone.now()
+
+    # A dialog with size messages
+    Message.objects.bulk_create([
+        Message(
+            time=now - timedelta(minutes=i),
+            sender_id=[USER_ID, INTERLOCUTOR_ID][i % 2],
+            receiver_id=[INTERLOCUTOR_ID, USER_ID][i % 2],
+            conversation_id=get_conversation_id(USER_ID, INTERLOCUTOR_ID),
+            text="text{}".format(i),
+            is_unread=i < 3
+        )
+        for i in range(size)
+    ])
+    # And size dialogs with one message
+    first_interlocutor_id = INTERLOCUTOR_ID - 1
+    Message.objects.bulk_create([
+        Message(
+            time=now - timedelta(minutes=i),
+            sender_id=interlocutor_id,
+            receiver_id=USER_ID,
+            conversation_id=get_conversation_id(USER_ID, interlocutor_id),
+            text="text{}".format(i)
+        )
+        for i, interlocutor_id in enumerate(range(
+            first_interlocutor_id,
+            first_interlocutor_id - size,
+            -1
+        ))
+    ])
+    Dialog.objects.rebuild(USER_ID)
+
+    messages = Message.objects.get_dialog_messages(USER_ID, INTERLOCUTOR_ID)
+    i_manager = DialogIntegrityManager(USER_ID, INTERLOCUTOR_ID)
+    benchmarks = [
+        (
+            "MessagesManager.get_dialogs",
+            lambda: Message.objects.get_dialogs(USER_ID)
+        ),
+        (
+            "DialogsManager.get_dialogs",
+            lambda: Dialog.objects.get_dialogs(USER_ID)
+        ),
+        (
+            "MessagesManager.get_dialog_messages",
+            lambda: Message.objects.get_dialog_messages(
+                USER_ID,
+                INTERLOCUTOR_ID
+            )
+        ),
+        (
+            "Message.as_dict",
+            lambda: [message.as_dict(USER_ID) for message in messages]
+        ),
+        (
+            "hash_buckets",
+            lambda: hash_buckets(messages)
+        ),
+        (
+            "DialogIntegrityManager.get_messages",
+            i_manager.sync.get_messages
+        )
+    ]
+
+    for name, function in benchmarks:
+        yield name, measure(function, repeat)
+
+
+def measure(function, repeat):
+    # Warming up
+    with CaptureQueriesContext(connection) as queries:
+        function()
+
+    times = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started_at)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "time": statistics.median(times),
+        "min_time": min(times),
+        "queries": len(queries),
+        "peak_memory": peak_memory
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        base = baseline[name]
+        for metric in ["time", "peak_memory"]:
+            if result[metric] > base[metric] * (1 + threshold):
+                regressions.append("{} {}: {} > {}".format(
+                    name, metric,
+                    result[metric], base[metric]
+                ))
+        if result["queries"] > base["queries"]:
+            regressions.append("{} queries: {} > {}".format(
+                name,
+                result["queries"], base["queries"]
+            ))
+
+    return regressions
@@ -0,0 +1,393 @@
+import asyncio
+import json
+import random
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.backends.signals import connection_created
+from django.db.models import Q
+from django.test import Client
+
+from config.asgi import application
+from messages.cache import get_sync_redis_cache
+from messages.models import Dialog
+from messages.models import Message
+
+
+OPERATIONS = ["send", "read", "delete"]
+# Commands which are sent back when an operation is done
+REPLIES = {
+    "send": "get_new_message",
+    "read": "mark_dialog_as_read",
+    "delete": "delete_dialog"
+}
+# Accounts which are created by the command are marked by the domain
+EMAIL_FORMAT = "{}@loadtest.invalid"
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives simulated users against the ASGI application "
+        "and reports latency, throughput and Redis/DB calls as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=10,
+            help="Number of simulated users"
+        )
+        parser.add_argument(
+            "--operations",
+            type=int,
+            default=20,
+            help="Number of operations of every user"
+        )
+        parser.add_argument(
+            "--mix",
+            default="send=8,read=1,delete=1",
+            help="Weights of operations"
+        )
+        parser.add_argument(
+            "--think-time",
+            type=float,
+            default=0,
+            help="Pause of a user between operations in seconds"
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=10,
+            help="Time to wait for a reply in seconds"
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            help="Seed of the operations' order"
+        )
+        parser.add_argument(
+            "--output",
+            help="Write the report to this file"
+        )
+        parser.add_argument(
+            "--keep-data",
+            action="store_true",
+            help="Don't delete users, messages and dialogs afterwards"
+        )
+
+    def handle(self, *args, **options):
+        if options["users"] < 2:
+            raise CommandError("At least 2 users are needed")
+        mix = parse_mix(options["mix"])
+
+        users = get_users(options["users"])
+        cookies = [get_session_cookie(user) for user in users]
+        try:
+            report = asyncio.run(run(
+                users, cookies, mix, options["operations"],
+                options["think_time"], options["timeout"],
+                random.Random(options["seed"])
+            ))
+        finally:
+            if not options["keep_data"]:
+                delete_data(users)
+
+        report_json = json.dumps(report, indent=2)
+        if options["output"] is not None:
+            with open(options["output"], "w") as f:
+                f.write(report_json)
+        self.stdout.write(report_json)
+
+
+class SimulatedUser:
+    def __init__(self, user, interlocutor, cookie, timeout):
+        headers = [
+            (b"cookie", cookie.encode()),
+            (b"origin", b"http://localhost")
+        ]
+        self.user = user
+        self.interlocutor = interlocutor
+        self.timeout = timeout
+        self.dialog = WebsocketCommunicator(
+            application,
+            "/ws/dialogs/u{}/".format(interlocutor.id),
+            headers
+        )
+        self.dialogs = WebsocketCommunicator(
+            application,
+            "/ws/dialogs/",
+            headers
+        )
+
+    async def connect(self):
+        for communicator in [self.dialog, self.dialogs]:
+            connected, _ = await communicator.connect(self.timeout)
+            if not connected:
+                raise CommandError(
+                    "User {} can't connect".format(self.user.id)
+                )
+            await self.wait_for(communicator, "check_integrity")
+
+    async def disconnect(self):
+        await self.dialog.disconnect()
+        await self.dialogs.disconnect()
+
+    async def do(self, operation, text):
+        # Replies of operations which have timed out are dropped,
+        # so they aren't taken for replies of this one
+        await self.drain(self.dialog)
+        await self.drain(self.dialogs)
+
+        if operation == "send":
+            communicator = self.dialog
+            await communicator.send_to(json.dumps({
+                "command": "get_new_message",
+                "message": {
+                    "text": text
+                }
+            }))
+
+            def is_reply(data):
+                return data["message"]["text"] == text
+        elif operation == "read":
+            communicator = self.dialogs
+            await self.dialog.send_to(json.dumps({
+                "command": "mark_dialog_as_read"
+            }))
+
+            def is_reply(data):
+                return data["dialog_id"] == self.interlocutor.id
+        else:
+            communicator = self.dialogs
+            await communicator.send_to(json.dumps({
+                "command": "delete_dialog",
+                "dialog_id": self.interlocutor.id
+            }))
+
+            def is_reply(data):
+                return data["dialog_id"] == self.interlocutor.id
+
+        await self.wait_for(communicator, REPLIES[operation], is_reply)
+
+    async def wait_for(self, communicator, command, is_reply=None):
+        # Events of other users and sessions are skipped
+        while True:
+            data = json.loads(
+                await communicator.receive_from(self.timeout)
+            )
+            if data["command"] == command and (
+                is_reply is None or is_reply(data)
+            ):
+                return data
+
+    async def drain(self, communicator):
+        while not await communicator.receive_nothing(0):
+            await communicator.receive_from(self.timeout)
+
+
+class QueriesCounter:
+    # Consumers query the database in threads of sync_to_async,
+    # so the counter is attached to every connection which is opened
+    def __init__(self):
+        self.number = 0
+        self.connections = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.number += 1
+
+        return execute(sql, params, many, context)
+
+    def attach(self, **kwargs):
+        connection = kwargs["connection"]
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self.connections.append(connection)
+
+    def __enter__(self):
+        connection_created.connect(self.attach)
+
+        return self
+
+    def __exit__(self, *args):
+        connection_created.disconnect(self.attach)
+        for connection in self.connections:
+            connection.execute_wrappers.remove(self)
+
+
+async def run(users, cookies, mix, operations_number,
+              think_time, timeout, rng):
+    simulated_users = [
+        SimulatedUser(
+            user,
+            users[(i + 1) % len(users)],
+            cookies[i],
+            timeout
+        )
+        for i, user in enumerate(users)
+    ]
+    schedules = [
+        rng.choices(list(mix), weights=list(mix.values()),
+                    k=operations_number)
+        for _ in simulated_users
+    ]
+    latencies = {operation: [] for operation in OPERATIONS}
+    errors = {operation: 0 for operation in OPERATIONS}
+
+    async def drive(simulated_user, schedule):
+        for i, operation in enumerate(schedule):
+            started_at = time.perf_counter()
+            try:
+                await simulated_user.do(
+                    operation,
+                    "load test {} {}".format(simulated_user.user.id, i)
+                )
+            except asyncio.TimeoutError:
+                errors[operation] += 1
+            else:
+                latencies[operation].append(
+                    time.perf_counter() - started_at
+                )
+
+            if think_time != 0:
+                await asyncio.sleep(think_time)
+
+    with QueriesCounter() as queries_counter:
+        for simulated_user in simulated_users:
+            await simulated_user.connect()
+
+        redis_stats = get_redis_stats()
+        queries_number = queries_counter.number
+        started_at = time.perf_counter()
+        await asyncio.gather(*[
+            drive(simulated_user, schedule)
+            for simulated_user, schedule in zip(simulated_users, schedules)
+        ])
+        duration = time.perf_counter() - started_at
+        queries_number = queries_counter.number - queries_number
+        redis_stats2 = get_redis_stats()
+
+        for simulated_user in simulated_users:
+            await simulated_user.disconnect()
+
+    operations_done = sum(len(values) for values in latencies.values())
+    redis_commands = {
+        name: redis_stats2[name] - redis_stats.get(name, 0)
+        for name in redis_stats2
+        if redis_stats2[name] != redis_stats.get(name, 0)
+    }
+
+    return {
+        "users": len(users),
+        "operations_per_user": operations_number,
+        "mix": mix,
+        "duration": round(duration, 3),
+        "throughput": round(operations_done / duration, 1),
+        "messages_per_second": round(len(latencies["send"]) / duration, 1),
+        "operations": {
+            operation: {
+                "count": len(latencies[operation]),
+                "errors": errors[operation],
+                "p50": percentile(latencies[operation], 50),
+                "p95": percentile(latencies[operation], 95),
+                "p99": percentile(latencies[operation], 99)
+            }
+            for operation in OPERATIONS
+        },
+        "db_queries": queries_number,
+        "redis_commands": sum(redis_commands.values()),
+        "redis_commands_by_name": redis_commands
+    }
+
+
+def parse_mix(mix):
+    weights = {}
+    try:
+        for part in mix.split(","):
+            operation, weight = part.split("=")
+            weights[operation.strip()] = int(weight)
+    except ValueError as e:
+        raise CommandError("Invalid mix: {}".format(mix)) from e
+
+    if (
+        not set(weights) <= set(OPERATIONS)
+        or any(weight < 0 for weight in weights.values())
+        or sum(weights.values()) == 0
+    ):
+        raise CommandError("Invalid mix: {}".format(mix))
+
+    return weights
+
+
+def percentile(values, percent):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    # Nearest-rank method
+    rank = max(1, -(-percent * len(values) // 100))
+
+    return round(values[int(rank) - 1] * 1000, 2)
+
+
+def get_redis_stats():
+    # Calls of all clients are counted by the server
+    return {
+        name[len("cmdstat_"):]: stats["calls"]
+        for name, stats in get_sync_redis_cache().info(
+            "commandstats"
+        ).items()
+        if name not in ["cmdstat_info"]
+    }
+
+
+def get_users(users_number):
+    usernames = ["loadtest{}".format(i) for i in range(users_number)]
+    # Accounts of the command are deleted afterwards,
+    # so other accounts with the same names mustn't be used
+    for user in get_user_model().objects.filter(username__in=usernames):
+        if (
+            user.email != EMAIL_FORMAT.format(user.username)
+            or user.has_usable_password()
+        ):
+            raise CommandError(
+                "User {} exists already".format(user.username)
+            )
+
+    users = []
+    for username in usernames:
+        user, created = get_user_model().objects.get_or_create(
+            username=username,
+            defaults={"email": EMAIL_FORMAT.format(username)}
+        )
+        if created:
+            user.set_unusable_password()
+            user.save()
+        users.append(user)
+
+    return users
+
+
+def get_session_cookie(user):
+    client = Client()
+    client.force_login(user)
+
+    return "{}={}".format(
+        settings.SESSION_COOKIE_NAME,
+        client.cookies[settings.SESSION_COOKIE_NAME].value
+    )
+
+
+def delete_data(users):
+    user_ids = [user.id for user in users]
+    Message.objects.filter(
+        Q(sender_id__in=user_ids) | Q(receiver_id__in=user_ids)
+    ).delete()
+    Dialog.objects.filter(
+        Q(owner_id__in=user_ids) | Q(interlocutor_id__in=user_ids)
+    ).delete()
+    get_user_model().objects.filter(id__in=user_ids).delete()
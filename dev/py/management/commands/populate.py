@@ -1,25 +1,321 @@
+import itertools
+import multiprocessing
+import random
+import time
+from datetime import timedelta
+
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connections
+from django.utils import timezone
+
+from messages.managers import get_conversation_id
+from messages.models import Dialog
+from messages.models import Message
+
+
+PASSWORD = "Ie25xSbcasc"
+WORDS = [
+    "hello", "how", "are", "you", "fine", "thanks", "what", "about",
+    "tomorrow", "meeting", "call", "me", "later", "ok", "sure", "see",
+    "the", "photos", "new", "project", "lunch", "today", "yes", "no"
+]
+# Unread messages are a tail of one interlocutor's messages
+MAX_UNREAD_TAIL = 5
 
 
 class Command(BaseCommand):
+    help = (
+        "Creates the development users and optionally synthetic users, "
+        "dialogs and messages"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=0,
+            help="Number of synthetic users"
+        )
+        parser.add_argument(
+            "--dialogs-per-user",
+            type=float,
+            default=10,
+            help="Mean number of dialogs started by a user"
+        )
+        parser.add_argument(
+            "--messages-per-dialog",
+            type=float,
+            default=50,
+            help="Mean number of messages in a dialog"
+        )
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=1.5,
+            help="Pareto shape of dialogs' numbers and sizes, "
+                 "smaller is more skewed"
+        )
+        parser.add_argument(
+            "--unread-ratio",
+            type=float,
+            default=0.2,
+            help="Share of dialogs which end with unread messages"
+        )
+        parser.add_argument(
+            "--deleted-ratio",
+            type=float,
+            default=0.05,
+            help="Share of messages deleted by each side"
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=365,
+            help="Messages are spread over this number of last days"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="Number of rows in one INSERT"
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes which insert messages"
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            help="Seed of the generated data"
+        )
+
     def handle(self, *args, **options):
-        user1 = get_user_model().objects.create(
-            id=1, username="1", email="1@email.com"
+        if options["skew"] <= 1:
+            raise CommandError("--skew has to be bigger than 1")
+
+        if not get_user_model().objects.filter(id=1).exists():
+            create_default_users()
+        if options["users"] == 0:
+            return
+
+        started_at = time.perf_counter()
+        rng = random.Random(options["seed"])
+        user_ids = create_users(options["users"], options["batch_size"])
+        pairs = get_pairs(
+            user_ids, rng,
+            options["dialogs_per_user"], options["skew"]
+        )
+
+        dialog_options = {
+            name: options[name] for name in [
+                "messages_per_dialog", "skew", "unread_ratio",
+                "deleted_ratio", "days", "batch_size"
+            ]
+        }
+        # Every chunk is generated with its own seed,
+        # so the result doesn't depend on the number of workers
+        chunks = [
+            (pairs[i:i + options["batch_size"]], rng.random(), dialog_options)
+            for i in range(0, len(pairs), options["batch_size"])
+        ]
+        if options["workers"] > 1:
+            # Children mustn't share connections of the parent
+            connections.close_all()
+            context = multiprocessing.get_context("fork")
+            with context.Pool(options["workers"]) as pool:
+                results = pool.map(create_dialogs, chunks)
+        else:
+            results = [create_dialogs(chunk) for chunk in chunks]
+
+        self.stdout.write(
+            "Created {} users, {} dialogs and {} messages in {:.1f}s".format(
+                len(user_ids),
+                sum(dialogs_number for dialogs_number, _ in results),
+                sum(messages_number for _, messages_number in results),
+                time.perf_counter() - started_at
+            )
+        )
+
+
+def create_default_users():
+    for i in range(1, 4):
+        user = get_user_model().objects.create(
+            id=i, username=str(i), email="{}@email.com".format(i)
         )
-        user1.set_password("Ie25xSbcasc")
-        user1.save()
-        user2 = get_user_model().objects.create(
-            id=2, username="2", email="2@email.com",
+        user.set_password(PASSWORD)
+        user.save()
+
+    get_user_model().objects.create_superuser(
+        "admin", "admin@email.com", PASSWORD
+    )
+
+
+def create_users(users_number, batch_size):
+    users_manager = get_user_model().objects
+    # Users of previous runs keep their names
+    first_number = users_manager.filter(
+        username__startswith="synthetic"
+    ).count()
+    last_id = users_manager.order_by("-id").values_list(
+        "id", flat=True
+    ).first() or 0
+    password = make_password(PASSWORD)
+
+    users = []
+    for number in range(first_number, first_number + users_number):
+        users.append(get_user_model()(
+            username="synthetic{}".format(number),
+            email="synthetic{}@email.com".format(number),
+            password=password
+        ))
+        if len(users) == batch_size:
+            users_manager.bulk_create(users)
+            users = []
+    users_manager.bulk_create(users)
+
+    # Ids aren't returned by bulk_create on every backend
+    return list(users_manager.filter(
+        id__gt=last_id,
+        username__startswith="synthetic"
+    ).order_by("id").values_list("id", flat=True))
+
+
+def get_pairs(user_ids, rng, dialogs_per_user, skew):
+    # Popular users take part in more dialogs
+    popularities = [
+        1 / (i + 1) for i in range(len(user_ids))
+    ]
+    rng.shuffle(popularities)
+    cum_popularities = list(itertools.accumulate(popularities))
+
+    pairs = set()
+    for user_id in user_ids:
+        dialogs_number = min(
+            get_skewed_number(rng, dialogs_per_user, skew),
+            len(user_ids) - 1
         )
-        user2.set_password("Ie25xSbcasc")
-        user2.save()
-        user3 = get_user_model().objects.create(
-            id=3, username="3", email="3@email.com",
+        interlocutor_ids = rng.choices(
+            user_ids,
+            cum_weights=cum_popularities,
+            k=dialogs_number
         )
-        user3.set_password("Ie25xSbcasc")
-        user3.save()
+        for interlocutor_id in interlocutor_ids:
+            if interlocutor_id != user_id:
+                pairs.add((
+                    min(user_id, interlocutor_id),
+                    max(user_id, interlocutor_id)
+                ))
+
+    return sorted(pairs)
+
+
+def get_skewed_number(rng, mean, skew):
+    # Pareto distribution with the given mean
+    scale = mean * (skew - 1) / skew
+
+    return max(1, round(scale * rng.paretovariate(skew)))
+
+
+def create_dialogs(chunk):
+    pairs, seed, options = chunk
+    rng = random.Random(seed)
+    now = timezone.now()
 
-        get_user_model().objects.create_superuser(
-            "admin", "admin@email.com", "Ie25xSbcasc"
+    messages = []
+    dialogs = []
+    messages_number = 0
+    for user1_id, user2_id in pairs:
+        dialog_messages = generate_messages(
+            rng, now, user1_id, user2_id, options
         )
+        messages.extend(dialog_messages)
+        dialogs.extend(summarize(dialog_messages, user1_id, user2_id))
+
+        if len(messages) >= options["batch_size"]:
+            Message.objects.bulk_create(messages, options["batch_size"])
+            messages_number += len(messages)
+            messages = []
+
+    Message.objects.bulk_create(messages, options["batch_size"])
+    Dialog.objects.bulk_create(dialogs, options["batch_size"])
+    messages_number += len(messages)
+
+    return len(dialogs), messages_number
+
+
+def generate_messages(rng, now, user1_id, user2_id, options):
+    messages_number = get_skewed_number(
+        rng,
+        options["messages_per_dialog"],
+        options["skew"]
+    )
+    started_at = now - timedelta(days=rng.uniform(0, options["days"]))
+    duration = (now - started_at).total_seconds()
+    times = sorted(
+        started_at + timedelta(seconds=rng.uniform(0, duration))
+        for _ in range(messages_number)
+    )
+    conversation_id = get_conversation_id(user1_id, user2_id)
+
+    messages = []
+    for message_time in times:
+        sender_id, receiver_id = rng.choice([
+            (user1_id, user2_id),
+            (user2_id, user1_id)
+        ])
+        messages.append(Message(
+            time=message_time,
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            conversation_id=conversation_id,
+            text=" ".join(rng.choices(WORDS, k=rng.randint(1, 12))),
+            is_unread=False,
+            is_deleted_by_sender=rng.random() < options["deleted_ratio"],
+            is_deleted_by_receiver=rng.random() < options["deleted_ratio"]
+        ))
+
+    if rng.random() < options["unread_ratio"]:
+        last_sender_id = messages[-1].sender_id
+        for message in reversed(messages[-MAX_UNREAD_TAIL:]):
+            if message.sender_id != last_sender_id:
+                break
+            message.is_unread = True
+
+    return messages
+
+
+def summarize(messages, user1_id, user2_id):
+    dialogs = []
+    for owner_id, interlocutor_id in [
+        (user1_id, user2_id),
+        (user2_id, user1_id)
+    ]:
+        visible_messages = [
+            message for message in messages
+            if not (
+                message.sender_id == owner_id
+                and message.is_deleted_by_sender
+                or message.receiver_id == owner_id
+                and message.is_deleted_by_receiver
+            )
+        ]
+        if len(visible_messages) == 0:
+            continue
+
+        dialogs.append(Dialog(
+            owner_id=owner_id,
+            interlocutor_id=interlocutor_id,
+            last_message_time=visible_messages[-1].time,
+            last_text=visible_messages[-1].text,
+            unread_count=sum(
+                1 for message in visible_messages
+                if message.receiver_id == owner_id and message.is_unread
+            )
+        ))
+
+    return dialogs
@@ -0,0 +1,51 @@
+import redis
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+
+from common.context_processors import unread_dialogs
+from dev.py.utils import CustomTestCase
+from messages.models import Message
+
+
+class TestUnreadDialogs(CustomTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_user(cls)
+
+    def setUp(self):
+        self.redis_cache = redis.Redis(
+            decode_responses=True,
+            db=settings.FS_REDIS_DB
+        )
+        self.request = self.factory.get("/")
+
+    def tearDown(self):
+        self.redis_cache.flushdb()
+
+    def test_nonauthorised(self):
+        self.request.user = AnonymousUser()
+        self.assertEqual(unread_dialogs(self.request), {})
+
+    def test_authorised(self):
+        self.request.user = self.user
+        self.assertEqual(
+            unread_dialogs(self.request),
+            {"unread_dialogs_exist": False}
+        )
+
+    def test_memoisation(self):
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        self.request.user = self.user
+        self.assertEqual(
+            unread_dialogs(self.request),
+            {"unread_dialogs_exist": True}
+        )
+
+        self.redis_cache.flushdb()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                unread_dialogs(self.request),
+                {"unread_dialogs_exist": True}
+            )
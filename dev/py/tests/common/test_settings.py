@@ -9,6 +9,25 @@ class TestSettings(CustomTestCase):
         self.assertEqual(settings.FS_DIALOG_INTEGRITY_TIMEOUT, 20*60)
         self.assertEqual(settings.FS_DIALOGS_INTEGRITY_TIMEOUT, 20*60)
         self.assertEqual(settings.FS_UNREAD_DIALOGS_TIMEOUT, 20*60)
+        self.assertEqual(settings.FS_DELETED_USERS_TIMEOUT, 5*60)
         self.assertEqual(settings.FS_NEW_MESSAGES_PERIOD, 60*60)
         self.assertEqual(settings.FS_REDIS_DB, 1)
+        self.assertEqual(settings.FS_REDIS_MAX_CONNECTIONS, 50)
+        self.assertEqual(settings.FS_REDIS_SOCKET_TIMEOUT, 5)
+        self.assertEqual(settings.FS_REDIS_SOCKET_CONNECT_TIMEOUT, 5)
+        self.assertEqual(settings.FS_REDIS_HEALTH_CHECK_INTERVAL, 30)
+        self.assertEqual(settings.FS_LOCAL_CACHE, False)
+        self.assertEqual(settings.FS_LOCAL_CACHE_MAX_SIZE, 10000)
+        self.assertEqual(settings.FS_LOCAL_CACHE_TIMEOUT, 5)
+        self.assertEqual(settings.FS_DIALOG_MESSAGES_PAGE_SIZE, 50)
+        self.assertEqual(settings.FS_MESSAGES_CHUNK_SIZE, 200)
+        self.assertEqual(settings.FS_CONNECTION_TTL, 60)
+        self.assertEqual(settings.FS_CONNECTION_HEARTBEAT_INTERVAL, 20)
+        self.assertEqual(settings.FS_MAX_SESSIONS_PER_USER, 5)
+        self.assertEqual(settings.FS_WRITE_BEHIND, False)
+        self.assertEqual(settings.FS_WRITE_BEHIND_BATCH_SIZE, 500)
+        self.assertEqual(settings.FS_WRITE_BEHIND_FLUSH_INTERVAL, 0.2)
+        self.assertEqual(settings.FS_WRITE_BEHIND_MAX_QUEUE_SIZE, 10000)
+        self.assertEqual(settings.FS_WRITE_BEHIND_LOCK_TIMEOUT, 30)
+        self.assertEqual(settings.FS_BINARY_PROTOCOL, False)
         self.assertEqual(settings.FS_TIME_FORMAT, "%Y.%m.%d %H:%M:%S")
@@ -60,6 +60,7 @@ class TestBase(CustomTestCase):
         with self.settings(DEBUG=True):
             html_code = self.render(
                 "base.html", is_authorised=True,
+                request_user_attrs={"unread_dialogs_exist": False}
             )
             self.assertIn(
                 '<div id="is_debug" data-is-debug="true" style="display: none"',
@@ -69,6 +70,7 @@ class TestBase(CustomTestCase):
         with self.settings(DEBUG=False):
             html_code = self.render(
                 "base.html", is_authorised=True,
+                request_user_attrs={"unread_dialogs_exist": False}
             )
             self.assertIn(
                 '<div id="is_debug" data-is-debug="false" style="display: none',
@@ -79,6 +81,7 @@ class TestBase(CustomTestCase):
         self.data = {"is_debug": True}
         html_code = self.render(
             "base.html", self.data, is_authorised=True,
+            request_user_attrs={"unread_dialogs_exist": False}
         )
         self.assertIn(
             '<script type="text/javascript" src="/static/common/js/base.js">',
@@ -90,7 +93,9 @@ class TestAccount(CustomTestCase):
     def test(self):
         html_code = self.render(
             "common/account.html", is_authorised=True,
-            request_user_attrs={"username": "name"}
+            request_user_attrs={
+                "username": "name", "unread_dialogs_exist": False
+            }
         )
         self.assertIn("<title>Account</title>", html_code)
         self.assertIn(
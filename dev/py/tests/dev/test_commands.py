@@ -0,0 +1,207 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest.mock import AsyncMock
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync as ats
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from dev.management.commands.benchmark import compare
+from dev.management.commands.loadtest import get_users
+from dev.management.commands.loadtest import parse_mix
+from dev.management.commands.loadtest import percentile
+from dev.management.commands.loadtest import SimulatedUser
+from dev.py.utils import CustomTestCase
+from messages.cache import get_sync_redis_cache
+from messages.managers import get_conversation_id
+from messages.models import Dialog
+from messages.models import Message
+
+
+class TestLoadtest(CustomTestCase):
+    def test_parse_mix(self):
+        self.assertEqual(
+            parse_mix("send=8, read=1,delete=0"),
+            {"send": 8, "read": 1, "delete": 0}
+        )
+
+        for mix in ["send", "send=a", "send=1,edit=1", "send=0", "send=-1"]:
+            with self.assertRaises(CommandError):
+                parse_mix(mix)
+
+    def test_percentile(self):
+        values = [i / 1000 for i in range(100, 0, -1)]
+
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([0.001], 99), 1)
+        self.assertIsNone(percentile([], 50))
+
+    def test_get_users(self):
+        users = get_users(2)
+        self.assertEqual(
+            [user.username for user in users],
+            ["loadtest0", "loadtest1"]
+        )
+        self.assertEqual(users[0].email, "loadtest0@loadtest.invalid")
+        self.assertEqual(get_users(2), users)
+
+        get_user_model().objects.create(
+            username="loadtest2",
+            email="user@email.com"
+        )
+        with self.assertRaises(CommandError):
+            get_users(3)
+        self.assertFalse(
+            get_user_model().objects.filter(username="loadtest3").exists()
+        )
+
+    def test_simulated_user___late_reply(self):
+        users = get_users(2)
+        simulated_user = SimulatedUser(users[0], users[1], "", 1)
+        stale_reply = json.dumps({
+            "command": "get_new_message",
+            "message": {"text": "text0"}
+        })
+        reply = json.dumps({
+            "command": "get_new_message",
+            "message": {"text": "text1"}
+        })
+        simulated_user.dialog = Mock(
+            send_to=AsyncMock(),
+            receive_from=AsyncMock(side_effect=[stale_reply, reply]),
+            receive_nothing=AsyncMock(side_effect=[False, True])
+        )
+        simulated_user.dialogs = Mock(
+            receive_nothing=AsyncMock(return_value=True)
+        )
+
+        ats(simulated_user.do)("send", "text1")
+        self.assertEqual(simulated_user.dialog.receive_from.call_count, 2)
+
+        simulated_user.dialog.receive_nothing = AsyncMock(return_value=True)
+        simulated_user.dialog.receive_from = AsyncMock(side_effect=[
+            stale_reply,
+            reply
+        ])
+        ats(simulated_user.do)("send", "text1")
+        self.assertEqual(simulated_user.dialog.receive_from.call_count, 2)
+
+
+class TestPopulate(CustomTestCase):
+    def test(self):
+        call_command("populate")
+
+        self.assertCountEqual(
+            get_user_model().objects.values_list("username", flat=True),
+            ["1", "2", "3", "admin"]
+        )
+
+    def test_synthetic(self):
+        out = StringIO()
+        call_command(
+            "populate", "--users", "30", "--dialogs-per-user", "3",
+            "--messages-per-dialog", "8", "--unread-ratio", "0.5",
+            "--deleted-ratio", "0.2", "--batch-size", "50", "--seed", "1",
+            stdout=out
+        )
+
+        user_ids = list(get_user_model().objects.filter(
+            username__startswith="synthetic"
+        ).values_list("id", flat=True))
+        self.assertEqual(len(user_ids), 30)
+        self.assertRegex(
+            out.getvalue(),
+            r"^Created 30 users, {} dialogs and {} messages in ".format(
+                Dialog.objects.count(),
+                Message.objects.count()
+            )
+        )
+        self.assertTrue(Message.objects.filter(is_unread=True).exists())
+        self.assertTrue(
+            Message.objects.filter(is_deleted_by_sender=True).exists()
+        )
+        for message in Message.objects.all()[:20]:
+            self.assertEqual(
+                message.conversation_id,
+                get_conversation_id(message.sender_id, message.receiver_id)
+            )
+
+        # Summaries are the same as ones built from messages
+        fields = [
+            "owner_id", "interlocutor_id", "last_message_time",
+            "last_text", "unread_count"
+        ]
+        summaries = list(Dialog.objects.values_list(*fields))
+        for user_id in user_ids:
+            Dialog.objects.rebuild(user_id)
+        self.assertCountEqual(
+            Dialog.objects.values_list(*fields),
+            summaries
+        )
+
+    def test_invalid_skew(self):
+        with self.assertRaises(CommandError):
+            call_command("populate", "--users", "2", "--skew", "1")
+
+
+class TestBenchmark(CustomTestCase):
+    def test(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.json")
+            out = StringIO()
+            call_command(
+                "benchmark", "--sizes", "3,5", "--repeat", "1",
+                "--redis", "real", "--output", path,
+                stdout=out
+            )
+
+            with open(path) as f:
+                results = json.load(f)
+
+        self.assertEqual(len(results), 12)
+        self.assertEqual(
+            set(results["hash_buckets[5]"]),
+            {"time", "min_time", "queries", "peak_memory"}
+        )
+        self.assertEqual(results["Message.as_dict[3]"]["queries"], 0)
+        self.assertEqual(
+            results["MessagesManager.get_dialog_messages[5]"]["queries"],
+            1
+        )
+        self.assertIn("hash_buckets[3]", out.getvalue())
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(get_sync_redis_cache().exists("dib_-1--2"))
+
+    def test___no_fakeredis(self):
+        with patch("dev.management.commands.benchmark.fakeredis", None):
+            for redis in ["auto", "fake"]:
+                with self.assertRaises(CommandError):
+                    call_command(
+                        "benchmark", "--sizes", "3", "--redis", redis,
+                        stdout=StringIO()
+                    )
+
+    def test_compare(self):
+        result = {"time": 1, "min_time": 1, "queries": 1, "peak_memory": 10}
+        baseline = {
+            "a[1]": result,
+            "b[1]": {**result, "time": 0.7, "queries": 0},
+            "c[1]": {**result, "peak_memory": 9}
+        }
+
+        self.assertEqual(
+            compare(
+                {"a[1]": result, "b[1]": result, "c[1]": result,
+                 "d[1]": result},
+                baseline,
+                0.25
+            ),
+            ["b[1] time: 1 > 0.7", "b[1] queries: 1 > 0"]
+        )
@@ -0,0 +1,362 @@
+import time
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+import redis
+from asgiref.sync import async_to_sync as ats
+from django.conf import settings
+from redis import asyncio as aioredis
+
+from dev.py.utils import CustomTestCase
+from messages import cache
+from messages.cache import AwaitableRedis
+from messages.cache import get_invalidation_channel
+from messages.cache import get_local_cache
+from messages.cache import get_local_cache_stats
+from messages.cache import get_pool_kwargs
+from messages.cache import get_pool_stats
+from messages.cache import get_redis_cache
+from messages.cache import get_sync_redis_cache
+from messages.cache import listen_invalidations
+from messages.cache import LocalCache
+from messages.cache import RedisManager
+from messages.cache import SyncFacade
+
+
+class FakeManager(RedisManager):
+    value = "value"
+
+    async def get_value(self):
+        return self.value
+
+    async def get_redis_cache(self):
+        return self.redis_cache
+
+    async def set_values(self, key, values):
+        async with self.redis_cache.pipeline() as pipeline:
+            pipeline.delete(key)
+            pipeline.sadd(key, *values)
+            return await pipeline.execute()
+
+
+class TestGetRedisCache(CustomTestCase):
+    def test(self):
+        async def get_caches():
+            return get_redis_cache(), get_redis_cache()
+
+        cache1, cache2 = ats(get_caches)()
+        self.assertIsInstance(cache1, aioredis.Redis)
+        self.assertIs(cache1, cache2)
+        self.assertEqual(
+            cache1.connection_pool.max_connections,
+            settings.FS_REDIS_MAX_CONNECTIONS
+        )
+
+        cache3, _ = ats(get_caches)()
+        self.assertIsNot(cache1, cache3)
+
+    def test_no_running_loop(self):
+        with self.assertRaises(RuntimeError):
+            get_redis_cache()
+
+
+class TestGetSyncRedisCache(CustomTestCase):
+    def test(self):
+        redis_cache = get_sync_redis_cache()
+
+        self.assertIsInstance(redis_cache, redis.Redis)
+        self.assertIs(redis_cache, get_sync_redis_cache())
+        self.assertEqual(
+            redis_cache.connection_pool.connection_kwargs["db"],
+            settings.FS_REDIS_DB
+        )
+
+
+class TestGetPoolKwargs(CustomTestCase):
+    def test(self):
+        self.assertEqual(get_pool_kwargs(), {
+            "db": settings.FS_REDIS_DB,
+            "decode_responses": True,
+            "max_connections": settings.FS_REDIS_MAX_CONNECTIONS,
+            "socket_timeout": settings.FS_REDIS_SOCKET_TIMEOUT,
+            "socket_connect_timeout": (
+                settings.FS_REDIS_SOCKET_CONNECT_TIMEOUT
+            ),
+            "health_check_interval": settings.FS_REDIS_HEALTH_CHECK_INTERVAL
+        })
+
+
+class TestGetPoolStats(CustomTestCase):
+    def test(self):
+        get_sync_redis_cache().ping()
+
+        async def ping():
+            await get_redis_cache().ping()
+
+            return get_pool_stats()
+
+        stats = ats(ping)()
+        self.assertEqual(
+            stats["max_connections"],
+            settings.FS_REDIS_MAX_CONNECTIONS
+        )
+        self.assertGreaterEqual(stats["async"]["pools"], 1)
+        self.assertGreaterEqual(stats["async"]["available_connections"], 1)
+        self.assertEqual(stats["sync"]["pools"], 1)
+        self.assertGreaterEqual(stats["sync"]["available_connections"], 1)
+
+
+class TestAwaitableRedis(CustomTestCase):
+    def test(self):
+        redis_cache = AwaitableRedis(get_sync_redis_cache())
+        ats(redis_cache.set)("key", "value")
+
+        self.assertEqual(ats(redis_cache.get)("key"), "value")
+        get_sync_redis_cache().flushdb()
+
+
+class TestRedisManager(CustomTestCase):
+    def test_redis_cache(self):
+        manager = FakeManager()
+
+        async def get_cache():
+            return manager.redis_cache, get_redis_cache()
+
+        cache1, cache2 = ats(get_cache)()
+        self.assertIs(cache1, cache2)
+
+    def test_run_script(self):
+        manager = FakeManager()
+        script = "return {KEYS[1], ARGV[1]}"
+        get_sync_redis_cache().script_flush()
+
+        self.assertEqual(
+            ats(manager.run_script)(script, ["key"], ["arg"]),
+            ["key", "arg"]
+        )
+        self.assertEqual(
+            ats(manager.run_script)(script, ["key"], ["arg"]),
+            ["key", "arg"]
+        )
+
+    def test_get_cached(self):
+        manager = FakeManager()
+        read = AsyncMock(return_value={"a": "1"})
+
+        self.assertEqual(ats(manager.get_cached)("key", read), {"a": "1"})
+        self.assertEqual(ats(manager.get_cached)("key", read), {"a": "1"})
+        self.assertEqual(read.await_count, 2)
+
+        local_cache = LocalCache(10, 60)
+        with self.settings(FS_LOCAL_CACHE=True), patch.object(
+            cache, "_local_cache", local_cache
+        ):
+            ats(manager.get_cached)("key", read)
+            self.assertEqual(
+                ats(manager.get_cached)("key", read),
+                {"a": "1"}
+            )
+            self.assertEqual(read.await_count, 3)
+
+            # Missing keys aren't kept
+            read.return_value = {}
+            ats(manager.get_cached)("key2", read)
+            ats(manager.get_cached)("key2", read)
+            self.assertEqual(read.await_count, 5)
+
+    def test_invalidate(self):
+        manager = FakeManager()
+        local_cache = LocalCache(10, 60)
+        local_cache.set("key", 1, 0)
+        local_cache.set("key2", 2, 0)
+        pubsub = get_sync_redis_cache().pubsub(
+            ignore_subscribe_messages=True
+        )
+        pubsub.subscribe(get_invalidation_channel())
+
+        with self.settings(FS_LOCAL_CACHE=True), patch.object(
+            cache, "_local_cache", local_cache
+        ):
+            ats(manager.invalidate)("key", "key2")
+
+        self.assertIsNone(local_cache.get("key"))
+        self.assertIsNone(local_cache.get("key2"))
+        # The confirmation of the subscription is skipped
+        message = pubsub.get_message(timeout=1)
+        message = message or pubsub.get_message(timeout=1)
+        self.assertEqual(message["data"], "key key2")
+        pubsub.close()
+
+    def test_sync(self):
+        manager = FakeManager()
+        self.assertIsInstance(manager.sync, SyncFacade)
+        self.assertIs(manager.sync.manager, manager)
+
+
+class TestSyncFacade(CustomTestCase):
+    def test(self):
+        facade = SyncFacade(FakeManager())
+
+        self.assertEqual(facade.get_value(), "value")
+        self.assertEqual(facade.value, "value")
+
+    def test_shared_sync_pool(self):
+        facade = SyncFacade(FakeManager())
+        redis_cache = facade.get_redis_cache()
+
+        self.assertIsInstance(redis_cache, AwaitableRedis)
+        self.assertIs(redis_cache.redis_cache, get_sync_redis_cache())
+
+    def test_pipeline(self):
+        facade = SyncFacade(FakeManager())
+        redis_cache = get_sync_redis_cache()
+        redis_cache.sadd("key", "a")
+
+        self.assertEqual(facade.set_values("key", ["b", "c"]), [1, 2])
+        self.assertCountEqual(redis_cache.smembers("key"), {"b", "c"})
+        self.assertEqual(
+            ats(FakeManager().set_values)("key", ["d"]),
+            [1, 1]
+        )
+        self.assertCountEqual(redis_cache.smembers("key"), {"d"})
+        redis_cache.flushdb()
+
+
+class TestLocalCache(CustomTestCase):
+    def test(self):
+        local_cache = LocalCache(2, 60)
+        value = {"a": 1}
+
+        local_cache.set("key", value, local_cache.version)
+        value["a"] = 2
+        self.assertEqual(local_cache.get("key"), {"a": 1})
+        local_cache.get("key")["a"] = 3
+        self.assertEqual(local_cache.get("key"), {"a": 1})
+        self.assertIsNone(local_cache.get("key2"))
+
+    def test_lru(self):
+        local_cache = LocalCache(2, 60)
+        local_cache.set("key1", 1, 0)
+        local_cache.set("key2", 2, 0)
+        local_cache.get("key1")
+        local_cache.set("key3", 3, 0)
+
+        self.assertEqual(local_cache.get("key1"), 1)
+        self.assertIsNone(local_cache.get("key2"))
+        self.assertEqual(local_cache.get("key3"), 3)
+
+    def test_timeout(self):
+        local_cache = LocalCache(2, -1)
+        local_cache.set("key", 1, 0)
+
+        self.assertIsNone(local_cache.get("key"))
+        self.assertEqual(local_cache.values, {})
+
+    def test_version(self):
+        local_cache = LocalCache(2, 60)
+        version = local_cache.version
+        local_cache.delete("key")
+        local_cache.set("key", 1, version)
+        self.assertIsNone(local_cache.get("key"))
+
+        # Other keys don't drop the value
+        version = local_cache.version
+        local_cache.delete("key2")
+        local_cache.set("key", 1, version)
+        self.assertEqual(local_cache.get("key"), 1)
+
+        version = local_cache.version
+        local_cache.clear()
+        local_cache.set("key", 1, version)
+        self.assertIsNone(local_cache.get("key"))
+
+    def test_version___forgotten(self):
+        local_cache = LocalCache(2, 60)
+        version = local_cache.version
+        local_cache.delete("key1", "key2", "key3")
+        self.assertEqual(list(local_cache.deletion_versions), ["key2", "key3"])
+
+        # A forgotten key is considered deleted at the newest version
+        local_cache.set("key1", 1, version)
+        self.assertIsNone(local_cache.get("key1"))
+        local_cache.set("key4", 4, version)
+        self.assertIsNone(local_cache.get("key4"))
+
+        local_cache.set("key4", 4, local_cache.version)
+        self.assertEqual(local_cache.get("key4"), 4)
+
+    def test_delete(self):
+        local_cache = LocalCache(3, 60)
+        for key in ["key1", "key2", "key3"]:
+            local_cache.set(key, 1, 0)
+
+        local_cache.delete("key1", "key2")
+        self.assertIsNone(local_cache.get("key1"))
+        self.assertIsNone(local_cache.get("key2"))
+        self.assertEqual(local_cache.get("key3"), 1)
+
+        local_cache.clear()
+        self.assertIsNone(local_cache.get("key3"))
+
+    def test_get_stats(self):
+        local_cache = LocalCache(1, 60)
+        local_cache.set("key1", 1, 0)
+        local_cache.set("key2", 2, 0)
+        local_cache.get("key1")
+        local_cache.get("key2")
+
+        self.assertEqual(local_cache.get_stats(), {
+            "size": 1,
+            "max_size": 1,
+            "hits": 1,
+            "misses": 1,
+            "evictions": 1
+        })
+
+
+class TestGetLocalCache(CustomTestCase):
+    @patch("messages.cache.listen_invalidations")
+    def test(self, listen_invalidations_mock):
+        with patch.object(cache, "_local_cache", None):
+            self.assertIsNone(get_local_cache())
+            self.assertIsNone(get_local_cache_stats())
+
+            with self.settings(
+                FS_LOCAL_CACHE=True,
+                FS_LOCAL_CACHE_MAX_SIZE=5
+            ):
+                local_cache = get_local_cache()
+                self.assertIsInstance(local_cache, LocalCache)
+                self.assertEqual(local_cache.max_size, 5)
+                self.assertIs(get_local_cache(), local_cache)
+                self.assertEqual(
+                    get_local_cache_stats(),
+                    local_cache.get_stats()
+                )
+
+        listen_invalidations_mock.assert_called_once_with(local_cache)
+
+
+class TestListenInvalidations(CustomTestCase):
+    def test(self):
+        local_cache = LocalCache(10, 60)
+        local_cache.set("key1", 1, 0)
+        local_cache.set("key2", 2, 0)
+        local_cache.set("key3", 3, 0)
+
+        thread = listen_invalidations(local_cache)
+        try:
+            get_sync_redis_cache().publish(
+                get_invalidation_channel(),
+                "key1 key2"
+            )
+            for _ in range(100):
+                if local_cache.get_stats()["size"] == 1:
+                    break
+                time.sleep(0.01)
+        finally:
+            thread.stop()
+            thread.join()
+
+        self.assertEqual(local_cache.get("key3"), 3)
+        self.assertIsNone(local_cache.get("key1"))
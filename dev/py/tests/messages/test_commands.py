@@ -0,0 +1,92 @@
+from io import StringIO
+from unittest.mock import patch
+
+import redis
+from asgiref.sync import async_to_sync as ats
+from django.conf import settings
+from django.core.management import call_command
+
+from dev.py.utils import CustomTestCase
+from messages.managers import get_conversation_id
+from messages.models import Dialog
+from messages.models import Message
+from messages.writebehind import MessagesQueue
+
+
+class TestRebuildDialogs(CustomTestCase):
+    def setUp(self):
+        Message.objects.create(sender_id=1, receiver_id=2, text="text1")
+        Message.objects.create(sender_id=3, receiver_id=1, text="text2")
+        Dialog.objects.create(
+            owner_id=5, interlocutor_id=6,
+            last_message_time=Message.objects.first().time
+        )
+
+    def test(self):
+        out = StringIO()
+        call_command("rebuild_dialogs", stdout=out)
+
+        self.assertEqual(out.getvalue(), "Rebuilt 4 dialogs of 3 users\n")
+        self.assertCountEqual(
+            Dialog.objects.values_list(
+                "owner_id", "interlocutor_id", "unread_count"
+            ),
+            [(1, 2, 0), (2, 1, 1), (1, 3, 1), (3, 1, 0)]
+        )
+
+    def test_user_ids(self):
+        out = StringIO()
+        call_command("rebuild_dialogs", "--user-id", "2", stdout=out)
+
+        self.assertEqual(out.getvalue(), "Rebuilt 1 dialogs of 1 users\n")
+        self.assertCountEqual(
+            Dialog.objects.values_list("owner_id", "interlocutor_id"),
+            [(2, 1), (5, 6)]
+        )
+
+
+class TestBackfillConversationIds(CustomTestCase):
+    def setUp(self):
+        Message.objects.create(sender_id=1, receiver_id=2, text="text1")
+        Message.objects.create(sender_id=3, receiver_id=1, text="text2")
+        Message.objects.create(sender_id=2, receiver_id=1, text="text3")
+        Message.objects.update(conversation_id=None)
+
+    def test(self):
+        out = StringIO()
+        call_command(
+            "backfill_conversation_ids", "--batch-size", "2", stdout=out
+        )
+
+        self.assertEqual(out.getvalue(), "Backfilled 3 messages\n")
+        self.assertCountEqual(
+            Message.objects.values_list("conversation_id", flat=True),
+            [
+                get_conversation_id(1, 2),
+                get_conversation_id(1, 3),
+                get_conversation_id(1, 2)
+            ]
+        )
+
+        out = StringIO()
+        call_command("backfill_conversation_ids", stdout=out)
+        self.assertEqual(out.getvalue(), "Backfilled 0 messages\n")
+
+
+class TestFlushMessages(CustomTestCase):
+    def tearDown(self):
+        redis.Redis(db=settings.FS_REDIS_DB).flushdb()
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test(self, p_ensure_flush_task):
+        queue = MessagesQueue()
+        for i in range(3):
+            ats(queue.put)(1, 2, "text{}".format(i))
+
+        out = StringIO()
+        with self.settings(FS_WRITE_BEHIND_BATCH_SIZE=2):
+            call_command("flush_messages", stdout=out)
+
+        self.assertEqual(out.getvalue(), "Flushed 3 messages, 0 are left\n")
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(p_ensure_flush_task.call_count, 3)
@@ -1,5 +1,6 @@
 import json
 from copy import deepcopy
+from unittest.mock import AsyncMock
 from unittest.mock import call
 from unittest.mock import Mock
 from unittest.mock import patch
@@ -9,23 +10,40 @@ from asgiref.sync import async_to_sync as ats
 from channels.layers import get_channel_layer
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 from dev.py.utils import CustomTestCase
-from messages.consumers import clear_group
+from messages.consumers import add_session
 from messages.consumers import CustomAsyncWebsocketConsumer
 from messages.consumers import DialogConsumer
 from messages.consumers import DialogsConsumer
 from messages.consumers import get_dialog_group_name
 from messages.consumers import get_dialogs_group_name
+from messages.consumers import LOG_DEBUG_LEVEL
+from messages.consumers import LOG_ERROR_LEVEL
 from messages.consumers import LOG_INFO_LEVEL
 from messages.consumers import LOG_WARNING_LEVEL
+from messages.consumers import StageTimer
 from messages.forms import MessagesForm
 from messages.managers import DialogIntegrityManager
 from messages.managers import DialogsIntegrityManager
+from messages.managers import encode_cursor
+from messages.managers import encode_time
+from messages.managers import hash_bucket
 from messages.managers import hash_dialog
-from messages.managers import hash_time
+from messages.managers import hash_message
+from messages.managers import NewMessageManager
 from messages.managers import UnreadDialogsManager
+from messages.models import Dialog
 from messages.models import Message
+from messages.registry import ConnectionRegistry
+from messages.registry import SessionState
+from messages.serializers import BINARY_PROTOCOL
+from messages.serializers import dumps
+from messages.serializers import JSON_PROTOCOL
+from messages.serializers import make_payload_event
+from messages.serializers import pack
+from messages.writebehind import MessagesQueue
 
 
 channel_layer = get_channel_layer()
@@ -47,23 +65,149 @@ class TestCustomAsyncWebsocketConsumer(CustomTestCase):
     def setUp(self):
         self.consumer.channel_layer = channel_layer
 
+    def tearDown(self):
+        redis_cache.flushdb()
+
     def test_disconnect(self):
+        registry = ConnectionRegistry(self.consumer.group_name)
         ats(channel_layer.group_add)(
             self.consumer.group_name,
             self.consumer.channel_name
         )
+        ats(add_session)(
+            self.consumer.group_name,
+            self.consumer.channel_name
+        )
+        session_state = SessionState(self.consumer.channel_name)
+        ats(session_state.create)(1, self.consumer.group_name)
+        self.consumer.heartbeat_task = Mock()
 
         ats(self.consumer.disconnect)("")
         self.assertNotIn(self.consumer.group_name, channel_layer.groups)
+        self.assertEqual(ats(registry.get_channels_names)(), [])
+        self.assertEqual(ats(session_state.get)(), {})
+        self.consumer.heartbeat_task.cancel.assert_called()
+        self.consumer.heartbeat_task = None
+
+    def test_join_group(self):
+        self.consumer.current_user = Mock(id=1)
+
+        async def join_group():
+            await self.consumer.join_group()
+            self.consumer.heartbeat_task.cancel()
+
+        ats(join_group)()
+        self.assertEqual(
+            list(channel_layer.groups[self.consumer.group_name].keys()),
+            [self.consumer.channel_name]
+        )
+        registry = ConnectionRegistry(self.consumer.group_name)
+        self.assertEqual(
+            ats(registry.get_channels_names)(),
+            [self.consumer.channel_name]
+        )
+        self.assertEqual(
+            ats(self.consumer.session_state.get)()["user_id"],
+            "1"
+        )
+        ats(channel_layer.group_discard)(
+            self.consumer.group_name,
+            self.consumer.channel_name
+        )
+        self.consumer.heartbeat_task = None
+
+    @patch("messages.consumers.logger.log")
+    @patch("messages.consumers.CustomAsyncWebsocketConsumer.close")
+    @patch("messages.consumers.asyncio.sleep")
+    @patch("messages.consumers.ConnectionRegistry.refresh")
+    def test_heartbeat(self, p_refresh, p_sleep, p_close, p_logger_log):
+        p_refresh.side_effect = [True, True, False]
+        self.consumer.session_state = Mock(refresh=AsyncMock())
+
+        ats(self.consumer.heartbeat)()
+        self.assertEqual(p_refresh.call_count, 3)
+        self.assertEqual(self.consumer.session_state.refresh.call_count, 2)
+        p_refresh.assert_called_with(self.consumer.channel_name)
+        p_sleep.assert_called_with(settings.FS_CONNECTION_HEARTBEAT_INTERVAL)
+        p_close.assert_called_once()
+        self.assertEqual(p_logger_log.call_args.args[0], LOG_WARNING_LEVEL)
+
+    @patch("messages.consumers.logger.log")
+    @patch("messages.consumers.CustomAsyncWebsocketConsumer.close")
+    @patch("messages.consumers.asyncio.sleep")
+    @patch("messages.consumers.ConnectionRegistry.refresh")
+    def test_heartbeat___error(
+        self, p_refresh, p_sleep, p_close, p_logger_log
+    ):
+        p_refresh.side_effect = redis.ConnectionError("error")
+
+        ats(self.consumer.heartbeat)()
+        p_close.assert_called_once()
+        self.assertEqual(p_logger_log.call_args.args[0], LOG_ERROR_LEVEL)
+        self.assertIn("error", p_logger_log.call_args.args[1])
+
+    @patch("messages.consumers.CustomAsyncWebsocketConsumer.send")
+    @patch("messages.consumers.CustomAsyncWebsocketConsumer.close")
+    def test_evict(self, p_close, p_send):
+        ats(self.consumer.evict)({"type": "evict"})
+        p_send.assert_called_with(dumps({
+            "command": "go_home"
+        }))
+        p_close.assert_called()
 
     @patch("messages.consumers.CustomAsyncWebsocketConsumer.send")
     def test_send_data(self, p_send):
         event = {"data": "event_data"}
         ats(self.consumer.send_data)(event)
         p_send.assert_called_with(
-            json.dumps(event["data"])
+            dumps(event["data"])
         )
 
+    @patch("messages.consumers.CustomAsyncWebsocketConsumer.send")
+    def test_send_payload(self, p_send):
+        event = make_payload_event({"command": "command"})
+        ats(self.consumer.send_payload)(event)
+        p_send.assert_called_with(event["text"])
+
+        self.consumer.protocol = BINARY_PROTOCOL
+        ats(self.consumer.send_payload)(event)
+        p_send.assert_called_with(bytes_data=pack(event["data"]))
+
+    @patch("messages.consumers.CustomAsyncWebsocketConsumer.send")
+    def test_send_command(self, p_send):
+        data = {"command": "command", "messages": [{"id": 1}]}
+        ats(self.consumer.send_command)(data)
+        p_send.assert_called_with(dumps(data))
+
+        self.consumer.protocol = BINARY_PROTOCOL
+        ats(self.consumer.send_command)(data)
+        p_send.assert_called_with(bytes_data=pack(data))
+
+    @patch("messages.consumers.CustomAsyncWebsocketConsumer.accept")
+    def test_accept_protocol(self, p_accept):
+        for subprotocols, protocol in [
+            ([BINARY_PROTOCOL, JSON_PROTOCOL], BINARY_PROTOCOL),
+            ([JSON_PROTOCOL], JSON_PROTOCOL),
+            ([], None)
+        ]:
+            consumer = CustomAsyncWebsocketConsumer()
+            consumer.scope = {"subprotocols": subprotocols}
+            with self.settings(FS_BINARY_PROTOCOL=True):
+                ats(consumer.accept_protocol)()
+            self.assertEqual(consumer.protocol, protocol)
+            p_accept.assert_called_with(protocol)
+
+        consumer = CustomAsyncWebsocketConsumer()
+        consumer.scope = {"subprotocols": [BINARY_PROTOCOL, JSON_PROTOCOL]}
+        ats(consumer.accept_protocol)()
+        self.assertEqual(consumer.protocol, JSON_PROTOCOL)
+
+    def test_decode(self):
+        data = {"command": "command"}
+
+        self.assertEqual(self.consumer.decode(json.dumps(data), None), data)
+        self.assertEqual(self.consumer.decode(None, pack(data)), data)
+
     @patch("messages.consumers.CustomAsyncWebsocketConsumer.send")
     @patch("messages.consumers.CustomAsyncWebsocketConsumer.close")
     def test_check_current_user(self, p_close, p_send):
@@ -71,7 +215,7 @@ class TestCustomAsyncWebsocketConsumer(CustomTestCase):
         self.consumer.current_user.is_authenticated = False
         res = ats(self.consumer.check_current_user)()
         self.assertFalse(res)
-        p_send.assert_called_with(json.dumps({
+        p_send.assert_called_with(dumps({
             "command": "go_home"
         }))
         p_close.assert_called()
@@ -124,11 +268,9 @@ class TestDialogConsumer(CustomTestCase):
         self.consumer.name = "1-2"
         self.consumer.type = "dialog"
         self.consumer.i_manager = DialogIntegrityManager(1, 2)
-        self.consumer.i_manager2 = DialogIntegrityManager(2, 1)
         self.consumer.dsi_manager = DialogsIntegrityManager(1)
-        self.consumer.dsi_manager2 = DialogsIntegrityManager(2)
         self.consumer.uds_manager = UnreadDialogsManager(1)
-        self.consumer.uds_manager2 = UnreadDialogsManager(2)
+        self.consumer.nm_manager = NewMessageManager(1, 2)
         self.consumer.group_name = get_dialog_group_name(1, 2)
         self.consumer.group_name2 = get_dialog_group_name(2, 1)
         self.consumer.dialogs_group_name = get_dialogs_group_name(1)
@@ -146,6 +288,7 @@ class TestDialogConsumer(CustomTestCase):
             group_name,
             "fake-channel-name"
         )
+        ats(add_session)(group_name, "fake-channel-name")
         p_check_current_user.return_value = False
 
         ats(self.consumer.connect)()
@@ -154,12 +297,10 @@ class TestDialogConsumer(CustomTestCase):
         self.assertEqual(self.consumer.name, "1-2")
         self.assertEqual(self.consumer.i_manager.user_id, 1)
         self.assertEqual(self.consumer.i_manager.interlocutor_id, 2)
-        self.assertEqual(self.consumer.i_manager2.user_id, 2)
-        self.assertEqual(self.consumer.i_manager2.interlocutor_id, 1)
         self.assertEqual(self.consumer.dsi_manager.user_id, 1)
-        self.assertEqual(self.consumer.dsi_manager2.user_id, 2)
         self.assertEqual(self.consumer.uds_manager.user_id, 1)
-        self.assertEqual(self.consumer.uds_manager2.user_id, 2)
+        self.assertEqual(self.consumer.nm_manager.sender_id, 1)
+        self.assertEqual(self.consumer.nm_manager.receiver_id, 2)
         self.assertEqual(
             self.consumer.group_name, get_dialog_group_name(1, 2)
         )
@@ -173,19 +314,32 @@ class TestDialogConsumer(CustomTestCase):
             self.consumer.dialogs_group_name2, get_dialogs_group_name(2)
         )
         self.assertEqual(self.consumer.group_name, group_name)
-        self.assertNotIn(self.consumer.group_name, channel_layer.groups)
+        self.assertIn(
+            "fake-channel-name",
+            channel_layer.groups[self.consumer.group_name]
+        )
         p_accept.assert_called()
         p_check_current_user.assert_called()
         p_send.assert_not_called()
 
         p_check_current_user.return_value = True
-        ats(self.consumer.connect)()
+        with self.settings(FS_MAX_SESSIONS_PER_USER=1):
+            ats(self.consumer.connect)()
         p_check_current_user.assert_called()
         self.assertEqual(
             list(channel_layer.groups[group_name].keys()),
             [self.channel_name]
         )
-        p_send.assert_called_with(json.dumps({
+        self.assertEqual(
+            ats(ConnectionRegistry(group_name).get_channels_names)(),
+            [self.channel_name]
+        )
+        self.assertEqual(
+            ats(self.consumer.session_state.get)()["group_name"],
+            group_name
+        )
+        self.assertIsNotNone(self.consumer.heartbeat_task)
+        p_send.assert_called_with(dumps({
             "command": "check_integrity",
             "integrity_hash": 0,
         }))
@@ -225,9 +379,14 @@ class TestDialogConsumer(CustomTestCase):
         self.assertEqual(len(messages), 1)
         self.assertCountEqual(self.redis_cache.smembers("uds_2"), {"", "1"})
         message = messages.first()
-        hash_ = hash_time(message.time)
-        self.assertCountEqual(self.redis_cache.get("di_1-2"), str(hash_))
-        self.assertCountEqual(self.redis_cache.get("di_2-1"), str(hash_))
+        buckets = {
+            "": "0",
+            hash_bucket(message.time): str(
+                hash_message(message.id, message.time)
+            )
+        }
+        self.assertEqual(self.redis_cache.hgetall("dib_1-2"), buckets)
+        self.assertEqual(self.redis_cache.hgetall("dib_2-1"), buckets)
         dialog_hash = hash_dialog(2, message.time)
         dialog_hash2 = hash_dialog(self.user.id, message.time)
         self.assertCountEqual(
@@ -238,57 +397,113 @@ class TestDialogConsumer(CustomTestCase):
             self.redis_cache.hgetall("dsi_2"),
             {"": 0, "1": str(dialog_hash2)}
         )
-        dialog_event = {
-            "type": "send_data",
-            "data": {
-                "command": "get_new_message",
-                "integrity_hash": ats(consumer.i_manager.get_hash)(),
-                "message": message.as_dict(self.user.id)
-            }
+        dialog_data = {
+            "command": "get_new_message",
+            "integrity_hash": ats(consumer.i_manager.get_hash)(),
+            "message": message.as_dict(self.user.id)
         }
-        dialog_event2 = {
-            "type": "send_data",
-            "data": {
-                "command": "get_new_message",
-                "integrity_hash": ats(consumer.i_manager2.get_hash)(),
-                "message": message.as_dict(2)
+        dialog_data2 = {
+            "command": "get_new_message",
+            "integrity_hash": ats(DialogIntegrityManager(2, 1).get_hash)(),
+            "message": message.as_dict(2)
+        }
+        dialogs_data = {
+            "command": "get_new_message",
+            "dialog": {
+                "id": 2,
+                "text": message.text,
+                "is_unread": False,
+                "hash": dialog_hash
+            },
+            "integrity_hash": ats(consumer.dsi_manager.get_hash)(),
+        }
+        dialogs_data2 = deepcopy(dialogs_data)
+        dialogs_data2["dialog"]["id"] = self.user.id
+        dialogs_data2["dialog"]["is_unread"] = True
+        dialogs_data2["dialog"]["hash"] = dialog_hash2
+        dialogs_data2["integrity_hash"] = ats(
+            DialogsIntegrityManager(2).get_hash
+        )()
+
+        self.assertEqual(
+            [call_.args[0] for call_ in p_group_send.call_args_list],
+            [
+                consumer.group_name, consumer.group_name2,
+                consumer.dialogs_group_name, consumer.dialogs_group_name2
+            ]
+        )
+        for call_, data in zip(p_group_send.call_args_list, [
+            dialog_data, dialog_data2, dialogs_data, dialogs_data2
+        ]):
+            event = call_.args[1]
+            self.assertEqual(event["type"], "send_payload")
+            self.assertEqual(json.loads(event["text"]), data)
+            self.assertEqual(event["data"], data)
+
+    @patch("messages.consumers.logger.log")
+    def test_receive___get_new_message___timings(self, p_logger_log):
+        self.additional_setUp()
+        data = {
+            "command": "get_new_message",
+            "message": {
+                "text": "text1"
             }
         }
-        dialogs_event = {
-            "type": "send_data",
-            "data": {
-                "command": "get_new_message",
-                "dialog": {
-                    "id": 2,
-                    "text": message.text,
-                    "is_unread": False,
-                    "hash": dialog_hash
-                },
-                "integrity_hash": ats(consumer.dsi_manager.get_hash)(),
+
+        ats(self.consumer.receive)(json.dumps(data))
+        level, info = p_logger_log.call_args.args
+        self.assertEqual(level, LOG_DEBUG_LEVEL)
+        self.assertRegex(
+            info,
+            r"new message save [\d.]+ms, consider [\d.]+ms, "
+            r"serialize [\d.]+ms, broadcast [\d.]+ms$"
+        )
+
+    @patch("messages.writebehind.ensure_flush_task")
+    @patch("dev.py.tests.messages.test_consumers.channel_layer.group_send")
+    def test_receive___get_new_message___write_behind(
+        self,
+        p_group_send,
+        p_ensure_flush_task
+    ):
+        self.additional_setUp()
+        data = {
+            "command": "get_new_message",
+            "message": {
+                "text": "text1"
             }
         }
-        dialogs_event2 = deepcopy(dialogs_event)
-        dialogs_event2["data"]["dialog"]["id"] = self.user.id
-        dialogs_event2["data"]["dialog"]["is_unread"] = True
-        dialogs_event2["data"]["dialog"]["hash"] = dialog_hash2
-        dialogs_event2["data"]["integrity_hash"] = ats(
-            consumer.dsi_manager2.get_hash
-        )()
-        p_group_send.assert_has_calls([
-            call(consumer.group_name, dialog_event),
-            call(consumer.group_name2, dialog_event2),
-            call(consumer.dialogs_group_name, dialogs_event),
-            call(consumer.dialogs_group_name2, dialogs_event2)
-        ])
 
+        with self.settings(FS_WRITE_BEHIND=True):
+            ats(self.consumer.receive)(json.dumps(data))
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(ats(MessagesQueue().get_size)(), 1)
+        self.assertEqual(p_group_send.call_count, 4)
+        p_ensure_flush_task.assert_called_once()
+
+        ats(MessagesQueue().flush)()
+        message = Message.objects.get()
+        self.assertEqual(message.text, "text1")
+        self.assertEqual(
+            self.redis_cache.hgetall("dib_1-2"),
+            {
+                "": "0",
+                hash_bucket(message.time): str(
+                    hash_message(message.id, message.time)
+                )
+            }
+        )
+
+    @patch("messages.consumers.timezone")
     @patch("dev.py.tests.messages.test_consumers.channel_layer.group_send")
     @patch("messages.consumers.DialogsIntegrityManager.mark_as_read")
     @patch("messages.consumers.UnreadDialogsManager.mark_as_read")
     def test_receive___mark_dialog_as_read(
         self, p_uds_mark_as_read,
-        p_dim_mark_as_read, p_group_send
+        p_dim_mark_as_read, p_group_send, p_timezone
     ):
         self.additional_setUp()
+        p_timezone.now.return_value = timezone.now()
         Message.objects.create(
             sender_id=2, receiver_id=self.user.id, text="text1"
         )
@@ -307,23 +522,44 @@ class TestDialogConsumer(CustomTestCase):
                 "integrity_hash": ats(self.consumer.dsi_manager.get_hash)()
             }
         }
-        p_group_send.assert_called_with(
-            self.consumer.dialogs_group_name, event
-        )
+        p_group_send.assert_has_calls([
+            call(self.consumer.dialogs_group_name, event),
+            call(self.consumer.group_name, {
+                "type": "read_dialog",
+                "read_at": p_timezone.now.return_value.timestamp()
+            })
+        ])
+
+    @patch("messages.consumers.DialogConsumer.send")
+    def test_read_dialog(self, p_send):
+        self.additional_setUp()
+        self.consumer.session_state = SessionState(self.channel_name)
+        ats(self.consumer.session_state.create)(1, self.consumer.group_name)
+
+        ats(self.consumer.read_dialog)({"type": "read_dialog", "read_at": 10})
+        p_send.assert_called_once_with(dumps({
+            "command": "mark_dialog_as_read"
+        }))
+
+        ats(self.consumer.read_dialog)({"type": "read_dialog", "read_at": 5})
+        p_send.assert_called_once()
 
     @patch("messages.consumers.DialogConsumer.send")
     def test_receive___give_messages(self, p_send):
         self.additional_setUp()
-        Message.objects.create(
-            sender_id=2, receiver_id=self.user.id, text="text1"
-        )
-        Message.objects.create(
-            sender_id=1, receiver_id=2, text="text2"
-        )
+        for _ in range(3):
+            Message.objects.create(
+                sender_id=2, receiver_id=self.user.id, text="text1"
+            )
+            Message.objects.create(
+                sender_id=1, receiver_id=2, text="text2"
+            )
 
         data = {"command": "give_messages"}
 
-        ats(self.consumer.receive)(json.dumps(data))
+        with self.settings(FS_MESSAGES_CHUNK_SIZE=4):
+            ats(self.consumer.receive)(json.dumps(data))
+        integrity_hash = ats(self.consumer.i_manager.get_hash)()
         messages, _ = ats(self.consumer.i_manager.get_messages)()
 
         messages_as_dict = []
@@ -331,10 +567,199 @@ class TestDialogConsumer(CustomTestCase):
             messages_as_dict.append(
                 message.as_dict(1)
             )
-        p_send.assert_called_with(json.dumps({
+        self.assertEqual(p_send.call_args_list, [
+            call(dumps({
+                "command": "get_messages",
+                "chunk": 0,
+                "messages": messages_as_dict[:4],
+            })),
+            call(dumps({
+                "command": "get_messages",
+                "chunk": 1,
+                "messages": messages_as_dict[4:],
+            })),
+            call(dumps({
+                "command": "get_messages_done",
+                "chunks": 2
+            }))
+        ])
+        self.assertEqual(
+            integrity_hash,
+            ats(self.consumer.i_manager.get_hash)()
+        )
+
+    @patch("messages.consumers.DialogConsumer.send")
+    def test_receive___give_messages___empty(self, p_send):
+        self.additional_setUp()
+
+        ats(self.consumer.receive)(json.dumps({"command": "give_messages"}))
+        self.assertEqual(p_send.call_args_list, [
+            call(dumps({
+                "command": "get_messages",
+                "chunk": 0,
+                "messages": [],
+            })),
+            call(dumps({
+                "command": "get_messages_done",
+                "chunks": 1
+            }))
+        ])
+
+    @patch("messages.consumers.DialogConsumer.send")
+    def test_receive___give_messages___binary(self, p_send):
+        self.additional_setUp()
+        self.consumer.protocol = BINARY_PROTOCOL
+        Message.objects.create(
+            sender_id=2, receiver_id=self.user.id, text="text1"
+        )
+
+        ats(self.consumer.receive)(
+            bytes_data=pack({"command": "give_messages"})
+        )
+        messages, _ = ats(self.consumer.i_manager.get_messages)()
+
+        p_send.assert_any_call(bytes_data=pack({
             "command": "get_messages",
-            "messages": messages_as_dict,
+            "chunk": 0,
+            "messages": [message.as_dict(1) for message in messages],
+        }))
+
+    @patch("messages.consumers.DialogConsumer.send")
+    def test_receive___give_messages_page(self, p_send):
+        self.additional_setUp()
+        message1 = Message.objects.create(
+            sender_id=2, receiver_id=self.user.id, text="text1"
+        )
+        message2 = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text2"
+        )
+
+        with self.settings(FS_DIALOG_MESSAGES_PAGE_SIZE=1):
+            ats(self.consumer.receive)(json.dumps({
+                "command": "give_messages_page"
+            }))
+        p_send.assert_called_with(dumps({
+            "command": "get_messages_page",
+            "messages": [message2.as_dict(1)],
+            "before": None,
+            "after": None,
+            "next_cursor": encode_cursor(message2)
+        }))
+
+        ats(self.consumer.receive)(json.dumps({
+            "command": "give_messages_page",
+            "before": encode_cursor(message2)
+        }))
+        p_send.assert_called_with(dumps({
+            "command": "get_messages_page",
+            "messages": [message1.as_dict(1)],
+            "before": encode_cursor(message2),
+            "after": None,
+            "next_cursor": None
+        }))
+
+    @patch("messages.consumers.DialogConsumer.send")
+    @patch("messages.consumers.DialogConsumer.log")
+    def test_receive___give_messages_page___invalid(self, p_log, p_send):
+        self.additional_setUp()
+        ats(self.consumer.receive)(json.dumps({
+            "command": "give_messages_page",
+            "after": "cursor"
         }))
+        p_log.assert_called_with(LOG_WARNING_LEVEL, "invalid cursor")
+        p_send.assert_not_called()
+
+    @patch("messages.consumers.DialogConsumer.send")
+    def test_receive___sync_messages(self, p_send):
+        self.additional_setUp()
+        message1 = Message.objects.create(
+            sender_id=2, receiver_id=self.user.id, text="text1"
+        )
+        message2 = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text2"
+        )
+
+        ats(self.consumer.receive)(json.dumps({
+            "command": "sync_messages",
+            "last_message_id": message1.id
+        }))
+        p_send.assert_called_with(dumps({
+            "command": "get_missing_messages",
+            "messages": [message2.as_dict(1)],
+            "is_complete": True,
+            "integrity_hash": ats(self.consumer.i_manager.get_hash)()
+        }))
+
+    @patch("messages.consumers.DialogConsumer.send")
+    @patch("messages.consumers.DialogConsumer.log")
+    def test_receive___sync_messages___invalid(self, p_log, p_send):
+        self.additional_setUp()
+        for data in [
+            {"command": "sync_messages"},
+            {"command": "sync_messages", "last_message_id": None},
+            {"command": "sync_messages", "last_message_id": "id"}
+        ]:
+            ats(self.consumer.receive)(json.dumps(data))
+            p_log.assert_called_with(
+                LOG_WARNING_LEVEL,
+                "invalid last message id"
+            )
+        p_send.assert_not_called()
+
+    @patch("messages.consumers.DialogConsumer.send")
+    def test_receive___give_integrity_buckets(self, p_send):
+        self.additional_setUp()
+        message = Message.objects.create(
+            sender_id=2, receiver_id=self.user.id, text="text1"
+        )
+
+        ats(self.consumer.receive)(json.dumps({
+            "command": "give_integrity_buckets"
+        }))
+        hash_ = hash_message(message.id, message.time)
+        p_send.assert_called_with(dumps({
+            "command": "get_integrity_buckets",
+            "buckets": {hash_bucket(message.time): hash_},
+            "integrity_hash": hash_
+        }))
+
+    @patch("messages.consumers.DialogConsumer.send")
+    def test_receive___give_buckets_messages(self, p_send):
+        self.additional_setUp()
+        message1 = Message.objects.create(
+            sender_id=2, receiver_id=self.user.id, text="text1"
+        )
+        message2 = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text2"
+        )
+        Message.objects.filter(id=message1.id).update(
+            time=message1.time - timezone.timedelta(days=1)
+        )
+        buckets = [hash_bucket(message2.time)]
+
+        ats(self.consumer.receive)(json.dumps({
+            "command": "give_buckets_messages",
+            "buckets": buckets
+        }))
+        p_send.assert_called_with(dumps({
+            "command": "get_buckets_messages",
+            "buckets": buckets,
+            "messages": [message2.as_dict(1)],
+            "integrity_hash": ats(self.consumer.i_manager.get_hash)()
+        }))
+
+    @patch("messages.consumers.DialogConsumer.send")
+    @patch("messages.consumers.DialogConsumer.log")
+    def test_receive___give_buckets_messages___invalid(self, p_log, p_send):
+        self.additional_setUp()
+        for data in [
+            {"command": "give_buckets_messages"},
+            {"command": "give_buckets_messages", "buckets": None},
+            {"command": "give_buckets_messages", "buckets": ["bucket"]}
+        ]:
+            ats(self.consumer.receive)(json.dumps(data))
+            p_log.assert_called_with(LOG_WARNING_LEVEL, "invalid buckets")
+        p_send.assert_not_called()
 
     @patch("messages.consumers.DialogConsumer.log")
     def test_receive___invalid(self, p_log):
@@ -393,23 +818,37 @@ class TestDialogsConsumer(CustomTestCase):
             group_name,
             "fake-channel-name"
         )
+        ats(add_session)(group_name, "fake-channel-name")
         p_check_current_user.return_value = False
 
         ats(self.consumer.connect)()
         self.assertEqual(self.consumer.group_name, group_name)
-        self.assertNotIn(self.consumer.group_name, channel_layer.groups)
+        self.assertIn(
+            "fake-channel-name",
+            channel_layer.groups[self.consumer.group_name]
+        )
         p_accept.assert_called()
         p_check_current_user.assert_called()
         p_send.assert_not_called()
 
         p_check_current_user.return_value = True
-        ats(self.consumer.connect)()
+        with self.settings(FS_MAX_SESSIONS_PER_USER=1):
+            ats(self.consumer.connect)()
         p_check_current_user.assert_called()
         self.assertEqual(
             list(channel_layer.groups[group_name].keys()),
             [self.channel_name]
         )
-        p_send.assert_called_with(json.dumps({
+        self.assertEqual(
+            ats(ConnectionRegistry(group_name).get_channels_names)(),
+            [self.channel_name]
+        )
+        self.assertEqual(
+            ats(self.consumer.session_state.get)()["group_name"],
+            group_name
+        )
+        self.assertIsNotNone(self.consumer.heartbeat_task)
+        p_send.assert_called_with(dumps({
             "command": "check_integrity",
             "integrity_hash": 0,
         }))
@@ -422,7 +861,7 @@ class TestDialogsConsumer(CustomTestCase):
         p_dim_mark_as_deleted, p_group_send
     ):
         self.additional_setUp()
-        Message.objects.create(
+        Message.objects.create_message(
             sender_id=2, receiver_id=self.user.id, text="text1"
         )
         di_manager = DialogIntegrityManager(
@@ -450,25 +889,112 @@ class TestDialogsConsumer(CustomTestCase):
             self.consumer.group_name, event
         )
 
+    @patch("dev.py.tests.messages.test_consumers.channel_layer.group_send")
+    def test_receive___delete_dialog___string_id(self, p_group_send):
+        self.additional_setUp()
+        Message.objects.create_message(
+            sender_id=2, receiver_id=self.user.id, text="text1"
+        )
+
+        ats(self.consumer.receive)(json.dumps({
+            "command": "delete_dialog",
+            "dialog_id": "2"
+        }))
+        self.assertFalse(Message.objects.dialog_has_visible_messages(
+            self.user.id,
+            2
+        ))
+        self.assertEqual(
+            p_group_send.call_args.args[1]["data"]["dialog_id"],
+            2
+        )
+
+    @patch("messages.consumers.logger.log")
+    @patch("dev.py.tests.messages.test_consumers.channel_layer.group_send")
+    def test_receive___delete_dialog___invalid_id(
+        self, p_group_send, p_logger_log
+    ):
+        self.additional_setUp()
+
+        for dialog_id in ["a", None]:
+            ats(self.consumer.receive)(json.dumps({
+                "command": "delete_dialog",
+                "dialog_id": dialog_id
+            }))
+            self.assertEqual(
+                p_logger_log.call_args.args[0],
+                LOG_WARNING_LEVEL
+            )
+        p_group_send.assert_not_called()
+
+    @patch("messages.consumers.timezone")
     @patch("messages.consumers.DialogsConsumer.send")
     @patch("messages.consumers.UnreadDialogsManager.reset")
     def test_receive___give_dialogs(
-        self, p_uds_reset, p_send
+        self, p_uds_reset, p_send, p_timezone
     ):
         self.additional_setUp()
-        Message.objects.create(
+        Message.objects.create_message(
             sender_id=2, receiver_id=1, text="text1"
         )
         data = {"command": "give_dialogs"}
+        p_timezone.now.return_value = timezone.now()
 
         ats(self.consumer.receive)(json.dumps(data))
         dialogs, _, uds_set = ats(self.consumer.i_manager.get_dialogs)()
         p_uds_reset.assert_called_with(uds_set)
-        p_send.assert_called_with(json.dumps({
+        p_send.assert_called_with(dumps({
             "command": "get_dialogs",
-            "dialogs": dialogs
+            "dialogs": dialogs,
+            "sync_token": encode_time(p_timezone.now.return_value)
         }))
 
+    @patch("messages.consumers.DialogsConsumer.send")
+    def test_receive___sync_dialogs(self, p_send):
+        self.additional_setUp()
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        since = timezone.now()
+        Message.objects.create_message(
+            sender_id=3, receiver_id=1, text="text2"
+        )
+        Message.objects.mark_dialog_messages_as_deleted(1, 4)
+        Message.objects.create_message(
+            sender_id=4, receiver_id=1, text="text3"
+        )
+        Message.objects.mark_dialog_messages_as_deleted(1, 4)
+
+        with patch("messages.consumers.timezone") as p_timezone:
+            p_timezone.now.return_value = timezone.now()
+            ats(self.consumer.receive)(json.dumps({
+                "command": "sync_dialogs",
+                "since": encode_time(since)
+            }))
+
+        dialogs, _, _ = Dialog.objects.get_dialogs(1)
+        p_send.assert_called_with(dumps({
+            "command": "get_changed_dialogs",
+            "dialogs": [dialogs[0]],
+            "deleted_dialogs_ids": [4],
+            "sync_token": encode_time(p_timezone.now.return_value),
+            "integrity_hash": ats(self.consumer.i_manager.get_hash)()
+        }))
+
+    @patch("messages.consumers.DialogsConsumer.send")
+    @patch("messages.consumers.DialogsConsumer.log")
+    def test_receive___sync_dialogs___invalid(self, p_log, p_send):
+        self.additional_setUp()
+        ats(self.consumer.receive)(json.dumps({"command": "sync_dialogs"}))
+        p_log.assert_called_with(LOG_WARNING_LEVEL, "invalid sync token")
+
+        ats(self.consumer.receive)(json.dumps({
+            "command": "sync_dialogs",
+            "since": "token"
+        }))
+        p_log.assert_called_with(LOG_WARNING_LEVEL, "invalid sync token")
+        p_send.assert_not_called()
+
     @patch("messages.consumers.DialogsConsumer.log")
     def test_receive___invalid(self, p_log):
         data = {}
@@ -480,6 +1006,18 @@ class TestDialogsConsumer(CustomTestCase):
         p_log.assert_called_with(LOG_WARNING_LEVEL, "invalid command")
 
 
+class TestStageTimer(CustomTestCase):
+    @patch("messages.consumers.time.perf_counter")
+    def test(self, p_perf_counter):
+        p_perf_counter.side_effect = [1, 1.002, 1.0025]
+        timer = StageTimer()
+        timer.finish("save")
+        timer.finish("consider")
+
+        self.assertEqual(list(timer.timings), ["save", "consider"])
+        self.assertEqual(str(timer), "save 2.0ms, consider 0.5ms")
+
+
 class TestUtils(CustomTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -491,27 +1029,38 @@ class TestUtils(CustomTestCase):
     def test_get_dialogs_group_name(self):
         self.assertEqual(get_dialogs_group_name(1), "ds1")
 
-    @patch("messages.consumers.channel_layer.group_send")
-    def test_clear_group(self, p_group_send):
+    @patch("messages.consumers.channel_layer.send")
+    def test_add_session(self, p_send):
         group_name = "my-group"
+        registry = ConnectionRegistry(group_name)
         ats(channel_layer.group_add)(
             group_name,
             "fake-channel-name"
         )
-        ats(clear_group)(group_name)
+        ats(add_session)(group_name, "fake-channel-name")
+        ats(add_session)(group_name, "channel-name")
 
-        p_group_send.assert_called_with(
-            group_name,
-            {
-                "type": "send_data",
-                "data": {
-                    "command": "go_home",
-                }
-            }
+        p_send.assert_not_called()
+        self.assertCountEqual(
+            ats(registry.get_channels_names)(),
+            ["fake-channel-name", "channel-name"]
+        )
+
+        with self.settings(FS_MAX_SESSIONS_PER_USER=1):
+            ats(add_session)(group_name, "channel-name")
 
+        p_send.assert_called_once_with(
+            "fake-channel-name",
+            {"type": "evict"}
         )
         self.assertNotIn(group_name, channel_layer.groups)
+        self.assertEqual(
+            ats(registry.get_channels_names)(),
+            ["channel-name"]
+        )
+        redis_cache.flushdb()
 
     def test_constants(self):
         self.assertEqual(LOG_WARNING_LEVEL, 30)
         self.assertEqual(LOG_INFO_LEVEL, 20)
+        self.assertEqual(LOG_DEBUG_LEVEL, 10)
@@ -1,15 +1,37 @@
+from unittest.mock import patch
+
+import pytz
 import redis
 from asgiref.sync import async_to_sync as ats
 from django.conf import settings
 from django.utils import timezone
 
 from dev.py.utils import CustomTestCase
+from messages import cache
+from messages.cache import LocalCache
+from messages.managers import backfill_conversation_ids
+from messages.managers import combine_hashes
+from messages.managers import decode_bucket
+from messages.managers import decode_cursor
+from messages.managers import decode_time
+from messages.managers import DeletedUsersManager
 from messages.managers import DialogIntegrityManager
 from messages.managers import DialogsIntegrityManager
+from messages.managers import DialogsManager
+from messages.managers import encode_cursor
+from messages.managers import encode_time
+from messages.managers import get_conversation_id
+from messages.managers import get_conversation_id_expression
+from messages.managers import hash_bucket
+from messages.managers import hash_buckets
 from messages.managers import hash_dialog
-from messages.managers import hash_time
+from messages.managers import hash_message
+from messages.managers import HASH_MODULUS
 from messages.managers import MessagesManager
+from messages.managers import NewMessageManager
+from messages.managers import summary_as_dict
 from messages.managers import UnreadDialogsManager
+from messages.models import Dialog
 from messages.models import Message
 
 
@@ -97,6 +119,116 @@ class TestMessagesManager(CustomTestCase):
             [self.messages[7]]
         )
 
+    def test_get_dialog_buckets(self):
+        self.assertEqual(
+            self.manager.get_dialog_buckets(1, 2, 2),
+            hash_buckets(self.manager.get_dialog_messages(1, 2))
+        )
+        self.assertEqual(self.manager.get_dialog_buckets(4, 1, 2), {})
+
+    def test_dialog_has_visible_messages(self):
+        self.assertTrue(self.manager.dialog_has_visible_messages(1, 2))
+        self.assertTrue(self.manager.dialog_has_visible_messages(1, 4))
+        self.assertFalse(self.manager.dialog_has_visible_messages(4, 1))
+        self.assertFalse(self.manager.dialog_has_visible_messages(5, 6))
+
+        with self.assertNumQueries(1):
+            self.manager.dialog_has_visible_messages(1, 2)
+
+    def test_iter_dialog_messages(self):
+        self.assertEqual(
+            list(self.manager.iter_dialog_messages(1, 2, 2)),
+            [[self.messages[2], self.messages[3]], [self.messages[4]]]
+        )
+        self.assertEqual(
+            list(self.manager.iter_dialog_messages(1, 3, 1)),
+            [[self.messages[6]]]
+        )
+        self.assertEqual(
+            list(self.manager.iter_dialog_messages(5, 6, 2)),
+            [[]]
+        )
+
+    def test_get_dialog_messages_page(self):
+        messages, next_cursor = self.manager.get_dialog_messages_page(
+            1, 2, limit=2
+        )
+        self.assertSequenceEqual(
+            messages,
+            [self.messages[3], self.messages[4]]
+        )
+        self.assertEqual(next_cursor, encode_cursor(self.messages[3]))
+
+        messages, next_cursor = self.manager.get_dialog_messages_page(
+            1, 2, before=next_cursor, limit=2
+        )
+        self.assertSequenceEqual(messages, [self.messages[2]])
+        self.assertIsNone(next_cursor)
+
+        messages, next_cursor = self.manager.get_dialog_messages_page(
+            1, 2, after=encode_cursor(self.messages[2]), limit=1
+        )
+        self.assertSequenceEqual(messages, [self.messages[3]])
+        self.assertEqual(next_cursor, encode_cursor(self.messages[3]))
+
+        messages, next_cursor = self.manager.get_dialog_messages_page(
+            1, 2, after=next_cursor, limit=1
+        )
+        self.assertSequenceEqual(messages, [self.messages[4]])
+        self.assertIsNone(next_cursor)
+
+        with self.settings(FS_DIALOG_MESSAGES_PAGE_SIZE=1):
+            messages, _ = self.manager.get_dialog_messages_page(1, 2)
+            self.assertSequenceEqual(messages, [self.messages[4]])
+
+        cursor = encode_cursor(self.messages[3])
+        with self.assertRaises(ValueError):
+            self.manager.get_dialog_messages_page(
+                1, 2, before=cursor, after=cursor
+            )
+        with self.assertRaises(ValueError):
+            self.manager.get_dialog_messages_page(1, 2, before="cursor")
+
+    def test_get_missing_dialog_messages(self):
+        messages, is_complete = self.manager.get_missing_dialog_messages(
+            1, 2, self.messages[2].id
+        )
+        self.assertSequenceEqual(messages, [self.messages[3], self.messages[4]])
+        self.assertTrue(is_complete)
+
+        messages, is_complete = self.manager.get_missing_dialog_messages(
+            1, 2, 0, limit=2
+        )
+        self.assertSequenceEqual(messages, [self.messages[2], self.messages[3]])
+        self.assertFalse(is_complete)
+
+    def test_get_dialog_buckets_messages(self):
+        # time is auto_now, so save() would overwrite it
+        self.manager.filter(id=self.messages[3].id).update(
+            time=timezone.now() - timezone.timedelta(days=2)
+        )
+        self.messages[3].refresh_from_db()
+        bucket = hash_bucket(self.messages[3].time)
+
+        self.assertSequenceEqual(
+            self.manager.get_dialog_buckets_messages(1, 2, [bucket]),
+            [self.messages[3]]
+        )
+        self.assertSequenceEqual(
+            self.manager.get_dialog_buckets_messages(
+                1, 2,
+                [bucket, hash_bucket(self.messages[4].time)]
+            ),
+            [self.messages[3], self.messages[2], self.messages[4]]
+        )
+        self.assertSequenceEqual(
+            self.manager.get_dialog_buckets_messages(1, 2, []),
+            []
+        )
+
+        with self.assertRaises(ValueError):
+            self.manager.get_dialog_buckets_messages(1, 2, ["bucket"])
+
     def test_get_dialogs(self):
         dialogs, hashes, uds_set = self.manager.get_dialogs(1)
 
@@ -130,6 +262,29 @@ class TestMessagesManager(CustomTestCase):
         )
         self.assertCountEqual(uds_set, {2, 3})
 
+    def test_get_dialogs___limit(self):
+        with self.assertNumQueries(1):
+            dialogs, hashes, uds_set = self.manager.get_dialogs(1, limit=2)
+
+        self.assertSequenceEqual(
+            [dialog["id"] for dialog in dialogs],
+            [4, 3]
+        )
+        self.assertCountEqual(hashes, {3, 4})
+        self.assertCountEqual(uds_set, {3})
+
+    def test_get_last_dialogs_messages___plan(self):
+        plan = self.manager.get_last_dialogs_messages(1).explain()
+
+        self.assertIn(
+            "USING INDEX custom_messages_message_sender_id",
+            plan
+        )
+        self.assertIn(
+            "USING INDEX custom_messages_message_receiver_id",
+            plan
+        )
+
     def test_mark_dialog_messages_as_read(self):
         self.manager.mark_dialog_messages_as_read(
             1, 2
@@ -149,6 +304,95 @@ class TestMessagesManager(CustomTestCase):
             is_unread=True, is_deleted_by_receiver=False
         ).exists())
 
+    def test_get_unread_counts(self):
+        self.assertEqual(self.manager.get_unread_counts(1), {2: 1, 3: 1})
+        self.assertEqual(self.manager.get_unread_counts(2), {1: 1})
+
+    def test_create_message(self):
+        message = self.manager.create_message(
+            sender_id=1, receiver_id=5, text="text"
+        )
+
+        self.assertEqual(self.manager.get(id=message.id), message)
+        self.assertTrue(Dialog.objects.filter(
+            owner_id=1, interlocutor_id=5, unread_count=0,
+            last_text="text", last_message_time=message.time
+        ).exists())
+        self.assertTrue(Dialog.objects.filter(
+            owner_id=5, interlocutor_id=1, unread_count=1,
+            last_text="text", last_message_time=message.time
+        ).exists())
+
+    def test_save_messages___taken_id(self):
+        message = Message(
+            id=self.messages[0].id, time=timezone.now(), sender_id=1,
+            receiver_id=5, conversation_id=get_conversation_id(1, 5),
+            text="text"
+        )
+
+        with self.assertLogs("messages.managers", "WARNING"):
+            self.assertEqual(self.manager.save_messages([message]), [message])
+        self.assertNotEqual(message.id, self.messages[0].id)
+        self.assertEqual(self.manager.get(id=message.id).text, "text")
+        self.assertEqual(
+            self.manager.get(id=self.messages[0].id).text,
+            "message0"
+        )
+        self.assertTrue(Dialog.objects.filter(
+            owner_id=5, interlocutor_id=1, last_text="text"
+        ).exists())
+
+    def test_save_messages(self):
+        time = timezone.now()
+        messages = [
+            Message(
+                id=100, time=time, sender_id=1, receiver_id=5,
+                conversation_id=get_conversation_id(1, 5), text="text1"
+            ),
+            Message(
+                id=101, time=time, sender_id=1, receiver_id=5,
+                conversation_id=get_conversation_id(1, 5), text="text2"
+            )
+        ]
+
+        self.assertEqual(
+            self.manager.save_messages(messages[:1]),
+            messages[:1]
+        )
+        self.assertEqual(self.manager.save_messages(messages), messages[1:])
+        self.assertSequenceEqual(
+            self.manager.filter(id__gte=100).order_by("id"),
+            messages
+        )
+        self.assertTrue(Dialog.objects.filter(
+            owner_id=5, interlocutor_id=1, unread_count=2,
+            last_text="text2"
+        ).exists())
+
+    def test_mark_dialog_messages_as_read___dialog(self):
+        self.manager.create_message(
+            sender_id=2, receiver_id=1, text="text"
+        )
+        self.manager.mark_dialog_messages_as_read(1, 2)
+
+        self.assertEqual(
+            Dialog.objects.get(owner_id=1, interlocutor_id=2).unread_count,
+            0
+        )
+
+    def test_mark_dialog_messages_as_deleted___dialog(self):
+        self.manager.create_message(
+            sender_id=2, receiver_id=1, text="text"
+        )
+        self.manager.mark_dialog_messages_as_deleted(1, 2)
+
+        self.assertTrue(
+            Dialog.objects.get(owner_id=1, interlocutor_id=2).is_deleted
+        )
+        self.assertFalse(
+            Dialog.objects.get(owner_id=2, interlocutor_id=1).is_deleted
+        )
+
     def test_mark_dialog_messages_as_deleted(self):
         self.manager.mark_dialog_messages_as_deleted(
             1, 2
@@ -165,10 +409,165 @@ class TestMessagesManager(CustomTestCase):
         ).exists())
 
 
+class TestDialogsManager(CustomTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.manager = DialogsManager()
+        cls.manager.model = Dialog
+
+    def setUp(self):
+        self.messages = []
+        for sender_id, receiver_id in [(1, 2), (2, 1), (3, 1), (1, 4)]:
+            self.messages.append(Message.objects.create_message(
+                sender_id=sender_id, receiver_id=receiver_id,
+                text="message{}".format(len(self.messages))
+            ))
+
+    def test_consider_messages(self):
+        time = timezone.now()
+        self.manager.consider_messages([
+            Message(
+                id=100, time=time, sender_id=5, receiver_id=1, text="text1"
+            ),
+            Message(
+                id=102, time=time, sender_id=1, receiver_id=5, text="text3"
+            ),
+            Message(
+                id=101, time=time, sender_id=5, receiver_id=1, text="text2"
+            ),
+            Message(
+                id=103, time=time, sender_id=1, receiver_id=2, text="text4"
+            )
+        ])
+
+        self.assertCountEqual(
+            self.manager.filter(
+                owner_id__in=[1, 2, 5],
+                interlocutor_id__in=[1, 2, 5]
+            ).values_list(
+                "owner_id", "interlocutor_id", "last_text", "unread_count"
+            ),
+            [
+                (1, 5, "text3", 2), (5, 1, "text3", 1),
+                (1, 2, "text4", 1), (2, 1, "text4", 2)
+            ]
+        )
+        self.manager.consider_messages([])
+
+    def test_get_dialogs(self):
+        self.assertEqual(
+            self.manager.get_dialogs(1),
+            Message.objects.get_dialogs(1)
+        )
+        self.assertEqual(
+            self.manager.get_dialogs(1, limit=2),
+            Message.objects.get_dialogs(1, limit=2)
+        )
+
+        self.manager.mark_as_deleted(1, 4)
+        dialogs, _, _ = self.manager.get_dialogs(1)
+        self.assertSequenceEqual(
+            [dialog["id"] for dialog in dialogs],
+            [3, 2]
+        )
+
+    def test_get_changed_dialogs(self):
+        since = timezone.now()
+        self.manager.mark_as_read(1, 2)
+        self.manager.mark_as_deleted(1, 4)
+        self.manager.mark_as_read(2, 1)
+
+        dialogs, deleted_dialogs_ids = self.manager.get_changed_dialogs(
+            1, since
+        )
+        self.assertSequenceEqual(
+            dialogs,
+            [summary_as_dict(
+                self.manager.filter(owner_id=1, interlocutor_id=2).values(
+                    "interlocutor_id", "last_message_time",
+                    "last_text", "unread_count"
+                ).get()
+            )]
+        )
+        self.assertSequenceEqual(deleted_dialogs_ids, [4])
+
+    def test_get_unread_dialogs_set(self):
+        self.assertEqual(self.manager.get_unread_dialogs_set(1), {2, 3})
+        self.assertEqual(self.manager.get_unread_dialogs_set(4), {1})
+
+    def test_consider_message(self):
+        self.manager.mark_as_deleted(1, 2)
+        message = Message.objects.create(
+            sender_id=2, receiver_id=1, text="text"
+        )
+        self.manager.consider_message(message)
+
+        dialog = self.manager.get(owner_id=1, interlocutor_id=2)
+        self.assertFalse(dialog.is_deleted)
+        self.assertEqual(dialog.unread_count, 1)
+        self.assertEqual(dialog.last_text, "text")
+        self.assertEqual(dialog.last_message_time, message.time)
+
+        dialog = self.manager.get(owner_id=2, interlocutor_id=1)
+        self.assertEqual(dialog.unread_count, 1)
+        self.assertEqual(dialog.last_text, "text")
+
+    def test_consider_message___older(self):
+        unread_count = self.manager.get(
+            owner_id=1, interlocutor_id=2
+        ).unread_count
+        message = Message.objects.create(
+            sender_id=2, receiver_id=1, text="newer"
+        )
+        self.manager.consider_message(message)
+        # A transaction of an older message has committed later
+        older_message = Message.objects.create(
+            sender_id=2, receiver_id=1, text="older",
+            time=message.time - timezone.timedelta(seconds=1)
+        )
+        self.manager.consider_message(older_message)
+
+        dialog = self.manager.get(owner_id=1, interlocutor_id=2)
+        self.assertEqual(dialog.last_text, "newer")
+        self.assertEqual(dialog.last_message_time, message.time)
+        self.assertEqual(dialog.unread_count, unread_count + 2)
+
+    def test_mark_as_read(self):
+        self.manager.mark_as_read(1, 2)
+        self.assertEqual(self.manager.get_unread_dialogs_set(1), {3})
+
+    def test_mark_as_deleted(self):
+        self.manager.mark_as_deleted(1, 3)
+
+        dialog = self.manager.get(owner_id=1, interlocutor_id=3)
+        self.assertTrue(dialog.is_deleted)
+        self.assertEqual(dialog.unread_count, 0)
+
+    def test_rebuild(self):
+        summaries = list(self.manager.filter(owner_id=1).values())
+        self.manager.filter(owner_id=1).update(unread_count=10)
+        Message.objects.filter(sender_id=1, receiver_id=4).update(
+            is_deleted_by_sender=True
+        )
+
+        self.assertEqual(self.manager.rebuild(1), 2)
+        self.assertCountEqual(
+            [
+                (summary["interlocutor_id"], summary["unread_count"])
+                for summary in self.manager.filter(owner_id=1).values()
+            ],
+            [
+                (summary["interlocutor_id"], summary["unread_count"])
+                for summary in summaries
+                if summary["interlocutor_id"] != 4
+            ]
+        )
+
+
 class TestDialogIntegrityManager(CustomTestCase):
     @classmethod
     def setUpTestData(cls):
-        cls.key = "di_1-2"
+        cls.key = "dib_1-2"
 
     def setUp(self):
         self.manager = DialogIntegrityManager(1, 2)
@@ -181,23 +580,61 @@ class TestDialogIntegrityManager(CustomTestCase):
         self.redis_cache.flushdb()
 
     def set_cache_value(self, value):
-        self.redis_cache.set(self.key, value)
+        self.redis_cache.delete(self.key)
+        self.redis_cache.hset(self.key, mapping=value)
 
     def get_cache_value(self):
-        value = self.redis_cache.get(self.key)
-        if value is not None:
-            value = int(value)
+        value = self.redis_cache.hgetall(self.key)
+        for bucket, hash_ in value.items():
+            value[bucket] = int(hash_)
 
         return value
 
     def test_get_hash(self):
         self.assertEqual(ats(self.manager.get_hash)(), 0)
-        self.assertEqual(self.get_cache_value(), 0)
+        self.assertEqual(self.get_cache_value(), {"": 0})
         self.redis_cache.flushdb()
 
-        self.set_cache_value(3)
-        self.assertEqual(ats(self.manager.get_hash)(), 3)
-        self.assertEqual(self.get_cache_value(), 3)
+        self.set_cache_value({"": 0, "20210701": 3, "20210702": 4})
+        self.assertEqual(ats(self.manager.get_hash)(), 7)
+
+        self.set_cache_value({"": 0, "20210701": HASH_MODULUS - 1, "0": 2})
+        self.assertEqual(ats(self.manager.get_hash)(), 1)
+
+    def test_get_buckets(self):
+        message = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        buckets = {
+            hash_bucket(message.time): hash_message(message.id, message.time)
+        }
+        self.assertEqual(ats(self.manager.get_buckets)(), buckets)
+        self.assertEqual(ats(self.manager.get_buckets)(), buckets)
+
+    def test_rebuild_buckets(self):
+        message1 = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        message2 = Message.objects.create(
+            sender_id=2, receiver_id=1, text="text2"
+        )
+        Message.objects.filter(id=message2.id).update(
+            time=message1.time - timezone.timedelta(days=1)
+        )
+        message2.refresh_from_db()
+        buckets = {
+            hash_bucket(message1.time): hash_message(
+                message1.id,
+                message1.time
+            ),
+            hash_bucket(message2.time): hash_message(
+                message2.id,
+                message2.time
+            )
+        }
+
+        self.assertEqual(ats(self.manager.rebuild_buckets)(), buckets)
+        self.assertEqual(self.get_cache_value(), {"": 0, **buckets})
 
     def test_get_messages(self):
         message1 = Message.objects.create(
@@ -206,6 +643,10 @@ class TestDialogIntegrityManager(CustomTestCase):
         message2 = Message.objects.create(
             sender_id=1, receiver_id=2, text="text2"
         )
+        Message.objects.filter(id=message2.id).update(
+            time=message1.time - timezone.timedelta(days=1)
+        )
+        message2.refresh_from_db()
         received_messages, received_hash = ats(self.manager.get_messages)()
 
         self.assertSequenceEqual(
@@ -213,23 +654,99 @@ class TestDialogIntegrityManager(CustomTestCase):
             Message.objects.get_dialog_messages(1, 2)
         )
 
-        hash_ = hash_time(message1.time) + hash_time(message2.time)
-        self.assertEqual(hash_, received_hash)
-        self.assertEqual(hash_, self.get_cache_value())
+        hash1 = hash_message(message1.id, message1.time)
+        hash2 = hash_message(message2.id, message2.time)
+        self.assertEqual(received_hash, combine_hashes([hash1, hash2]))
+        self.assertEqual(self.get_cache_value(), {
+            "": 0,
+            hash_bucket(message1.time): hash1,
+            hash_bucket(message2.time): hash2
+        })
 
-    def test_add_to_cache(self):
-        hash_ = 10
-        self.set_cache_value(hash_)
-        time = timezone.now()
-        ats(self.manager.add_to_hash)(time)
+    def test_stream_messages(self):
+        message1 = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        message2 = Message.objects.create(
+            sender_id=2, receiver_id=1, text="text2"
+        )
+        Message.objects.filter(id=message1.id).update(
+            time=message2.time - timezone.timedelta(days=1)
+        )
+        message1.refresh_from_db()
+
+        async def stream():
+            return [
+                chunk async for chunk in self.manager.stream_messages(1)
+            ]
+
+        self.assertEqual(ats(stream)(), [[message1], [message2]])
+        self.assertEqual(self.get_cache_value(), {
+            "": 0,
+            hash_bucket(message1.time): hash_message(
+                message1.id,
+                message1.time
+            ),
+            hash_bucket(message2.time): hash_message(
+                message2.id,
+                message2.time
+            )
+        })
+
+    def test_add_to_hash(self):
+        message = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        bucket = hash_bucket(message.time)
+        hash_ = hash_message(message.id, message.time)
 
-        self.assertEqual(ats(self.manager.get_hash)(), hash_ + hash_time(time))
+        ats(self.manager.add_to_hash)(message)
+        self.assertEqual(self.get_cache_value(), {})
+
+        self.set_cache_value({"": 0, bucket: HASH_MODULUS - 1})
+        ats(self.manager.add_to_hash)(message)
+        self.assertEqual(self.get_cache_value(), {"": 0, bucket: hash_ - 1})
+
+    def test_drop(self):
+        message = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        self.set_cache_value({"": 0, "20210701": 200})
+        ats(self.manager.drop)()
+
+        self.assertFalse(self.redis_cache.exists(self.key))
+        self.assertEqual(
+            ats(self.manager.get_hash)(),
+            hash_message(message.id, message.time)
+        )
 
     def test_delete(self):
-        self.set_cache_value(200)
+        self.set_cache_value({"": 0, "20210701": 200})
         ats(self.manager.delete)()
 
-        self.assertEqual(self.get_cache_value(), 0)
+        self.assertEqual(self.get_cache_value(), {"": 0})
+        self.assertEqual(ats(self.manager.get_hash)(), 0)
+
+    def test_local_cache(self):
+        message = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        bucket = hash_bucket(message.time)
+        self.set_cache_value({"": 0, bucket: 3})
+
+        with self.settings(FS_LOCAL_CACHE=True), patch.object(
+            cache, "_local_cache", LocalCache(10, 60)
+        ):
+            self.assertEqual(ats(self.manager.get_hash)(), 3)
+            self.set_cache_value({"": 0, bucket: 4})
+            self.assertEqual(ats(self.manager.get_hash)(), 3)
+
+            # Changes of the manager are seen at once
+            ats(self.manager.add_to_hash)(message)
+            self.assertEqual(
+                ats(self.manager.get_hash)(),
+                4 + hash_message(message.id, message.time)
+            )
 
 
 class TestDialogsIntegrityManager(CustomTestCase):
@@ -260,11 +777,11 @@ class TestDialogsIntegrityManager(CustomTestCase):
         return value
 
     def test_get_hash(self):
-        Message.objects.create(
+        Message.objects.create_message(
             sender_id=2, receiver_id=1, text="text1"
         )
         _, ds_hashes, _ = Message.objects.get_dialogs(1)
-        hash_ = ds_hashes[2] + 1
+        hash_ = combine_hashes([ds_hashes[2], 1])
         self.assertEqual(ats(self.manager.get_hash)(), hash_)
 
         self.redis_cache.flushdb()
@@ -276,10 +793,10 @@ class TestDialogsIntegrityManager(CustomTestCase):
         self.assertEqual(ats(self.manager.get_hash)(), 301)
 
     def test_get_dialogs(self):
-        message1 = Message.objects.create(
+        Message.objects.create_message(
             sender_id=1, receiver_id=2, text="text1"
         )
-        Message.objects.create(
+        Message.objects.create_message(
             sender_id=3, receiver_id=1, text="text2"
         )
         ds, ds_hashes, uds_set = ats(self.manager.get_dialogs)()
@@ -292,7 +809,7 @@ class TestDialogsIntegrityManager(CustomTestCase):
         self.assertCountEqual(self.get_cache_value(), ds_hashes)
 
         ###
-        message1.delete()
+        Message.objects.mark_dialog_messages_as_deleted(1, 2)
         ds, ds_hashes, uds_set = ats(self.manager.get_dialogs)()
         ds_db, ds_hashes_db, uds_set_db = Message.objects.get_dialogs(1)
         ds_hashes_db[""] = 0
@@ -316,7 +833,7 @@ class TestDialogsIntegrityManager(CustomTestCase):
         )
 
     def test_mark_as_read(self):
-        Message.objects.create(
+        Message.objects.create_message(
             sender_id=2, receiver_id=1, text="text1"
         )
         ats(self.manager.mark_as_read)(2)
@@ -329,7 +846,7 @@ class TestDialogsIntegrityManager(CustomTestCase):
         )
 
     def test_mark_as_deleted(self):
-        Message.objects.create(
+        Message.objects.create_message(
             sender_id=2, receiver_id=1, text="text1"
         )
         ats(self.manager.mark_as_deleted)(2)
@@ -373,11 +890,42 @@ class TestUnreadDialogsManager(CustomTestCase):
         self.assertEqual(ats(self.manager.get_number)(), 2)
 
         self.redis_cache.flushdb()
-        Message.objects.create(
+        Message.objects.create_message(
             sender_id=2, receiver_id=1, text="text1"
         )
         self.assertEqual(ats(self.manager.get_number)(), 1)
 
+    def test_exist(self):
+        self.redis_cache.sadd(self.key, *{"", 3})
+        self.assertTrue(self.manager.exist())
+
+        self.redis_cache.flushdb()
+        self.redis_cache.sadd(self.key, "")
+        self.assertFalse(self.manager.exist())
+
+        self.redis_cache.flushdb()
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        with self.assertNumQueries(1):
+            self.assertTrue(self.manager.exist())
+        self.assertCountEqual(self.get_cache_value(), {"", 2})
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.manager.exist())
+
+    def test_has_dialog(self):
+        self.redis_cache.sadd(self.key, *{"", 3})
+        self.assertTrue(ats(self.manager.has_dialog)(3))
+        self.assertFalse(ats(self.manager.has_dialog)(4))
+
+        self.redis_cache.flushdb()
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        self.assertTrue(ats(self.manager.has_dialog)(2))
+        self.assertCountEqual(self.get_cache_value(), {"", 2})
+
     def test_reset(self):
         self.redis_cache.sadd(self.key, *{"", 2})
         ats(self.manager.reset)({3, 4})
@@ -403,14 +951,227 @@ class TestUnreadDialogsManager(CustomTestCase):
         self.assertCountEqual(self.get_cache_value(), {"", 3})
 
 
+class TestDeletedUsersManager(CustomTestCase):
+    def setUp(self):
+        self.manager = DeletedUsersManager(3)
+
+    def tearDown(self):
+        DeletedUsersManager.clear()
+
+    def test(self):
+        self.assertFalse(self.manager.exists())
+
+        self.manager.add()
+        self.assertTrue(self.manager.exists())
+        self.assertFalse(DeletedUsersManager(4).exists())
+
+    def test___expired(self):
+        with self.settings(FS_DELETED_USERS_TIMEOUT=-1):
+            DeletedUsersManager(4).add()
+        self.assertFalse(DeletedUsersManager(4).exists())
+
+        self.manager.add()
+        with self.settings(FS_DELETED_USERS_TIMEOUT=-1):
+            DeletedUsersManager(5).add()
+        self.assertEqual(
+            list(DeletedUsersManager.expiration_times),
+            [3, 5]
+        )
+        self.manager.add()
+        self.assertEqual(list(DeletedUsersManager.expiration_times), [3])
+
+
+class TestNewMessageManager(CustomTestCase):
+    def setUp(self):
+        self.manager = NewMessageManager(1, 2)
+        self.redis_cache = redis.Redis(
+            decode_responses=True,
+            db=settings.FS_REDIS_DB
+        )
+
+    def tearDown(self):
+        self.redis_cache.flushdb()
+
+    def get_hashes(self):
+        return [
+            ats(DialogIntegrityManager(1, 2).get_hash)(),
+            ats(DialogIntegrityManager(2, 1).get_hash)(),
+            ats(DialogsIntegrityManager(1).get_hash)(),
+            ats(DialogsIntegrityManager(2).get_hash)()
+        ]
+
+    def test_prepare(self):
+        ats(self.manager.prepare)()
+
+        for key in ["dib_1-2", "dib_2-1", "dsi_1", "dsi_2"]:
+            self.assertEqual(self.redis_cache.hgetall(key), {"": "0"})
+
+    def test_consider___cold_cache(self):
+        message = Message.objects.create_message(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        hashes = ats(self.manager.consider)(message)
+
+        self.assertEqual(hashes, self.get_hashes())
+        self.assertEqual(hashes[0], hash_message(message.id, message.time))
+
+    def test_consider___warm_cache(self):
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        self.get_hashes()
+        ats(UnreadDialogsManager(2).get_number)()
+
+        message = Message.objects.create_message(
+            sender_id=1, receiver_id=2, text="text2"
+        )
+        with patch(
+            "messages.managers.DialogIntegrityManager.get_hash"
+        ) as p_di_get_hash, patch(
+            "messages.managers.DialogsIntegrityManager.get_hash"
+        ) as p_dsi_get_hash:
+            hashes = ats(self.manager.consider)(message)
+            p_di_get_hash.assert_not_called()
+            p_dsi_get_hash.assert_not_called()
+
+        self.assertCountEqual(self.redis_cache.smembers("uds_2"), {"", "1"})
+        self.assertEqual(
+            self.redis_cache.hget("dsi_2", "1"),
+            str(hash_dialog(1, message.time))
+        )
+        self.assertEqual(hashes, self.get_hashes())
+        self.redis_cache.flushdb()
+        self.assertEqual(hashes, self.get_hashes())
+
+
 class TestUtilFunctions(CustomTestCase):
-    def test_hash_dialog(self):
+    def test_summary_as_dict(self):
         time = timezone.now()
-        self.assertEqual(hash_dialog(2, time), 2 + hash_time(time))
+        summary = {
+            "interlocutor_id": 2, "last_message_time": time,
+            "last_text": "text", "unread_count": 3
+        }
+        self.assertEqual(summary_as_dict(summary), {
+            "id": 2, "text": "text", "is_unread": True,
+            "hash": hash_dialog(2, time)
+        })
+
+        summary["unread_count"] = 0
+        self.assertFalse(summary_as_dict(summary)["is_unread"])
+
+    def test_time(self):
+        time = timezone.now()
+        self.assertEqual(decode_time(encode_time(time)), time)
+
+        with self.assertRaises(ValueError):
+            decode_time("time")
+
+    def test_cursor(self):
+        message = Message(id=12, time=timezone.now())
+        cursor = encode_cursor(message)
+        self.assertEqual(decode_cursor(cursor), (message.time, 12))
+
+        for cursor in ["", "12", "time_12", "20210701052700000000_id"]:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_get_conversation_id(self):
+        self.assertEqual(get_conversation_id(1, 2), 2**32 + 2)
+        self.assertEqual(get_conversation_id(2, 1), 2**32 + 2)
+        self.assertNotEqual(
+            get_conversation_id(1, 3),
+            get_conversation_id(2, 3)
+        )
 
-    def test_hash_dialog(self):
+        max_id = 2**31 - 1
+        self.assertLess(get_conversation_id(max_id, max_id - 1), 2**63)
+
+    def test_get_conversation_id_expression(self):
+        Message.objects.create(sender_id=1, receiver_id=2, text="text1")
+        Message.objects.create(sender_id=3, receiver_id=1, text="text2")
+
+        for message in Message.objects.annotate(
+            expected_conversation_id=get_conversation_id_expression()
+        ):
+            self.assertEqual(
+                message.expected_conversation_id,
+                message.conversation_id
+            )
+
+    def test_backfill_conversation_ids(self):
+        messages = [
+            Message.objects.create(sender_id=1, receiver_id=2, text="text1"),
+            Message.objects.create(sender_id=3, receiver_id=1, text="text2"),
+            Message.objects.create(sender_id=2, receiver_id=1, text="text3")
+        ]
+        Message.objects.update(conversation_id=None)
+
+        self.assertEqual(
+            backfill_conversation_ids(Message.objects, 2),
+            (2, messages[1].id)
+        )
+        self.assertEqual(
+            backfill_conversation_ids(Message.objects, 2, messages[1].id),
+            (1, messages[2].id)
+        )
+        self.assertEqual(
+            backfill_conversation_ids(Message.objects, 2, messages[2].id),
+            (0, messages[2].id)
+        )
+        for message in messages:
+            message.refresh_from_db()
+            self.assertEqual(
+                message.conversation_id,
+                get_conversation_id(message.sender_id, message.receiver_id)
+            )
+
+    def test_hashes(self):
         time = timezone.now()
+        hash_ = hash_message(1, time)
+        self.assertEqual(hash_message(1, time), hash_)
+        self.assertLess(hash_, HASH_MODULUS)
+        self.assertNotEqual(hash_message(2, time), hash_)
+        self.assertNotEqual(
+            hash_message(1, time + timezone.timedelta(days=1)),
+            hash_
+        )
+        self.assertNotEqual(hash_dialog(1, time), hash_)
+        self.assertLess(hash_dialog(1, time), HASH_MODULUS)
+
+    def test_combine_hashes(self):
+        self.assertEqual(combine_hashes([]), 0)
+        self.assertEqual(combine_hashes(["1", 2]), 3)
+        self.assertEqual(combine_hashes([HASH_MODULUS - 1, 3]), 2)
+
+    def test_bucket(self):
+        time = timezone.make_aware(
+            timezone.datetime(2021, 7, 1, 23, 30),
+            timezone=pytz.utc
+        )
+        self.assertEqual(hash_bucket(time), "20210701")
+        self.assertEqual(
+            hash_bucket(time.astimezone(pytz.timezone("Europe/Moscow"))),
+            "20210701"
+        )
         self.assertEqual(
-            hash_time(time),
-            time.hour*3600 + time.minute*60 + time.second
+            decode_bucket("20210701"),
+            time.replace(hour=0, minute=0)
         )
+
+        with self.assertRaises(ValueError):
+            decode_bucket("bucket")
+
+    def test_hash_buckets(self):
+        time = timezone.now()
+        messages = [
+            Message(id=1, time=time),
+            Message(id=2, time=time),
+            Message(id=3, time=time - timezone.timedelta(days=1))
+        ]
+        self.assertEqual(hash_buckets(messages), {
+            hash_bucket(time): combine_hashes([
+                hash_message(1, time),
+                hash_message(2, time)
+            ]),
+            hash_bucket(messages[2].time): hash_message(3, messages[2].time)
+        })
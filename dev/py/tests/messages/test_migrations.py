@@ -0,0 +1,68 @@
+import importlib
+from unittest.mock import Mock
+
+from django.apps import apps
+from django.db import connection
+
+from dev.py.utils import CustomTestCase
+from messages.models import Dialog
+from messages.models import Message
+
+
+class TestBackfillDialogs(CustomTestCase):
+    def setUp(self):
+        self.migration = importlib.import_module(
+            "messages.migrations.0008_backfill_dialogs"
+        )
+        self.schema_editor = Mock(connection=connection)
+
+    def get_summaries(self):
+        return list(Dialog.objects.order_by(
+            "owner_id", "interlocutor_id"
+        ).values_list(
+            "owner_id", "interlocutor_id",
+            "last_message_time", "last_text", "unread_count"
+        ))
+
+    def test(self):
+        for sender_id, receiver_id, text, is_deleted_by_receiver in [
+            (1, 2, "text1", False),
+            (2, 1, "text2", False),
+            (2, 1, "text3", True),
+            (3, 1, "text4", False),
+            (1, 4, "text5", False)
+        ]:
+            Message.objects.create(
+                sender_id=sender_id, receiver_id=receiver_id, text=text,
+                is_deleted_by_receiver=is_deleted_by_receiver
+            )
+        for user_id in [1, 2, 3, 4]:
+            Dialog.objects.rebuild(user_id)
+        expected_summaries = self.get_summaries()
+        Dialog.objects.all().delete()
+
+        self.migration.BATCH_SIZE = 1
+        try:
+            self.migration.backfill(apps, self.schema_editor)
+        finally:
+            self.migration.BATCH_SIZE = 1000
+
+        self.assertEqual(self.get_summaries(), expected_summaries)
+        self.assertEqual(len(expected_summaries), 6)
+
+    def test___existing_summaries(self):
+        message = Message.objects.create_message(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        Dialog.objects.filter(owner_id=1).update(last_text="text2")
+
+        self.migration.backfill(apps, self.schema_editor)
+        self.assertEqual(
+            Dialog.objects.get(owner_id=1).last_text,
+            "text2"
+        )
+        self.assertEqual(Dialog.objects.count(), 2)
+        self.assertEqual(
+            Dialog.objects.get(owner_id=2).last_message_time,
+            message.time
+        )
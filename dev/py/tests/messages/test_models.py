@@ -1,8 +1,11 @@
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 
 from dev.py.utils import CustomTestCase
-from messages.managers import hash_time
+from messages.managers import hash_bucket
+from messages.managers import hash_message
+from messages.models import Dialog
 from messages.models import Message
 
 
@@ -13,21 +16,23 @@ class TestMessages(CustomTestCase):
         self.time = timezone.now()
         self.text = "text"
         self.message = Message(
-            time=self.time,
+            id=5, time=self.time,
             sender_id=self.user1_id, receiver_id=self.user2_id,
             text=self.text, is_unread=False
         )
 
     def test__fields(self):
-        self.assertEqual(len(Message().__dict__), 9)
+        self.assertEqual(len(Message().__dict__), 10)
 
         self.assertEqual(Message.id.field.editable, False)
-        self.assertEqual(Message.time.field.auto_now, True)
+        self.assertEqual(Message.time.field.default, timezone.now)
         self.assertEqual(Message.time.field.editable, False)
         self.assertEqual(Message.sender_id.field.editable, False)
         self.assertEqual(Message.sender_id.field.db_index, True)
         self.assertEqual(Message.receiver_id.field.editable, False)
         self.assertEqual(Message.receiver_id.field.db_index, True)
+        self.assertEqual(Message.conversation_id.field.editable, False)
+        self.assertEqual(Message.conversation_id.field.null, True)
         self.assertEqual(
             Message.text.field.max_length,
             settings.FS_MAX_MESSAGE_LENGTH
@@ -37,13 +42,21 @@ class TestMessages(CustomTestCase):
         self.assertEqual(Message.is_deleted_by_sender.field.default, False)
         self.assertEqual(Message.is_deleted_by_receiver.field.default, False)
 
+    def test_save(self):
+        message = Message.objects.create(
+            sender_id=3, receiver_id=2, text="text"
+        )
+        self.assertEqual(message.conversation_id, 2*2**32 + 3)
+
     def test_as_dict(self):
         message_as_dict = {
+            "id": 5,
             "time": self.time.strftime("%Y.%m.%d %H:%M:%S"),
             "user_owns_message": True,
             "is_unread": False,
             "text": self.text,
-            "hash": hash_time(self.time)
+            "hash": hash_message(5, self.time),
+            "bucket": hash_bucket(self.time)
         }
         self.assertEqual(
             self.message.as_dict(self.user1_id),
@@ -65,3 +78,79 @@ class TestMessages(CustomTestCase):
 
     def test__str__(self):
         self.assertEqual(self.message.__str__(), self.text)
+
+
+class TestDialog(CustomTestCase):
+    def test__fields(self):
+        self.assertEqual(Dialog.id.field.editable, False)
+        self.assertEqual(Dialog.owner_id.field.editable, False)
+        self.assertEqual(Dialog.interlocutor_id.field.editable, False)
+        self.assertEqual(Dialog.last_message_time.field.editable, False)
+        self.assertEqual(
+            Dialog.last_text.field.max_length,
+            settings.FS_MAX_MESSAGE_LENGTH
+        )
+        self.assertEqual(Dialog.unread_count.field.default, 0)
+        self.assertEqual(Dialog.is_deleted.field.default, False)
+        self.assertEqual(Dialog.updated_at.field.auto_now, True)
+
+    def test_unique_owner_interlocutor(self):
+        self.assertEqual(
+            Dialog._meta.constraints[0].fields,
+            ("owner_id", "interlocutor_id")
+        )
+
+    def test__str__(self):
+        self.assertEqual(
+            Dialog(owner_id=1, interlocutor_id=2).__str__(),
+            "1-2"
+        )
+
+
+class TestMessageIndexes(CustomTestCase):
+    def assertUsesIndex(self, queryset, *indexes_names):
+        if connection.vendor == "postgresql":
+            # Tables of tests are too small to prefer indexes
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+
+        plan = queryset.explain()
+        self.assertTrue(
+            any(index_name in plan for index_name in indexes_names),
+            plan
+        )
+
+    def test_dialog_messages(self):
+        self.assertUsesIndex(
+            Message.objects.filter_dialog_messages(1, 2).order_by("time"),
+            "message_conversation_time_idx"
+        )
+
+    def test_conversation(self):
+        self.assertUsesIndex(
+            Message.objects.filter(
+                conversation_id=2**32 + 2
+            ).order_by("time"),
+            "message_conversation_time_idx"
+        )
+
+    def test_unread_dialogs_set(self):
+        self.assertUsesIndex(
+            Message.objects.filter(
+                receiver_id=1,
+                is_unread=True,
+                is_deleted_by_receiver=False
+            ).values_list("sender_id", flat=True).distinct(),
+            "message_unread_idx"
+        )
+
+    def test_dialog_unread_messages(self):
+        self.assertUsesIndex(
+            Message.objects.filter(
+                sender_id=2,
+                receiver_id=1,
+                is_unread=True,
+                is_deleted_by_receiver=False
+            ),
+            "message_unread_idx"
+        )
@@ -0,0 +1,132 @@
+import time
+from unittest.mock import patch
+
+import redis
+from asgiref.sync import async_to_sync as ats
+from django.conf import settings
+
+from dev.py.utils import CustomTestCase
+from messages.registry import ConnectionRegistry
+from messages.registry import SessionState
+
+
+class TestConnectionRegistry(CustomTestCase):
+    def setUp(self):
+        self.registry = ConnectionRegistry("group")
+        self.redis_cache = redis.Redis(
+            decode_responses=True,
+            db=settings.FS_REDIS_DB
+        )
+
+    def tearDown(self):
+        self.redis_cache.flushdb()
+
+    def test_init(self):
+        self.assertEqual(self.registry.group_name, "group")
+        self.assertEqual(self.registry.key, "cr_group")
+        self.assertEqual(self.registry.ttl, settings.FS_CONNECTION_TTL)
+
+    def test_add(self):
+        self.assertEqual(ats(self.registry.add)("channel1", 2), [])
+        self.assertEqual(ats(self.registry.add)("channel2", 2), [])
+        self.assertEqual(ats(self.registry.add)("channel3", 2), ["channel1"])
+        self.assertEqual(
+            ats(self.registry.add)("channel4", 1),
+            ["channel2", "channel3"]
+        )
+        self.assertEqual(
+            ats(self.registry.get_channels_names)(),
+            ["channel4"]
+        )
+        self.assertLessEqual(
+            self.redis_cache.ttl(self.registry.key),
+            settings.FS_CONNECTION_TTL
+        )
+
+        self.redis_cache.zadd(self.registry.key, {"channel5": time.time() - 1})
+        self.assertEqual(ats(self.registry.add)("channel6", 2), [])
+
+    def test_get_channels_names(self):
+        self.assertEqual(ats(self.registry.get_channels_names)(), [])
+
+        ats(self.registry.add)("channel1", 1)
+        self.redis_cache.zadd(self.registry.key, {"channel2": time.time() - 1})
+        self.assertEqual(
+            ats(self.registry.get_channels_names)(),
+            ["channel1"]
+        )
+
+    def test_refresh(self):
+        self.assertFalse(ats(self.registry.refresh)("channel1"))
+        self.assertEqual(ats(self.registry.get_channels_names)(), [])
+
+        ats(self.registry.add)("channel1", 1)
+        score = self.redis_cache.zscore(self.registry.key, "channel1")
+        later = time.time() + 1
+        with patch("messages.registry.time.time") as p_time:
+            p_time.return_value = later
+            self.assertTrue(ats(self.registry.refresh)("channel1"))
+        self.assertGreater(
+            self.redis_cache.zscore(self.registry.key, "channel1"),
+            score
+        )
+
+    def test_discard(self):
+        ats(self.registry.add)("channel1", 1)
+        ats(self.registry.discard)("channel1")
+        self.assertEqual(ats(self.registry.get_channels_names)(), [])
+
+
+class TestSessionState(CustomTestCase):
+    def setUp(self):
+        self.session_state = SessionState("channel")
+        self.redis_cache = redis.Redis(
+            decode_responses=True,
+            db=settings.FS_REDIS_DB
+        )
+
+    def tearDown(self):
+        self.redis_cache.flushdb()
+
+    def test_init(self):
+        self.assertEqual(self.session_state.channel_name, "channel")
+        self.assertEqual(self.session_state.key, "ss_channel")
+        self.assertEqual(self.session_state.ttl, settings.FS_CONNECTION_TTL)
+
+    def test_create(self):
+        ats(self.session_state.create)(1, "group")
+
+        state = ats(self.session_state.get)()
+        self.assertEqual(state["user_id"], "1")
+        self.assertEqual(state["group_name"], "group")
+        self.assertEqual(state["read_at"], "0")
+        self.assertAlmostEqual(
+            float(state["connected_at"]),
+            time.time(),
+            delta=60
+        )
+        self.assertLessEqual(
+            self.redis_cache.ttl(self.session_state.key),
+            settings.FS_CONNECTION_TTL
+        )
+
+    def test_refresh(self):
+        ats(self.session_state.create)(1, "group")
+        self.redis_cache.expire(self.session_state.key, 1)
+
+        ats(self.session_state.refresh)()
+        self.assertGreater(self.redis_cache.ttl(self.session_state.key), 1)
+
+    def test_set_read_at(self):
+        ats(self.session_state.create)(1, "group")
+
+        self.assertTrue(ats(self.session_state.set_read_at)(10.5))
+        self.assertFalse(ats(self.session_state.set_read_at)(10.5))
+        self.assertFalse(ats(self.session_state.set_read_at)(5))
+        self.assertEqual(ats(self.session_state.get)()["read_at"], "10.5")
+
+    def test_delete(self):
+        ats(self.session_state.create)(1, "group")
+        ats(self.session_state.delete)()
+
+        self.assertEqual(ats(self.session_state.get)(), {})
@@ -0,0 +1,130 @@
+import json
+from unittest.mock import patch
+
+import msgpack
+
+from dev.py.utils import CustomTestCase
+from messages.managers import hash_dialog
+from messages.models import Message
+from messages.serializers import BINARY_PROTOCOL
+from messages.serializers import COLUMNAR_FIELDS
+from messages.serializers import dumps
+from messages.serializers import JSON_PROTOCOL
+from messages.serializers import make_payload_event
+from messages.serializers import NewMessageSerializer
+from messages.serializers import pack
+from messages.serializers import to_columns
+from messages.serializers import unpack
+
+
+class TestNewMessageSerializer(CustomTestCase):
+    def setUp(self):
+        self.message = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text1"
+        )
+        self.serializer = NewMessageSerializer(self.message)
+
+    def test_get_dialog_event(self):
+        for user_id in [1, 2]:
+            event = self.serializer.get_dialog_event(user_id, 5)
+            data = {
+                "command": "get_new_message",
+                "integrity_hash": 5,
+                "message": self.message.as_dict(user_id)
+            }
+
+            self.assertEqual(event["type"], "send_payload")
+            self.assertEqual(json.loads(event["text"]), data)
+            self.assertEqual(event["data"], data)
+
+    def test_get_dialogs_event(self):
+        self.assertEqual(
+            self.serializer.get_dialogs_event(1, 5),
+            make_payload_event({
+                "command": "get_new_message",
+                "dialog": {
+                    "id": 2,
+                    "text": "text1",
+                    "is_unread": False,
+                    "hash": hash_dialog(2, self.message.time)
+                },
+                "integrity_hash": 5
+            })
+        )
+        self.assertEqual(
+            self.serializer.get_dialogs_event(2, 6),
+            make_payload_event({
+                "command": "get_new_message",
+                "dialog": {
+                    "id": 1,
+                    "text": "text1",
+                    "is_unread": True,
+                    "hash": hash_dialog(1, self.message.time)
+                },
+                "integrity_hash": 6
+            })
+        )
+
+
+class TestUtilFunctions(CustomTestCase):
+    def test_constants(self):
+        self.assertEqual(BINARY_PROTOCOL, "fs.msgpack")
+        self.assertEqual(JSON_PROTOCOL, "fs.json")
+        self.assertEqual(COLUMNAR_FIELDS, ["messages", "dialogs"])
+
+    def test_dumps(self):
+        data = {"command": "command", "list": [1, "2"], "hash": 2**47}
+
+        self.assertEqual(json.loads(dumps(data)), data)
+        with patch("messages.serializers.orjson", None):
+            self.assertEqual(dumps(data), json.dumps(data))
+
+    def test_pack(self):
+        messages = [
+            {"id": 1, "text": "text1", "is_unread": True},
+            {"id": 2, "text": "text2", "is_unread": False}
+        ]
+        data = {
+            "command": "get_messages",
+            "messages": messages,
+            "integrity_hash": 2**47
+        }
+        bytes_data = pack(data)
+
+        self.assertEqual(unpack(bytes_data), {
+            "command": "get_messages",
+            "messages": {
+                "id": [1, 2],
+                "text": ["text1", "text2"],
+                "is_unread": [True, False]
+            },
+            "integrity_hash": 2**47
+        })
+        self.assertEqual(data["messages"], messages)
+        self.assertLess(len(bytes_data), len(dumps(data)))
+        self.assertEqual(
+            unpack(pack({"command": "get_dialogs", "dialogs": []})),
+            {"command": "get_dialogs", "dialogs": {}}
+        )
+
+    def test_unpack(self):
+        self.assertEqual(
+            unpack(msgpack.packb({"command": "give_messages"})),
+            {"command": "give_messages"}
+        )
+
+    def test_to_columns(self):
+        self.assertEqual(to_columns([]), {})
+        self.assertEqual(
+            to_columns([{"a": 1, "b": 2}, {"a": 3, "b": 4}]),
+            {"a": [1, 3], "b": [2, 4]}
+        )
+
+    def test_make_payload_event(self):
+        data = {"command": "command", "dialogs": [{"id": 1}]}
+
+        self.assertEqual(make_payload_event(data), {
+            "type": "send_payload",
+            "text": dumps(data),
+            "data": data
+        })
@@ -40,6 +40,20 @@ class TestDialog(CustomTestCase):
             html_code
         )
 
+    def test_initial_messages(self):
+        data = {
+            "interlocutor": Mock(id=2, email="2@email.com"),
+            "form": MessagesForm(),
+            "initial_messages": {"messages": [], "hash_offset": 5}
+        }
+        html_code = self.render("messages/dialog.html", data)
+
+        self.assertIn(
+            '<script id="initial-messages" type="application/json">'
+            '{"messages": [], "hash_offset": 5}</script>',
+            html_code
+        )
+
 
 class TestDialogs(CustomTestCase):
     def test(self):
@@ -51,3 +65,16 @@ class TestDialogs(CustomTestCase):
             '<script type="module" src = "/static/messages/js/dialogs.js">',
             html_code
         )
+        self.assertNotIn('id="initial-dialogs"', html_code)
+
+    def test_initial_dialogs(self):
+        data = {
+            "initial_dialogs": {"dialogs": [], "sync_token": "token"}
+        }
+        html_code = self.render("messages/dialogs.html", data)
+
+        self.assertIn(
+            '<script id="initial-dialogs" type="application/json">'
+            '{"dialogs": [], "sync_token": "token"}</script>',
+            html_code
+        )
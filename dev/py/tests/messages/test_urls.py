@@ -3,9 +3,12 @@ from django.urls import reverse
 from django.urls.exceptions import NoReverseMatch
 
 from dev.py.utils import CustomTestCase
+from messages.views import dialog_messages_api_view
 from messages.views import dialog_view
+from messages.views import dialogs_api_view
 from messages.views import dialogs_view
 from messages.views import main_page_view
+from messages.views import metrics_view
 
 
 class TestUrls(CustomTestCase):
@@ -21,3 +24,25 @@ class TestUrls(CustomTestCase):
         self.assertRaises(NoReverseMatch, reverse, "dialog", args=[-123])
         self.assertRaises(NoReverseMatch, reverse, "dialog", args=[0])
         self.assertEqual(resolve("/dialogs/u123/").func, dialog_view)
+
+    def test_api_dialogs(self):
+        self.assertEqual(reverse("api_dialogs"), "/api/dialogs/")
+        self.assertEqual(resolve("/api/dialogs/").func, dialogs_api_view)
+
+    def test_api_dialog_messages(self):
+        self.assertEqual(
+            reverse("api_dialog_messages", args=[123]),
+            "/api/dialogs/u123/messages/"
+        )
+        self.assertRaises(
+            NoReverseMatch,
+            reverse, "api_dialog_messages", args=[0]
+        )
+        self.assertEqual(
+            resolve("/api/dialogs/u123/messages/").func,
+            dialog_messages_api_view
+        )
+
+    def test_metrics(self):
+        self.assertEqual(reverse("metrics"), "/metrics/")
+        self.assertEqual(resolve("/metrics/").func, metrics_view)
@@ -1,8 +1,23 @@
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync as ats
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 
 from dev.py.utils import CustomTestCase
+from messages.cache import get_local_cache_stats
+from messages.cache import get_pool_stats
+from messages.cache import get_sync_redis_cache
 from messages.forms import MessagesForm
+from messages.managers import combine_hashes
+from messages.managers import decode_time
+from messages.managers import DeletedUsersManager
+from messages.managers import DialogIntegrityManager
+from messages.managers import DialogsIntegrityManager
+from messages.managers import encode_cursor
+from messages.managers import hash_buckets
+from messages.managers import UnreadDialogsManager
+from messages.models import Dialog
 from messages.models import Message
 
 
@@ -12,6 +27,9 @@ class TestDialogsView(CustomTestCase):
         cls.create_user(cls)
         cls.URL = reverse("dialogs")
 
+    def tearDown(self):
+        get_sync_redis_cache().flushdb()
+
     def test_template(self):
         self.client.force_login(self.user)
         response = self.client.get(self.URL)
@@ -21,6 +39,34 @@ class TestDialogsView(CustomTestCase):
             "messages/dialogs.html"
         )
 
+    def test_initial_dialogs(self):
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        Message.objects.create_message(
+            sender_id=1, receiver_id=3, text="text2"
+        )
+        self.client.force_login(self.user)
+        response = self.client.get(self.URL)
+
+        initial_dialogs = response.context["initial_dialogs"]
+        self.assertEqual(
+            initial_dialogs["dialogs"],
+            Dialog.objects.get_dialogs(1)[0]
+        )
+        self.assertIsNotNone(decode_time(initial_dialogs["sync_token"]))
+        self.assertEqual(
+            combine_hashes([
+                *[dialog["hash"] for dialog in initial_dialogs["dialogs"]],
+                1
+            ]),
+            ats(DialogsIntegrityManager(1).get_hash)()
+        )
+        self.assertEqual(
+            get_sync_redis_cache().smembers("uds_1"),
+            {"", "2"}
+        )
+
     def test_nonauthorised(self):
         self.assertCustomRedirects(
             self.URL, "/login/?next=" + self.URL,
@@ -42,6 +88,10 @@ class TestDialogView(CustomTestCase):
         cls.url1 = reverse("dialog", args=[1])
         cls.url2 = reverse("dialog", args=[2])
 
+    def tearDown(self):
+        get_sync_redis_cache().flushdb()
+        DeletedUsersManager.clear()
+
     def test_nonauthorised(self):
         self.assertCustomRedirects(
             self.url1,
@@ -63,6 +113,70 @@ class TestDialogView(CustomTestCase):
         self.assertTemplateUsed(response, "messages/dialog.html")
         self.assertIsInstance(response.context["form"], MessagesForm)
         self.assertEqual(response.context["interlocutor"], self.user2)
+        self.assertEqual(
+            response.context["initial_messages"],
+            {"messages": [], "hash_offset": 0}
+        )
+
+    def test_existing_interlocutor___initial_messages(self):
+        for i in range(3):
+            Message.objects.create_message(
+                sender_id=1, receiver_id=2, text="text{}".format(i)
+            )
+        messages = Message.objects.get_dialog_messages(1, 2)
+        self.client.force_login(self.user1)
+        with self.settings(FS_DIALOG_MESSAGES_PAGE_SIZE=2):
+            response = self.client.get(self.url2)
+
+        initial_messages = response.context["initial_messages"]
+        self.assertEqual(
+            initial_messages["messages"],
+            [message.as_dict(1) for message in messages[1:]]
+        )
+        self.assertEqual(
+            initial_messages["hash_offset"],
+            messages[0].as_dict(1)["hash"]
+        )
+        self.assertEqual(
+            combine_hashes([
+                initial_messages["hash_offset"],
+                *[
+                    message["hash"]
+                    for message in initial_messages["messages"]
+                ]
+            ]),
+            ats(DialogIntegrityManager(1, 2).get_hash)()
+        )
+
+    def test_existing_interlocutor___message_is_saved_meanwhile(self):
+        get_dialog_messages_page = Message.objects.get_dialog_messages_page
+
+        def save_and_get_page(*args, **kwargs):
+            Message.objects.create_message(
+                sender_id=2, receiver_id=1, text="text1"
+            )
+
+            return get_dialog_messages_page(*args, **kwargs)
+
+        self.client.force_login(self.user1)
+        with patch.object(
+            Message.objects,
+            "get_dialog_messages_page",
+            save_and_get_page
+        ):
+            response = self.client.get(self.url2)
+
+        # The client gets a mismatch and restores the dialog
+        initial_messages = response.context["initial_messages"]
+        messages, _ = ats(DialogIntegrityManager(1, 2).get_messages)()
+        self.assertEqual(len(initial_messages["messages"]), 1)
+        self.assertNotEqual(
+            combine_hashes([
+                initial_messages["hash_offset"],
+                initial_messages["messages"][0]["hash"]
+            ]),
+            combine_hashes(hash_buckets(messages).values())
+        )
 
     def test_nonexisting_interlocutor___no_messages(self):
         self.client.force_login(self.user1)
@@ -83,6 +197,157 @@ class TestDialogView(CustomTestCase):
             "messages/dialog_with_deleted_interlocutor.html"
         )
 
+    def test_nonexisting_interlocutor___cached(self):
+        Message.objects.create(
+            sender_id=1, receiver_id=3, text="text1"
+        )
+        self.client.force_login(self.user1)
+        self.client.get(reverse("dialog", args=[3]))
+        self.assertTrue(DeletedUsersManager(3).exists())
+
+        # The session, the user and the messages' existence
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("dialog", args=[3]))
+        self.assertTemplateUsed(
+            response,
+            "messages/dialog_with_deleted_interlocutor.html"
+        )
+
+
+class TestDialogsApiView(CustomTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_user(cls)
+        cls.URL = reverse("api_dialogs")
+
+    def tearDown(self):
+        get_sync_redis_cache().flushdb()
+
+    def test_nonauthorised(self):
+        self.assertCustomRedirects(
+            self.URL, "/login/?next=" + self.URL,
+            302, 200
+        )
+
+    def test(self):
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        self.client.force_login(self.user)
+        response = self.client.get(self.URL)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {"dialogs": Dialog.objects.get_dialogs(1)[0]}
+        )
+        self.assertEqual(
+            response["ETag"],
+            '"{}"'.format(ats(DialogsIntegrityManager(1).get_hash)())
+        )
+        self.assertIn("Cookie", response["Vary"])
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    def test_not_modified(self):
+        self.client.force_login(self.user)
+        etag = self.client.get(self.URL)["ETag"]
+
+        # The session and the user
+        with self.assertNumQueries(2):
+            response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        ats(DialogsIntegrityManager(1).consider_new)(
+            2, Dialog.objects.get_dialogs(1)[0][0]["hash"]
+        )
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_post(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.post(self.URL).status_code, 405)
+
+
+class TestDialogMessagesApiView(CustomTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_user(cls)
+        cls.URL = reverse("api_dialog_messages", args=[2])
+
+    def tearDown(self):
+        get_sync_redis_cache().flushdb()
+
+    def test_nonauthorised(self):
+        self.assertCustomRedirects(
+            self.URL, "/login/?next=" + self.URL,
+            302, 200
+        )
+
+    def test(self):
+        for i in range(3):
+            Message.objects.create_message(
+                sender_id=2, receiver_id=1, text="text{}".format(i)
+            )
+        messages = Message.objects.get_dialog_messages(1, 2)
+        self.client.force_login(self.user)
+        with self.settings(FS_DIALOG_MESSAGES_PAGE_SIZE=2):
+            response = self.client.get(self.URL)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "messages": [
+                    message.as_dict(1) for message in messages[1:]
+                ],
+                "next_cursor": encode_cursor(messages[1])
+            }
+        )
+        self.assertEqual(
+            response["ETag"],
+            '"{}-1"'.format(ats(DialogIntegrityManager(1, 2).get_hash)())
+        )
+
+        with self.settings(FS_DIALOG_MESSAGES_PAGE_SIZE=2):
+            response = self.client.get(
+                self.URL,
+                {"before": encode_cursor(messages[1])}
+            )
+        self.assertEqual(
+            response.json(),
+            {"messages": [messages[0].as_dict(1)], "next_cursor": None}
+        )
+
+    def test_not_modified(self):
+        Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text1"
+        )
+        self.client.force_login(self.user)
+        etag = self.client.get(self.URL)["ETag"]
+
+        # The session and the user
+        with self.assertNumQueries(2):
+            response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Reading changes the messages, but not their hashes
+        ats(UnreadDialogsManager(1).mark_as_read)(2)
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_cursor(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.URL, {"before": "cursor"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json(),
+            {"error": "cursor isn't a valid cursor"}
+        )
+
 
 class TestMainPageView(CustomTestCase):
     def test(self):
@@ -90,3 +355,29 @@ class TestMainPageView(CustomTestCase):
             "/", reverse("dialogs"),
             302, 302
         )
+
+
+class TestMetricsView(CustomTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_user(cls)
+        cls.URL = reverse("metrics")
+
+    def test(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(self.URL)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "redis_pools": get_pool_stats(),
+                "local_cache": get_local_cache_stats()
+            }
+        )
+
+    def test_not_staff(self):
+        self.client.force_login(self.user)
+        self.assertStatusCode(self.URL, 302)
@@ -0,0 +1,271 @@
+import asyncio
+import json
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import redis
+from asgiref.sync import async_to_sync as ats
+from django.conf import settings
+from django.utils import timezone
+
+from dev.py.utils import CustomTestCase
+from messages.managers import DialogIntegrityManager
+from messages.managers import encode_time
+from messages.managers import get_conversation_id
+from messages.models import Dialog
+from messages.models import Message
+from messages.writebehind import _flush_tasks
+from messages.writebehind import decode_message
+from messages.writebehind import encode_message
+from messages.writebehind import ensure_flush_task
+from messages.writebehind import flush_periodically
+from messages.writebehind import MessagesQueue
+
+
+class TestMessagesQueue(CustomTestCase):
+    def setUp(self):
+        self.queue = MessagesQueue()
+        self.redis_cache = redis.Redis(
+            decode_responses=True,
+            db=settings.FS_REDIS_DB
+        )
+
+    def tearDown(self):
+        self.redis_cache.flushdb()
+
+    def test_init(self):
+        self.assertEqual(self.queue.key, "wb_messages")
+        self.assertEqual(self.queue.id_key, "wb_message_id")
+        self.assertEqual(self.queue.lock_key, "wb_lock")
+        self.assertEqual(
+            self.queue.batch_size,
+            settings.FS_WRITE_BEHIND_BATCH_SIZE
+        )
+        self.assertEqual(
+            self.queue.max_size,
+            settings.FS_WRITE_BEHIND_MAX_QUEUE_SIZE
+        )
+        self.assertEqual(
+            self.queue.lock_timeout,
+            settings.FS_WRITE_BEHIND_LOCK_TIMEOUT
+        )
+
+    def test_get_next_id(self):
+        message = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text"
+        )
+
+        self.assertEqual(ats(self.queue.get_next_id)(), message.id + 1)
+        self.assertEqual(ats(self.queue.get_next_id)(), message.id + 2)
+
+    def test_raise_id(self):
+        self.assertEqual(ats(self.queue.raise_id)(), 0)
+
+        message = Message.objects.create(
+            sender_id=1, receiver_id=2, text="text"
+        )
+        self.assertEqual(ats(self.queue.raise_id)(), message.id)
+        self.redis_cache.set(self.queue.id_key, message.id + 5)
+        self.assertEqual(ats(self.queue.raise_id)(), message.id + 5)
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_put(self, p_ensure_flush_task):
+        message = ats(self.queue.put)(1, 2, "text")
+
+        self.assertEqual(message.id, 1)
+        self.assertEqual(message.conversation_id, get_conversation_id(1, 2))
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(
+            self.redis_cache.lrange(self.queue.key, 0, -1),
+            [encode_message(message)]
+        )
+        p_ensure_flush_task.assert_called_once()
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_put___full_queue(self, p_ensure_flush_task):
+        self.queue.max_size = 1
+        ats(self.queue.put)(1, 2, "text1")
+        message = ats(self.queue.put)(1, 2, "text2")
+
+        self.assertSequenceEqual(Message.objects.all(), [message])
+        self.assertEqual(ats(self.queue.get_size)(), 1)
+        p_ensure_flush_task.assert_called_once()
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_put___full_queue___order(self, p_ensure_flush_task):
+        self.queue.max_size = 1
+        ats(self.queue.put)(2, 1, "older")
+        message = ats(self.queue.put)(2, 1, "newer")
+        ats(self.queue.flush)()
+
+        dialog = Dialog.objects.get(owner_id=1, interlocutor_id=2)
+        self.assertEqual(dialog.last_text, "newer")
+        self.assertEqual(dialog.last_message_time, message.time)
+        self.assertEqual(dialog.unread_count, 2)
+        p_ensure_flush_task.assert_called_once()
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_flush(self, p_ensure_flush_task):
+        self.queue.batch_size = 2
+        messages = [
+            ats(self.queue.put)(1, 2, "text{}".format(i))
+            for i in range(3)
+        ]
+
+        self.assertEqual(ats(self.queue.flush)(), 2)
+        self.assertEqual(ats(self.queue.get_size)(), 1)
+        self.assertEqual(ats(self.queue.flush)(), 1)
+        self.assertEqual(ats(self.queue.flush)(), 0)
+        self.assertSequenceEqual(
+            Message.objects.order_by("id"),
+            messages
+        )
+        self.assertEqual(
+            Dialog.objects.get(owner_id=2, interlocutor_id=1).unread_count,
+            3
+        )
+        self.assertFalse(self.redis_cache.exists(self.queue.lock_key))
+        self.assertEqual(p_ensure_flush_task.call_count, 3)
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_flush___message_saved_outside(self, p_ensure_flush_task):
+        message1 = ats(self.queue.put)(1, 2, "text1")
+        ats(self.queue.flush)()
+        message2 = Message.objects.create_message(
+            sender_id=2, receiver_id=1, text="text2"
+        )
+        message3 = ats(self.queue.put)(1, 2, "text3")
+        i_manager = DialogIntegrityManager(1, 2)
+        ats(i_manager.get_hash)()
+
+        self.assertEqual(ats(self.queue.flush)(), 1)
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("text", flat=True)),
+            ["text1", "text2", "text3"]
+        )
+        # The queued id has been taken meanwhile
+        self.assertEqual(message3.id, message2.id)
+        self.assertNotIn(
+            Message.objects.get(text="text3").id,
+            [message1.id, message2.id]
+        )
+        self.assertFalse(self.redis_cache.exists(i_manager.key))
+        self.assertEqual(
+            ats(self.queue.get_next_id)(),
+            Message.objects.get(text="text3").id + 1
+        )
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_flush___replay(self, p_ensure_flush_task):
+        message = ats(self.queue.put)(1, 2, "text")
+        # A flush has crashed after its transaction
+        Message.objects.save_messages([message])
+
+        self.assertEqual(ats(self.queue.flush)(), 1)
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(
+            Dialog.objects.get(owner_id=2, interlocutor_id=1).unread_count,
+            1
+        )
+        p_ensure_flush_task.assert_called_once()
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_flush___locked(self, p_ensure_flush_task):
+        ats(self.queue.put)(1, 2, "text")
+        self.redis_cache.set(self.queue.lock_key, 1)
+
+        self.assertEqual(ats(self.queue.flush)(), 0)
+        self.assertEqual(ats(self.queue.get_size)(), 1)
+        p_ensure_flush_task.assert_called_once()
+
+    @patch("messages.writebehind.ensure_flush_task")
+    def test_flush___expired_lock(self, p_ensure_flush_task):
+        messages = [
+            ats(self.queue.put)(1, 2, "text{}".format(i))
+            for i in range(2)
+        ]
+        other_queue = MessagesQueue()
+        save_messages = Message.objects.save_messages
+
+        def slow_save_messages(batch):
+            # The lock expires and another process flushes the batch
+            self.redis_cache.delete(self.queue.lock_key)
+            other_queue.messages_manager = Mock(
+                save_messages=save_messages,
+                aggregate=Message.objects.aggregate
+            )
+            self.assertEqual(ats(other_queue.flush)(), 2)
+            ats(MessagesQueue().put)(1, 2, "text2")
+            self.redis_cache.set(self.queue.lock_key, "token")
+
+            return save_messages(batch)
+
+        self.queue.messages_manager = Mock(
+            save_messages=slow_save_messages,
+            aggregate=Message.objects.aggregate
+        )
+        self.assertEqual(ats(self.queue.flush)(), 2)
+
+        self.assertEqual(ats(self.queue.get_size)(), 1)
+        self.assertEqual(self.redis_cache.get(self.queue.lock_key), "token")
+        self.assertSequenceEqual(Message.objects.order_by("id"), messages)
+        self.assertEqual(p_ensure_flush_task.call_count, 3)
+
+
+class TestUtilFunctions(CustomTestCase):
+    def tearDown(self):
+        redis.Redis(db=settings.FS_REDIS_DB).flushdb()
+
+    def test_encode_message(self):
+        message = Message(
+            id=3, time=timezone.now(), sender_id=1, receiver_id=2,
+            conversation_id=get_conversation_id(1, 2), text="text"
+        )
+        item = encode_message(message)
+
+        self.assertEqual(json.loads(item), {
+            "id": 3,
+            "time": encode_time(message.time),
+            "sender_id": 1,
+            "receiver_id": 2,
+            "conversation_id": message.conversation_id,
+            "text": "text"
+        })
+
+        decoded_message = decode_message(item)
+        self.assertEqual(decoded_message.id, 3)
+        self.assertEqual(decoded_message.time, message.time)
+        self.assertEqual(decoded_message.text, "text")
+        self.assertEqual(
+            decoded_message.conversation_id,
+            message.conversation_id
+        )
+
+    @patch("messages.writebehind.asyncio.sleep")
+    @patch("messages.writebehind.MessagesQueue.flush")
+    def test_flush_periodically(self, p_flush, p_sleep):
+        batch_size = settings.FS_WRITE_BEHIND_BATCH_SIZE
+        p_flush.side_effect = [
+            batch_size, 1, Exception(), 0, asyncio.CancelledError()
+        ]
+
+        with patch("messages.writebehind.logger.exception") as p_log:
+            with self.assertRaises(asyncio.CancelledError):
+                ats(flush_periodically)()
+            p_log.assert_called_once()
+
+        self.assertEqual(p_flush.call_count, 5)
+        p_sleep.assert_called_with(settings.FS_WRITE_BEHIND_FLUSH_INTERVAL)
+
+    @patch("messages.writebehind.flush_periodically")
+    def test_ensure_flush_task(self, p_flush_periodically):
+        async def ensure():
+            ensure_flush_task()
+            task = _flush_tasks[asyncio.get_running_loop()]
+            ensure_flush_task()
+
+            return task, _flush_tasks[asyncio.get_running_loop()]
+
+        task1, task2 = ats(ensure)()
+        self.assertIs(task1, task2)
+        p_flush_periodically.assert_called_once()
@@ -1,6 +1,8 @@
 from django.contrib import admin
 
+from .models import Dialog
 from .models import Message
 
 
 admin.site.register(Message)
+admin.site.register(Dialog)
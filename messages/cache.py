@@ -0,0 +1,327 @@
+import asyncio
+import collections
+import contextvars
+import copy
+import hashlib
+import logging
+import threading
+import time
+import weakref
+
+import redis
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from redis import asyncio as aioredis
+from redis.exceptions import NoScriptError
+
+
+logger = logging.getLogger(__name__)
+
+# Connections of the asyncio client are bound to the event loop
+# which has opened them, so every loop gets its own pool.
+# An ASGI worker runs one loop, so it has one asyncio pool
+_redis_caches = weakref.WeakKeyDictionary()
+_sync_redis_cache = None
+_sync_caller = contextvars.ContextVar("sync_caller", default=False)
+# Every process has one local cache and one thread of invalidations
+_local_cache = None
+_local_cache_lock = threading.Lock()
+
+
+def get_pool_kwargs():
+    return {
+        "db": settings.FS_REDIS_DB,
+        "decode_responses": True,
+        "max_connections": settings.FS_REDIS_MAX_CONNECTIONS,
+        "socket_timeout": settings.FS_REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.FS_REDIS_SOCKET_CONNECT_TIMEOUT,
+        "health_check_interval": settings.FS_REDIS_HEALTH_CHECK_INTERVAL
+    }
+
+
+def get_redis_cache():
+    if _sync_caller.get():
+        return AwaitableRedis(get_sync_redis_cache())
+
+    loop = asyncio.get_running_loop()
+    if loop not in _redis_caches:
+        _redis_caches[loop] = aioredis.Redis(
+            connection_pool=aioredis.ConnectionPool(**get_pool_kwargs())
+        )
+
+    return _redis_caches[loop]
+
+
+def get_sync_redis_cache():
+    global _sync_redis_cache
+
+    if _sync_redis_cache is None:
+        _sync_redis_cache = redis.Redis(
+            connection_pool=redis.ConnectionPool(**get_pool_kwargs())
+        )
+
+    return _sync_redis_cache
+
+
+def get_pool_stats():
+    stats = {
+        "max_connections": settings.FS_REDIS_MAX_CONNECTIONS,
+        "async": {
+            "pools": 0,
+            "in_use_connections": 0,
+            "available_connections": 0
+        },
+        "sync": {
+            "pools": 0,
+            "in_use_connections": 0,
+            "available_connections": 0
+        }
+    }
+
+    pools = [
+        ("async", redis_cache.connection_pool)
+        for redis_cache in list(_redis_caches.values())
+    ]
+    if _sync_redis_cache is not None:
+        pools.append(("sync", _sync_redis_cache.connection_pool))
+
+    for kind, pool in pools:
+        stats[kind]["pools"] += 1
+        stats[kind]["in_use_connections"] += len(pool._in_use_connections)
+        stats[kind]["available_connections"] += len(
+            pool._available_connections
+        )
+
+    return stats
+
+
+def get_local_cache():
+    global _local_cache
+
+    if not settings.FS_LOCAL_CACHE:
+        return None
+
+    if _local_cache is None:
+        with _local_cache_lock:
+            if _local_cache is None:
+                local_cache = LocalCache(
+                    settings.FS_LOCAL_CACHE_MAX_SIZE,
+                    settings.FS_LOCAL_CACHE_TIMEOUT
+                )
+                listen_invalidations(local_cache)
+                _local_cache = local_cache
+
+    return _local_cache
+
+
+def get_local_cache_stats():
+    if _local_cache is None:
+        return None
+
+    return _local_cache.get_stats()
+
+
+def get_invalidation_channel():
+    # Channels are shared by all databases of a server
+    return "invalidate_{}".format(settings.FS_REDIS_DB)
+
+
+def listen_invalidations(local_cache):
+    def invalidate(message):
+        local_cache.delete(*message["data"].split())
+
+    def handle_exception(e, *_args):
+        # Invalidations could be lost while the connection is restored
+        logger.warning("invalidations aren't received: {}".format(e))
+        local_cache.clear()
+
+    pubsub = get_sync_redis_cache().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{get_invalidation_channel(): invalidate})
+
+    return pubsub.run_in_thread(
+        sleep_time=1,
+        daemon=True,
+        exception_handler=handle_exception
+    )
+
+
+class LocalCache:
+    # Values of Redis keys are kept in the process for a short time,
+    # keys changed by any process are evicted through pub/sub
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.values = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        # Versions at which keys have been deleted. The oldest ones
+        # are forgotten, and the newest forgotten version is used
+        # for every key which isn't remembered
+        self.deletion_versions = collections.OrderedDict()
+        self.forgotten_version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.values.get(key)
+            if item is None or item[1] < time.monotonic():
+                self.values.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.values.move_to_end(key)
+            self.hits += 1
+
+            return copy.copy(item[0])
+
+    def set(self, key, value, version):
+        with self.lock:
+            # The key could be changed while its value was read
+            if self.deletion_versions.get(
+                key,
+                self.forgotten_version
+            ) > version:
+                return
+
+            self.values[key] = (
+                copy.copy(value),
+                time.monotonic() + self.timeout
+            )
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self.lock:
+            self.version += 1
+            for key in keys:
+                self.values.pop(key, None)
+                self.deletion_versions[key] = self.version
+                self.deletion_versions.move_to_end(key)
+
+            while len(self.deletion_versions) > self.max_size:
+                _, self.forgotten_version = self.deletion_versions.popitem(
+                    last=False
+                )
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.values.clear()
+            self.deletion_versions.clear()
+            self.forgotten_version = self.version
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "size": len(self.values),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+class AwaitableRedis:
+    # Lets coroutines of the managers run on the shared sync pool
+    # when they are called through SyncFacade
+    def __init__(self, redis_cache):
+        self.redis_cache = redis_cache
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_cache, name)
+
+        async def wrapper(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return wrapper
+
+    def pipeline(self, *args, **kwargs):
+        return AwaitablePipeline(self.redis_cache.pipeline(*args, **kwargs))
+
+
+class AwaitablePipeline:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_args):
+        self.pipeline.reset()
+
+    def __getattr__(self, name):
+        # Commands are only buffered until the pipeline is executed
+        return getattr(self.pipeline, name)
+
+    async def execute(self, *args, **kwargs):
+        return self.pipeline.execute(*args, **kwargs)
+
+
+class RedisManager:
+    @property
+    def redis_cache(self):
+        return get_redis_cache()
+
+    async def run_script(self, script, keys, args):
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        try:
+            return await self.redis_cache.evalsha(
+                sha, len(keys), *keys, *args
+            )
+        except NoScriptError:
+            return await self.redis_cache.eval(
+                script, len(keys), *keys, *args
+            )
+
+    async def get_cached(self, key, read):
+        local_cache = get_local_cache()
+        if local_cache is None:
+            return await read()
+
+        value = local_cache.get(key)
+        if value is None:
+            version = local_cache.version
+            value = await read()
+            # Missing keys are rebuilt and invalidated at once
+            if value:
+                local_cache.set(key, value, version)
+
+        return value
+
+    async def invalidate(self, *keys):
+        local_cache = get_local_cache()
+        if local_cache is None:
+            return
+
+        local_cache.delete(*keys)
+        await self.redis_cache.publish(
+            get_invalidation_channel(),
+            " ".join(keys)
+        )
+
+    @property
+    def sync(self):
+        return SyncFacade(self)
+
+
+class SyncFacade:
+    def __init__(self, manager):
+        self.manager = manager
+
+    def __getattr__(self, name):
+        attr = getattr(self.manager, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            token = _sync_caller.set(True)
+            try:
+                return async_to_sync(attr)(*args, **kwargs)
+            finally:
+                _sync_caller.reset(token)
+
+        return wrapper
@@ -1,43 +1,132 @@
+import asyncio
 import json
 import logging
-from copy import deepcopy
+import time
 
 from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 from .forms import MessagesForm
+from .managers import combine_hashes
+from .managers import decode_time
 from .managers import DialogIntegrityManager
 from .managers import DialogsIntegrityManager
-from .managers import hash_dialog
+from .managers import encode_time
+from .managers import NewMessageManager
 from .managers import UnreadDialogsManager
+from .models import Dialog
 from .models import Message
+from .registry import ConnectionRegistry
+from .registry import SessionState
+from .serializers import BINARY_PROTOCOL
+from .serializers import dumps
+from .serializers import JSON_PROTOCOL
+from .serializers import NewMessageSerializer
+from .serializers import pack
+from .serializers import unpack
+from .writebehind import MessagesQueue
 
 
 logger = logging.getLogger(__name__)
+LOG_ERROR_LEVEL = 40
 LOG_WARNING_LEVEL = 30
 LOG_INFO_LEVEL = 20
+LOG_DEBUG_LEVEL = 10
 
 
 class CustomAsyncWebsocketConsumer(AsyncWebsocketConsumer):
+    heartbeat_task = None
+    protocol = None
+
     async def disconnect(self, event):
         self.log(LOG_INFO_LEVEL, "disconnect {}".format(event))
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+
+        await ConnectionRegistry(self.group_name).discard(self.channel_name)
+        await SessionState(self.channel_name).delete()
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
         )
 
-    async def send_data(self, event):
-        await self.send(
-            json.dumps(event["data"])
+    async def join_group(self):
+        self.session_state = SessionState(self.channel_name)
+        await self.session_state.create(
+            self.current_user.id,
+            self.group_name
         )
+        await add_session(self.group_name, self.channel_name)
+        await self.channel_layer.group_add(
+            self.group_name,
+            self.channel_name
+        )
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+
+    async def heartbeat(self):
+        registry = ConnectionRegistry(self.group_name)
+        try:
+            while True:
+                await asyncio.sleep(settings.FS_CONNECTION_HEARTBEAT_INTERVAL)
+                if not await registry.refresh(self.channel_name):
+                    # The connection has expired, the client reconnects
+                    # and is registered again
+                    self.log(LOG_WARNING_LEVEL, "connection has expired")
+                    await self.close()
+                    return
+                await self.session_state.refresh()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log(LOG_ERROR_LEVEL, "heartbeat has failed: {}".format(e))
+            await self.close()
+
+    async def evict(self, event):
+        self.log(LOG_INFO_LEVEL, "evict {}".format(event))
+        await self.send_command({
+            "command": "go_home"
+        })
+        await self.close()
+
+    async def send_data(self, event):
+        await self.send_command(event["data"])
+
+    async def send_payload(self, event):
+        if self.protocol == BINARY_PROTOCOL:
+            await self.send(bytes_data=pack(event["data"]))
+        else:
+            await self.send(event["text"])
+
+    async def send_command(self, data):
+        if self.protocol == BINARY_PROTOCOL:
+            await self.send(bytes_data=pack(data))
+        else:
+            await self.send(dumps(data))
+
+    async def accept_protocol(self):
+        subprotocols = self.scope.get("subprotocols", [])
+        if settings.FS_BINARY_PROTOCOL and BINARY_PROTOCOL in subprotocols:
+            self.protocol = BINARY_PROTOCOL
+        elif JSON_PROTOCOL in subprotocols:
+            self.protocol = JSON_PROTOCOL
+
+        await self.accept(self.protocol)
+
+    def decode(self, text_data, bytes_data):
+        if bytes_data is not None:
+            return unpack(bytes_data)
+
+        return json.loads(text_data)
 
     async def check_current_user(self):
         if (not self.current_user.is_authenticated):
-            await self.send(json.dumps({
+            await self.send_command({
                 "command": "go_home"
-            }))
+            })
             await self.close()
 
             return False
@@ -56,7 +145,7 @@ class CustomAsyncWebsocketConsumer(AsyncWebsocketConsumer):
 
 class DialogConsumer(CustomAsyncWebsocketConsumer):
     async def connect(self):
-        await self.accept()
+        await self.accept_protocol()
         self.current_user = self.scope["user"]
         self.interlocutor_id = int(
             self.scope["url_route"]["kwargs"]["interlocutor_id"]
@@ -72,20 +161,14 @@ class DialogConsumer(CustomAsyncWebsocketConsumer):
             self.current_user.id,
             self.interlocutor_id
         )
-        self.i_manager2 = DialogIntegrityManager(
-            self.interlocutor_id,
-            self.current_user.id
-        )
         self.dsi_manager = DialogsIntegrityManager(
             self.current_user.id
         )
-        self.dsi_manager2 = DialogsIntegrityManager(
-            self.interlocutor_id
-        )
         self.uds_manager = UnreadDialogsManager(
             self.current_user.id
         )
-        self.uds_manager2 = UnreadDialogsManager(
+        self.nm_manager = NewMessageManager(
+            self.current_user.id,
             self.interlocutor_id
         )
 
@@ -104,20 +187,16 @@ class DialogConsumer(CustomAsyncWebsocketConsumer):
             self.interlocutor_id
         )
 
-        await clear_group(self.group_name)
-        if (await self.check_current_user()):
-            await self.channel_layer.group_add(
-                self.group_name,
-                self.channel_name
-            )
-            await self.send(json.dumps({
+        if await self.check_current_user():
+            await self.join_group()
+            await self.send_command({
                 "command": "check_integrity",
                 "integrity_hash": await self.i_manager.get_hash(),
-            }))
+            })
 
-    async def receive(self, text_data):
-        self.log(LOG_INFO_LEVEL, "receive {}".format(text_data))
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        self.log(LOG_INFO_LEVEL, "receive {}".format(text_data or bytes_data))
+        data = self.decode(text_data, bytes_data)
 
         if "command" not in data:
             self.log(LOG_WARNING_LEVEL, "command is needed")
@@ -127,100 +206,73 @@ class DialogConsumer(CustomAsyncWebsocketConsumer):
             received_form = MessagesForm({
                 "text": data["message"]["text"]
             })
-            if received_form.is_valid():
+            if not received_form.is_valid():
+                raise ValidationError(
+                    "{} isn't valid!".format(MessagesForm.__name__)
+                )
+
+            timer = StageTimer()
+            if settings.FS_WRITE_BEHIND:
+                await self.nm_manager.prepare()
+                timer.finish("prepare")
+                new_message = await MessagesQueue().put(
+                    sender_id=self.current_user.id,
+                    receiver_id=self.interlocutor_id,
+                    text=received_form.cleaned_data["text"]
+                )
+            else:
                 new_message = await sync_to_async(
-                    Message.objects.create
+                    Message.objects.create_message
                 )(
                     sender_id=self.current_user.id,
                     receiver_id=self.interlocutor_id,
                     text=received_form.cleaned_data["text"]
                 )
-            else:
-                raise ValidationError(
-                    "{} isn't valid!".format(MessagesForm.__name__)
+            timer.finish("save")
+
+            (
+                integrity_hash, integrity_hash2,
+                dialogs_integrity_hash, dialogs_integrity_hash2
+            ) = await self.nm_manager.consider(new_message)
+            timer.finish("consider")
+
+            serializer = NewMessageSerializer(new_message)
+            timer.finish("serialize")
+
+            # Groups don't depend on each other
+            await asyncio.gather(
+                self.channel_layer.group_send(
+                    self.group_name,
+                    serializer.get_dialog_event(
+                        self.current_user.id,
+                        integrity_hash
+                    )
+                ),
+                self.channel_layer.group_send(
+                    self.group_name2,
+                    serializer.get_dialog_event(
+                        self.interlocutor_id,
+                        integrity_hash2
+                    )
+                ),
+                self.channel_layer.group_send(
+                    self.dialogs_group_name,
+                    serializer.get_dialogs_event(
+                        self.current_user.id,
+                        dialogs_integrity_hash
+                    )
+                ),
+                self.channel_layer.group_send(
+                    self.dialogs_group_name2,
+                    serializer.get_dialogs_event(
+                        self.interlocutor_id,
+                        dialogs_integrity_hash2
+                    )
                 )
-
-            await self.uds_manager2.add_dialog(self.current_user.id)
-            await self.i_manager.add_to_hash(new_message.time)
-            await self.i_manager2.add_to_hash(new_message.time)
-
-            dialog_event = {
-                "type": "send_data",
-                "data": {
-                    "command": "get_new_message",
-                    "integrity_hash": await self.i_manager.get_hash()
-                }
-            }
-            dialog_event["data"]["message"] = new_message.as_dict(
-                self.current_user.id
-            )
-            await self.channel_layer.group_send(
-                self.group_name,
-                dialog_event
             )
+            timer.finish("broadcast")
 
-            dialog_event2 = deepcopy(dialog_event)
-            dialog_event2["data"]["message"] = new_message.as_dict(
-                self.interlocutor_id
-            )
-            dialog_event2["data"]["integrity_hash"] = (
-                await self.i_manager2.get_hash()
-            )
-            await self.channel_layer.group_send(
-                self.group_name2,
-                dialog_event2
-            )
-
-            dialog_hash = hash_dialog(
-                self.interlocutor_id,
-                new_message.time
-            )
-            await self.dsi_manager.consider_new(
-                self.interlocutor_id,
-                dialog_hash
-            )
-            dialogs_event = {
-                "type": "send_data",
-                "data": {
-                    "command": "get_new_message",
-                    "dialog": {
-                        "id": self.interlocutor_id,
-                        "text": new_message.text,
-                        "is_unread": False,
-                        "hash": dialog_hash
-                    },
-                    "integrity_hash": await self.dsi_manager.get_hash(),
-                }
-            }
-            await self.channel_layer.group_send(
-                self.dialogs_group_name,
-                dialogs_event
-            )
-
-            dialog_hash2 = hash_dialog(
-                self.current_user.id,
-                new_message.time
-            )
-            await self.dsi_manager2.consider_new(
-                self.current_user.id,
-                dialog_hash2
-            )
-            dialogs_event2 = deepcopy(dialogs_event)
-            dialogs_event2["data"]["dialog"]["id"] = (
-                self.current_user.id
-            )
-            dialogs_event2["data"]["dialog"]["is_unread"] = (
-                True
-            )
-            dialogs_event2["data"]["dialog"]["hash"] = dialog_hash2
-            dialogs_event2["data"]["integrity_hash"] = (
-                await self.dsi_manager2.get_hash()
-            )
-
-            await self.channel_layer.group_send(
-                self.dialogs_group_name2,
-                dialogs_event2
-            )
+            self.log(LOG_DEBUG_LEVEL, "new message {}".format(timer))
         elif data["command"] == "mark_dialog_as_read":
             messages = await self.dsi_manager.mark_as_read(
                 self.interlocutor_id
@@ -241,8 +293,52 @@ class DialogConsumer(CustomAsyncWebsocketConsumer):
                 self.dialogs_group_name,
                 dialogs_event
             )
+
+            # Other sessions of the dialog stop considering it unread
+            await self.channel_layer.group_send(
+                self.group_name,
+                {
+                    "type": "read_dialog",
+                    "read_at": timezone.now().timestamp()
+                }
+            )
         elif data["command"] == "give_messages":
-            messages, _ = await self.i_manager.get_messages()
+            # History is sent in bounded frames, the first one
+            # replaces messages of the client
+            chunk_index = 0
+            async for messages in self.i_manager.stream_messages(
+                settings.FS_MESSAGES_CHUNK_SIZE
+            ):
+                messages_as_dict = []
+                for message in messages:
+                    messages_as_dict.append(
+                        message.as_dict(self.current_user.id)
+                    )
+
+                await self.send_command({
+                    "command": "get_messages",
+                    "chunk": chunk_index,
+                    "messages": messages_as_dict,
+                })
+                chunk_index += 1
+
+            await self.send_command({
+                "command": "get_messages_done",
+                "chunks": chunk_index
+            })
+        elif data["command"] == "give_messages_page":
+            try:
+                messages, next_cursor = await sync_to_async(
+                    Message.objects.get_dialog_messages_page
+                )(
+                    self.current_user.id,
+                    self.interlocutor_id,
+                    before=data.get("before"),
+                    after=data.get("after")
+                )
+            except ValueError:
+                self.log(LOG_WARNING_LEVEL, "invalid cursor")
+                return
 
             messages_as_dict = []
             for message in messages:
@@ -250,20 +346,86 @@ class DialogConsumer(CustomAsyncWebsocketConsumer):
                     message.as_dict(self.current_user.id)
                 )
 
-            text_data = {
-                "command": "get_messages",
+            await self.send_command({
+                "command": "get_messages_page",
                 "messages": messages_as_dict,
-            }
-            await self.send(
-                json.dumps(text_data)
+                "before": data.get("before"),
+                "after": data.get("after"),
+                "next_cursor": next_cursor
+            })
+        elif data["command"] == "sync_messages":
+            try:
+                last_message_id = int(data["last_message_id"])
+            except (KeyError, TypeError, ValueError):
+                self.log(LOG_WARNING_LEVEL, "invalid last message id")
+                return
+
+            messages, is_complete = await sync_to_async(
+                Message.objects.get_missing_dialog_messages
+            )(
+                self.current_user.id,
+                self.interlocutor_id,
+                last_message_id
             )
+
+            messages_as_dict = []
+            for message in messages:
+                messages_as_dict.append(
+                    message.as_dict(self.current_user.id)
+                )
+
+            await self.send_command({
+                "command": "get_missing_messages",
+                "messages": messages_as_dict,
+                "is_complete": is_complete,
+                "integrity_hash": await self.i_manager.get_hash()
+            })
+        elif data["command"] == "give_integrity_buckets":
+            buckets = await self.i_manager.get_buckets()
+
+            await self.send_command({
+                "command": "get_integrity_buckets",
+                "buckets": buckets,
+                "integrity_hash": combine_hashes(buckets.values())
+            })
+        elif data["command"] == "give_buckets_messages":
+            try:
+                messages = await sync_to_async(
+                    Message.objects.get_dialog_buckets_messages
+                )(
+                    self.current_user.id,
+                    self.interlocutor_id,
+                    list(data["buckets"])
+                )
+            except (KeyError, TypeError, ValueError):
+                self.log(LOG_WARNING_LEVEL, "invalid buckets")
+                return
+
+            messages_as_dict = []
+            for message in messages:
+                messages_as_dict.append(
+                    message.as_dict(self.current_user.id)
+                )
+
+            await self.send_command({
+                "command": "get_buckets_messages",
+                "buckets": data["buckets"],
+                "messages": messages_as_dict,
+                "integrity_hash": await self.i_manager.get_hash()
+            })
         else:
             self.log(LOG_WARNING_LEVEL, "invalid command")
 
+    async def read_dialog(self, event):
+        if await self.session_state.set_read_at(event["read_at"]):
+            await self.send_command({
+                "command": "mark_dialog_as_read"
+            })
+
 
 class DialogsConsumer(CustomAsyncWebsocketConsumer):
     async def connect(self):
-        await self.accept()
+        await self.accept_protocol()
         self.current_user = self.scope["user"]
         self.name = str(self.current_user.id)
         self.type = "dialogs"
@@ -280,28 +442,30 @@ class DialogsConsumer(CustomAsyncWebsocketConsumer):
             self.current_user.id
         )
 
-        await clear_group(self.group_name)
         if await self.check_current_user():
-            await self.channel_layer.group_add(
-                self.group_name,
-                self.channel_name
-            )
-            await self.send(json.dumps({
+            await self.join_group()
+            await self.send_command({
                 "command": "check_integrity",
                 "integrity_hash": await self.i_manager.get_hash(),
-            }))
+            })
 
-    async def receive(self, text_data):
-        self.log(LOG_INFO_LEVEL, "receive {}".format(text_data))
+    async def receive(self, text_data=None, bytes_data=None):
+        self.log(LOG_INFO_LEVEL, "receive {}".format(text_data or bytes_data))
 
-        data = json.loads(text_data)
+        data = self.decode(text_data, bytes_data)
 
         if "command" not in data:
             self.log(LOG_WARNING_LEVEL, "command is needed")
             return
 
         if data["command"] == "delete_dialog":
-            dialog_id = data["dialog_id"]
+            # Browsers send ids of DOM nodes, which are strings
+            try:
+                dialog_id = int(data["dialog_id"])
+            except (KeyError, TypeError, ValueError):
+                self.log(LOG_WARNING_LEVEL, "invalid dialog id")
+                return
+
             await self.i_manager.mark_as_deleted(dialog_id)
             await self.uds_manager.mark_as_read(dialog_id)
 
@@ -324,18 +488,58 @@ class DialogsConsumer(CustomAsyncWebsocketConsumer):
                 event
             )
         elif data["command"] == "give_dialogs":
+            # The token is taken before the query, so changes made
+            # during it are sent again by the next sync
+            sync_token = encode_time(timezone.now())
             dialogs, _, uds_set = await self.i_manager.get_dialogs()
 
             await self.uds_manager.reset(uds_set)
 
-            await self.send(json.dumps({
+            await self.send_command({
                 "command": "get_dialogs",
-                "dialogs": dialogs
-            }))
+                "dialogs": dialogs,
+                "sync_token": sync_token
+            })
+        elif data["command"] == "sync_dialogs":
+            try:
+                since = decode_time(data["since"])
+            except (KeyError, ValueError):
+                self.log(LOG_WARNING_LEVEL, "invalid sync token")
+                return
+
+            sync_token = encode_time(timezone.now())
+            dialogs, deleted_dialogs_ids = await sync_to_async(
+                Dialog.objects.get_changed_dialogs
+            )(self.current_user.id, since)
+
+            await self.send_command({
+                "command": "get_changed_dialogs",
+                "dialogs": dialogs,
+                "deleted_dialogs_ids": deleted_dialogs_ids,
+                "sync_token": sync_token,
+                "integrity_hash": await self.i_manager.get_hash()
+            })
         else:
             self.log(LOG_WARNING_LEVEL, "invalid command")
 
 
+class StageTimer:
+    def __init__(self):
+        self.timings = {}
+        self.started_at = time.perf_counter()
+
+    def finish(self, stage):
+        finished_at = time.perf_counter()
+        self.timings[stage] = finished_at - self.started_at
+        self.started_at = finished_at
+
+    def __str__(self):
+        return ", ".join(
+            "{} {:.1f}ms".format(stage, timing * 1000)
+            for stage, timing in self.timings.items()
+        )
+
+
 def get_dialog_group_name(user1_id, user2_id):
     return "d{}-{}".format(user1_id, user2_id)
 
@@ -347,21 +551,12 @@ def get_dialogs_group_name(user_id):
 channel_layer = get_channel_layer()
 
 
-async def clear_group(group_name):
-    if group_name in channel_layer.groups:
-        await channel_layer.group_send(
-            group_name,
-            {
-                "type": "send_data",
-                "data": {
-                    "command": "go_home",
-                }
-            }
-        )
-
-        channels_names = deepcopy(channel_layer.groups[group_name])
-        for channel_name in channels_names:
-            await channel_layer.group_discard(
-                group_name,
-                channel_name
-            )
+async def add_session(group_name, channel_name):
+    # Sessions beyond the limit are evicted on any worker process
+    registry = ConnectionRegistry(group_name)
+    for old_channel_name in await registry.add(
+        channel_name,
+        settings.FS_MAX_SESSIONS_PER_USER
+    ):
+        await channel_layer.send(old_channel_name, {"type": "evict"})
+        await channel_layer.group_discard(group_name, old_channel_name)
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from messages.managers import backfill_conversation_ids
+from messages.models import Message
+
+
+class Command(BaseCommand):
+    help = "Fills conversation ids of messages which don't have them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of messages updated at once"
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Seconds to wait between batches"
+        )
+
+    def handle(self, *args, **options):
+        messages_number = 0
+        last_id = 0
+        while True:
+            updated_number, last_id = backfill_conversation_ids(
+                Message.objects,
+                options["batch_size"],
+                last_id
+            )
+            if updated_number == 0:
+                break
+
+            messages_number += updated_number
+            if options["sleep"] > 0:
+                time.sleep(options["sleep"])
+
+        self.stdout.write(
+            "Backfilled {} messages".format(messages_number)
+        )
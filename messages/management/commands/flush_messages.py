@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from messages.writebehind import MessagesQueue
+
+
+class Command(BaseCommand):
+    help = "Saves messages of the write-behind queue to the database"
+
+    def handle(self, *args, **options):
+        queue = MessagesQueue()
+
+        messages_number = 0
+        while True:
+            flushed_number = queue.sync.flush()
+            messages_number += flushed_number
+            if flushed_number == 0:
+                break
+
+        self.stdout.write(
+            "Flushed {} messages, {} are left".format(
+                messages_number,
+                queue.sync.get_size()
+            )
+        )
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from messages.models import Dialog
+from messages.models import Message
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the Dialog summary table from the Message table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user-id",
+            type=int,
+            nargs="+",
+            dest="user_ids",
+            help="Rebuild only dialogs of these users"
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options["user_ids"]
+        if user_ids is None:
+            user_ids = set(
+                Message.objects.values_list(
+                    "sender_id",
+                    flat=True
+                ).distinct()
+            ) | set(
+                Message.objects.values_list(
+                    "receiver_id",
+                    flat=True
+                ).distinct()
+            )
+            Dialog.objects.exclude(
+                owner_id__in=Message.objects.values("sender_id")
+            ).exclude(
+                owner_id__in=Message.objects.values("receiver_id")
+            ).delete()
+
+        dialogs_number = 0
+        for user_id in sorted(user_ids):
+            dialogs_number += Dialog.objects.rebuild(user_id)
+
+        self.stdout.write(
+            "Rebuilt {} dialogs of {} users".format(
+                dialogs_number,
+                len(user_ids)
+            )
+        )
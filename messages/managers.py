@@ -1,10 +1,108 @@
-from itertools import chain
+import asyncio
+import hashlib
+import logging
+import threading
+from datetime import timedelta
 
-import redis
+import pytz
 from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import connections
+from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import Count
+from django.db.models import Exists
 from django.db.models import F
+from django.db.models import OuterRef
+from django.db.models import Q
+from django.db.models import Subquery
+from django.db.models import Value
+from django.db.models import When
+from django.utils import timezone
+
+from .cache import RedisManager
+
+
+logger = logging.getLogger(__name__)
+
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+# User ids are 32-bit, so the smaller one takes the high half
+# of a conversation id and the bigger one takes the low half
+CONVERSATION_ID_SHIFT = 2**32
+SUMMARY_FIELDS = (
+    "interlocutor_id", "last_message_time",
+    "last_text", "unread_count"
+)
+
+HASH_BUCKET_FORMAT = "%Y%m%d"
+# Hashes are summed by browsers and Lua as doubles,
+# which are exact only up to 2^53
+HASH_MODULUS = 2**48
+
+# KEYS: di, dsi and uds keys of the sender, then the same of the receiver
+# ARGV: sender id, receiver id, message hash, message bucket,
+# dialog hash of the sender, dialog hash of the receiver, hash modulus.
+# Missing keys aren't created: the next get_hash rebuilds them
+# from the database, which already contains the new message
+NEW_MESSAGE_SCRIPT = """
+local modulus = tonumber(ARGV[7])
+
+local function sum_values(key, hash)
+    for _, value in ipairs(redis.call("HVALS", key)) do
+        hash = (hash + tonumber(value)) % modulus
+    end
+
+    return hash
+end
+
+local function consider(di_key, dsi_key, uds_key, dialog_id, dialog_hash)
+    local di_hash = false
+    if redis.call("EXISTS", di_key) == 1 then
+        local bucket_hash = tonumber(redis.call("HGET", di_key, ARGV[4]) or 0)
+        bucket_hash = (bucket_hash + tonumber(ARGV[3])) % modulus
+        redis.call(
+            "HSET", di_key, ARGV[4], string.format("%.0f", bucket_hash)
+        )
+        di_hash = sum_values(di_key, 0)
+    end
+
+    local dsi_hash = false
+    if redis.call("EXISTS", dsi_key) == 1 then
+        redis.call("HSET", dsi_key, dialog_id, dialog_hash)
+
+        local uds_number = redis.call("SCARD", uds_key)
+        if uds_number > 0 then
+            dsi_hash = sum_values(dsi_key, uds_number - 1)
+        end
+    end
+
+    return {di_hash, dsi_hash}
+end
+
+if redis.call("EXISTS", KEYS[6]) == 1 then
+    redis.call("SADD", KEYS[6], ARGV[1])
+end
+
+local sender_hashes = consider(KEYS[1], KEYS[2], KEYS[3], ARGV[2], ARGV[5])
+local receiver_hashes = consider(KEYS[4], KEYS[5], KEYS[6], ARGV[1], ARGV[6])
+
+return {
+    sender_hashes[1], receiver_hashes[1],
+    sender_hashes[2], receiver_hashes[2]
+}
+"""
+
+# KEYS: di key
+# ARGV: message bucket, message hash, hash modulus
+ADD_TO_BUCKET_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    local bucket_hash = tonumber(redis.call("HGET", KEYS[1], ARGV[1]) or 0)
+    bucket_hash = (bucket_hash + tonumber(ARGV[2])) % tonumber(ARGV[3])
+    redis.call("HSET", KEYS[1], ARGV[1], string.format("%.0f", bucket_hash))
+end
+"""
 
 
 class MessagesManager(models.Manager):
@@ -18,120 +116,523 @@ class MessagesManager(models.Manager):
             flat=True
         ).distinct())
 
-    def get_dialog_messages(self, user1_id, user2_id):
-        messages1 = self.filter(
-            sender_id=user1_id,
-            receiver_id=user2_id,
-            is_deleted_by_sender=False
+    def filter_dialog_messages(self, user1_id, user2_id):
+        return self.filter(
+            conversation_id=get_conversation_id(user1_id, user2_id)
+        ).filter(
+            Q(
+                sender_id=user1_id,
+                receiver_id=user2_id,
+                is_deleted_by_sender=False
+            ) | Q(
+                sender_id=user2_id,
+                receiver_id=user1_id,
+                is_deleted_by_receiver=False
+            )
         )
-        messages2 = self.filter(
-            sender_id=user2_id,
-            receiver_id=user1_id,
-            is_deleted_by_receiver=False
+
+    def get_dialog_messages(self, user1_id, user2_id):
+        return list(self.filter_dialog_messages(
+            user1_id,
+            user2_id
+        ).order_by("time", "id"))
+
+    def dialog_has_visible_messages(self, user1_id, user2_id):
+        # Stops at the first row without sorting the dialog
+        return self.filter_dialog_messages(user1_id, user2_id).exists()
+
+    def get_dialog_buckets(self, user1_id, user2_id, chunk_size):
+        # Only ids and times are read, through a cursor
+        messages = self.filter_dialog_messages(
+            user1_id,
+            user2_id
+        ).values_list("id", "time").iterator(chunk_size=chunk_size)
+
+        buckets = dict()
+        for message_id, time in messages:
+            bucket = hash_bucket(time)
+            buckets[bucket] = combine_hashes([
+                buckets.get(bucket, 0),
+                hash_message(message_id, time)
+            ])
+
+        return buckets
+
+    def iter_dialog_messages(self, user1_id, user2_id, chunk_size):
+        # A dialog is read through a cursor, so only one chunk is
+        # in memory. At least one chunk is yielded
+        messages = self.filter_dialog_messages(
+            user1_id,
+            user2_id
+        ).order_by("time", "id").iterator(chunk_size=chunk_size)
+
+        chunk = []
+        chunks_number = 0
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+                chunks_number += 1
+
+        if len(chunk) != 0 or chunks_number == 0:
+            yield chunk
+
+    def get_dialog_messages_page(
+        self, user1_id, user2_id,
+        before=None, after=None, limit=None
+    ):
+        if before is not None and after is not None:
+            raise ValueError("Only one cursor can be used at once")
+
+        if limit is None:
+            limit = settings.FS_DIALOG_MESSAGES_PAGE_SIZE
+
+        messages = self.filter_dialog_messages(user1_id, user2_id)
+        if after is not None:
+            time, id_ = decode_cursor(after)
+            messages = messages.filter(
+                Q(time__gt=time) | Q(time=time, id__gt=id_)
+            ).order_by("time", "id")
+        else:
+            if before is not None:
+                time, id_ = decode_cursor(before)
+                messages = messages.filter(
+                    Q(time__lt=time) | Q(time=time, id__lt=id_)
+                )
+            messages = messages.order_by("-time", "-id")
+
+        # One extra row shows whether the next page exists
+        page = list(messages[:limit + 1])
+        has_next_page = len(page) > limit
+        page = page[:limit]
+        if after is None:
+            page.reverse()
+
+        next_cursor = None
+        if has_next_page:
+            if after is None:
+                next_cursor = encode_cursor(page[0])
+            else:
+                next_cursor = encode_cursor(page[-1])
+
+        return page, next_cursor
+
+    def get_missing_dialog_messages(
+        self, user1_id, user2_id,
+        last_message_id, limit=None
+    ):
+        if limit is None:
+            limit = settings.FS_DIALOG_MESSAGES_PAGE_SIZE
+
+        messages = list(self.filter_dialog_messages(
+            user1_id,
+            user2_id
+        ).filter(
+            id__gt=last_message_id
+        ).order_by("time", "id")[:limit + 1])
+
+        return messages[:limit], len(messages) <= limit
+
+    def get_dialog_buckets_messages(self, user1_id, user2_id, buckets):
+        if len(buckets) == 0:
+            return []
+
+        buckets_filter = Q()
+        for bucket in buckets:
+            start = decode_bucket(bucket)
+            buckets_filter |= Q(
+                time__gte=start,
+                time__lt=start + timedelta(days=1)
+            )
+
+        return list(self.filter_dialog_messages(
+            user1_id,
+            user2_id
+        ).filter(buckets_filter).order_by("time", "id"))
+
+    def get_last_dialogs_messages(self, user_id, limit=None):
+        visible_messages = self.annotate_interlocutor(
+            self.filter(
+                Q(sender_id=user_id, is_deleted_by_sender=False)
+                | Q(receiver_id=user_id, is_deleted_by_receiver=False)
+            ),
+            user_id
         )
-        return sorted(
-            chain(messages1, messages2),
-            key=lambda obj: obj.time
+
+        if connections[self.db].vendor == "postgresql":
+            last_messages = self.annotate_interlocutor(
+                self.filter(id__in=visible_messages.order_by(
+                    "conversation_id", "-time", "-id"
+                ).distinct("conversation_id").values("id")),
+                user_id
+            )
+        else:
+            last_messages = visible_messages.filter(id=Subquery(
+                visible_messages.filter(
+                    conversation_id=OuterRef("conversation_id")
+                ).order_by("-time", "-id").values("id")[:1]
+            ))
+
+        last_messages = last_messages.annotate(
+            dialog_is_unread=Exists(self.filter(
+                sender_id=OuterRef("interlocutor_id"),
+                receiver_id=user_id,
+                is_unread=True,
+                is_deleted_by_receiver=False
+            ))
+        ).order_by("-time", "-id").values(
+            "interlocutor_id", "time", "text", "dialog_is_unread"
         )
+        if limit is not None:
+            last_messages = last_messages[:limit]
+
+        return last_messages
+
+    def get_dialogs(self, user_id, limit=None):
+        last_messages = self.get_last_dialogs_messages(user_id, limit)
 
-    def get_dialogs(self, user_id):
-        messages1 = self.filter(
-            sender_id=user_id,
-            is_deleted_by_sender=False
-        ).annotate(
-            interlocutor_id=F("receiver_id")
-        ).values("interlocutor_id", "time", "text")
-        messages2 = self.filter(
+        dialogs = []
+        dialogs_hashes = dict()
+        uds_set = set()
+        for message in last_messages:
+            interlocutor_id = message["interlocutor_id"]
+            dialog = {
+                "id": interlocutor_id,
+                "text": message["text"],
+                "is_unread": message["dialog_is_unread"],
+                "hash": hash_dialog(interlocutor_id, message["time"])
+            }
+            dialogs.append(dialog)
+            dialogs_hashes[interlocutor_id] = dialog["hash"]
+            if dialog["is_unread"]:
+                uds_set.add(interlocutor_id)
+
+        return dialogs, dialogs_hashes, uds_set
+
+    def annotate_interlocutor(self, messages, user_id):
+        return messages.annotate(interlocutor_id=Case(
+            When(sender_id=user_id, then=F("receiver_id")),
+            default=F("sender_id"),
+            output_field=models.IntegerField()
+        ))
+
+    def get_unread_counts(self, user_id):
+        return dict(self.filter(
             receiver_id=user_id,
+            is_unread=True,
             is_deleted_by_receiver=False
-        ).annotate(
-            interlocutor_id=F("sender_id")
-        ).values("interlocutor_id", "time", "text", "is_unread")
-
-        max_time_dict = dict()
-        for message in chain(messages1, messages2):
-            if (message["interlocutor_id"] not in max_time_dict
-                or message["time"]
-                    > max_time_dict[message["interlocutor_id"]]["time"]
+        ).values("sender_id").annotate(
+            unread_count=Count("id")
+        ).values_list("sender_id", "unread_count"))
+
+    def create_message(self, sender_id, receiver_id, text):
+        # It's impossible to import as usually
+        from .models import Dialog
+
+        with transaction.atomic(using=self.db):
+            message = self.create(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                text=text
+            )
+            Dialog.objects.consider_message(message)
+
+        return message
+
+    def save_messages(self, messages):
+        # It's impossible to import as usually
+        from .models import Dialog
+
+        with transaction.atomic(using=self.db):
+            # Messages of a replayed batch may be saved already.
+            # An id could also be taken by a message which has been
+            # saved outside the queue, then the message gets a new id
+            saved_messages = {
+                id_: fields
+                for id_, *fields in self.filter(
+                    id__in=[message.id for message in messages]
+                ).values_list("id", "sender_id", "receiver_id", "time")
+            }
+            new_messages = []
+            conflicting_messages = []
+            for message in messages:
+                fields = saved_messages.get(message.id)
+                if fields is None:
+                    new_messages.append(message)
+                elif fields != [
+                    message.sender_id,
+                    message.receiver_id,
+                    message.time
+                ]:
+                    logger.warning(
+                        "message id {} is taken, a new one is given".format(
+                            message.id
+                        )
+                    )
+                    conflicting_messages.append(message)
+
+            self.bulk_create(new_messages)
+
+            if (
+                connections[self.db].vendor == "postgresql"
+                and len(new_messages) != 0
             ):
-                max_time_dict[message["interlocutor_id"]] = message
+                # Ids are given by the queue, so the sequence
+                # has to be moved for usual inserts
+                with connections[self.db].cursor() as cursor:
+                    cursor.execute(
+                        "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                        "(SELECT MAX(id) FROM {}))".format(
+                            self.model._meta.db_table
+                        ),
+                        [self.model._meta.db_table]
+                    )
 
-        uds_set = set()
-        for message in chain(messages1, messages2):
-            if (message.get("is_unread", False)):
-                uds_set.add(message["interlocutor_id"])
+            for message in conflicting_messages:
+                message.id = None
+                message.save(using=self.db, force_insert=True)
+            new_messages.extend(conflicting_messages)
 
-        dialogs = []
-        for interlocutor_id, message in max_time_dict.items():
-            dialog = dict()
-            dialog["id"] = interlocutor_id
-            dialog["time_for_sort"] = message["time"]
-            dialog["text"] = message["text"]
-            dialog["is_unread"] = interlocutor_id in uds_set
-            dialog["hash"] = hash_dialog(interlocutor_id, message["time"])
+            Dialog.objects.consider_messages(new_messages)
 
-            dialogs.append(dialog)
+        return new_messages
+
+    def mark_dialog_messages_as_read(self, user1_id, user2_id):
+        # It's impossible to import as usually
+        from .models import Dialog
+
+        with transaction.atomic(using=self.db):
+            self.filter(
+                sender_id=user2_id,
+                receiver_id=user1_id,
+                is_unread=True,
+                is_deleted_by_receiver=False
+            ).update(is_unread=False)
+            Dialog.objects.mark_as_read(user1_id, user2_id)
+
+    def mark_dialog_messages_as_deleted(self, user1_id, user2_id):
+        # It's impossible to import as usually
+        from .models import Dialog
 
-        dialogs.sort(
-            key=lambda obj: obj["time_for_sort"],
-            reverse=True
+        messages = self.filter(
+            conversation_id=get_conversation_id(user1_id, user2_id)
         )
-        for dialog in dialogs:
-            del(dialog["time_for_sort"])
+        with transaction.atomic(using=self.db):
+            messages.filter(
+                sender_id=user1_id,
+                receiver_id=user2_id,
+                is_deleted_by_sender=False
+            ).update(is_deleted_by_sender=True)
+            messages.filter(
+                sender_id=user2_id,
+                receiver_id=user1_id,
+                is_deleted_by_receiver=False
+            ).update(is_deleted_by_receiver=True)
+            Dialog.objects.mark_as_deleted(user1_id, user2_id)
 
+
+class DialogsManager(models.Manager):
+    def get_dialogs(self, owner_id, limit=None):
+        summaries = self.filter(
+            owner_id=owner_id,
+            is_deleted=False
+        ).order_by("-last_message_time", "-id").values(*SUMMARY_FIELDS)
+        if limit is not None:
+            summaries = summaries[:limit]
+
+        dialogs = []
         dialogs_hashes = dict()
-        for dialog in dialogs:
+        uds_set = set()
+        for summary in summaries:
+            dialog = summary_as_dict(summary)
+            dialogs.append(dialog)
             dialogs_hashes[dialog["id"]] = dialog["hash"]
+            if dialog["is_unread"]:
+                uds_set.add(dialog["id"])
 
         return dialogs, dialogs_hashes, uds_set
 
-    def mark_dialog_messages_as_read(self, user1_id, user2_id):
-        self.filter(
-            sender_id=user2_id,
-            receiver_id=user1_id,
-            is_unread=True,
-            is_deleted_by_receiver=False
-        ).update(is_unread=False)
+    def get_changed_dialogs(self, owner_id, since):
+        summaries = self.filter(
+            owner_id=owner_id,
+            updated_at__gte=since
+        ).order_by("-last_message_time", "-id").values(
+            "is_deleted", *SUMMARY_FIELDS
+        )
 
-    def mark_dialog_messages_as_deleted(self, user1_id, user2_id):
+        dialogs = []
+        deleted_dialogs_ids = []
+        for summary in summaries:
+            if summary["is_deleted"]:
+                deleted_dialogs_ids.append(summary["interlocutor_id"])
+            else:
+                dialogs.append(summary_as_dict(summary))
+
+        return dialogs, deleted_dialogs_ids
+
+    def get_unread_dialogs_set(self, owner_id):
+        return set(self.filter(
+            owner_id=owner_id,
+            is_deleted=False,
+            unread_count__gt=0
+        ).values_list("interlocutor_id", flat=True))
+
+    def consider_message(self, message):
+        self._consider_message(
+            message.sender_id,
+            message.receiver_id,
+            message,
+            unread_increment=0
+        )
+        self._consider_message(
+            message.receiver_id,
+            message.sender_id,
+            message,
+            unread_increment=1
+        )
+
+    def consider_messages(self, messages):
+        last_messages = dict()
+        unread_increments = dict()
+        for message in messages:
+            for owner_id, interlocutor_id, unread_increment in [
+                (message.sender_id, message.receiver_id, 0),
+                (message.receiver_id, message.sender_id, 1)
+            ]:
+                key = (owner_id, interlocutor_id)
+                last_message = last_messages.get(key)
+                if last_message is None or (
+                    (last_message.time, last_message.id)
+                    < (message.time, message.id)
+                ):
+                    last_messages[key] = message
+                unread_increments[key] = (
+                    unread_increments.get(key, 0) + unread_increment
+                )
+
+        for key, message in last_messages.items():
+            self._consider_message(
+                *key,
+                message,
+                unread_increment=unread_increments[key]
+            )
+
+    def _consider_message(
+        self, owner_id, interlocutor_id,
+        message, unread_increment
+    ):
+        summaries = self.filter(
+            owner_id=owner_id,
+            interlocutor_id=interlocutor_id
+        )
+        # Concurrent transactions can commit out of time order,
+        # so an older message doesn't replace the last one
+        is_newer = Q(last_message_time__lte=message.time)
+        update_values = {
+            "unread_count": F("unread_count") + unread_increment,
+            "last_message_time": Case(
+                When(is_newer, then=Value(message.time)),
+                default=F("last_message_time"),
+                output_field=models.DateTimeField()
+            ),
+            "last_text": Case(
+                When(is_newer, then=Value(message.text)),
+                default=F("last_text"),
+                output_field=models.CharField()
+            ),
+            "is_deleted": False,
+            "updated_at": timezone.now()
+        }
+
+        if summaries.update(**update_values) == 0:
+            try:
+                with transaction.atomic(using=self.db):
+                    self.create(
+                        owner_id=owner_id,
+                        interlocutor_id=interlocutor_id,
+                        last_message_time=message.time,
+                        last_text=message.text,
+                        unread_count=unread_increment,
+                        is_deleted=False,
+                        updated_at=timezone.now()
+                    )
+            except IntegrityError:
+                # A concurrent message has just created the row
+                summaries.update(**update_values)
+
+    def mark_as_read(self, owner_id, interlocutor_id):
         self.filter(
-            sender_id=user1_id,
-            receiver_id=user2_id,
-            is_deleted_by_sender=False
-        ).update(is_deleted_by_sender=True)
+            owner_id=owner_id,
+            interlocutor_id=interlocutor_id
+        ).update(unread_count=0, updated_at=timezone.now())
+
+    def mark_as_deleted(self, owner_id, interlocutor_id):
         self.filter(
-            sender_id=user2_id,
-            receiver_id=user1_id,
-            is_deleted_by_receiver=False
-        ).update(is_deleted_by_receiver=True)
+            owner_id=owner_id,
+            interlocutor_id=interlocutor_id
+        ).update(
+            is_deleted=True,
+            unread_count=0,
+            updated_at=timezone.now()
+        )
+
+    def rebuild(self, owner_id):
+        # It's impossible to import as usually
+        from .models import Message
+
+        last_messages = Message.objects.get_last_dialogs_messages(owner_id)
+        unread_counts = Message.objects.get_unread_counts(owner_id)
 
+        summaries = []
+        for message in last_messages:
+            interlocutor_id = message["interlocutor_id"]
+            summaries.append(self.model(
+                owner_id=owner_id,
+                interlocutor_id=interlocutor_id,
+                last_message_time=message["time"],
+                last_text=message["text"],
+                unread_count=unread_counts.get(interlocutor_id, 0)
+            ))
 
-class DialogIntegrityManager:
+        with transaction.atomic(using=self.db):
+            self.filter(owner_id=owner_id).delete()
+            self.bulk_create(summaries)
+
+        return len(summaries)
+
+
+class DialogIntegrityManager(RedisManager):
     def __init__(self, user_id, interlocutor_id):
         # It's impossible to import as usually
         from .models import Message
 
         self.user_id = user_id
         self.interlocutor_id = interlocutor_id
-        self.key = "di_{}-{}".format(
+        self.key = "dib_{}-{}".format(
             self.user_id,
             self.interlocutor_id
         )
         self.messages_manager = Message.objects
-        self.redis_cache = redis.Redis(
-            decode_responses=True,
-            db=settings.FS_REDIS_DB
-        )
         self.timeout = settings.FS_DIALOG_INTEGRITY_TIMEOUT
 
     async def get_hash(self):
-        hash_str = self.redis_cache.get(self.key)
-        if hash_str is None:
-            _, hash_ = await self.get_messages()
+        return combine_hashes((await self.get_buckets()).values())
+
+    async def get_buckets(self):
+        buckets = await self.get_cached(
+            self.key,
+            lambda: self.redis_cache.hgetall(self.key)
+        )
+        if buckets == {}:
+            buckets = await self.rebuild_buckets()
         else:
-            hash_ = int(hash_str)
+            # It's needed because of Redis architecture
+            del buckets[""]
+            for bucket, hash_ in buckets.items():
+                buckets[bucket] = int(hash_)
 
-        return hash_
+        return buckets
 
     async def get_messages(self):
         messages = await sync_to_async(
@@ -141,85 +642,139 @@ class DialogIntegrityManager:
             self.interlocutor_id
         )
 
-        hash_ = 0
-        for message in messages:
-            hash_ += hash_time(message.time)
+        return messages, await self.set_buckets(hash_buckets(messages))
 
-        self.redis_cache.setex(
-            self.key,
-            self.timeout,
-            hash_
+    async def rebuild_buckets(self):
+        buckets = await sync_to_async(
+            self.messages_manager.get_dialog_buckets
+        )(
+            self.user_id,
+            self.interlocutor_id,
+            settings.FS_MESSAGES_CHUNK_SIZE
         )
+        await self.set_buckets(buckets)
 
-        return messages, hash_
+        return buckets
 
-    async def add_to_hash(self, time):
-        self.redis_cache.incrby(self.key, hash_time(time))
+    async def stream_messages(self, chunk_size):
+        chunks = self.messages_manager.iter_dialog_messages(
+            self.user_id,
+            self.interlocutor_id,
+            chunk_size
+        )
+        buckets = dict()
+        try:
+            while True:
+                # The cursor lives in the thread of sync_to_async
+                chunk = await sync_to_async(next)(chunks, None)
+                if chunk is None:
+                    break
 
-    async def delete(self):
-        self.redis_cache.setex(
-            self.key,
-            self.timeout,
-            0
+                for bucket, hash_ in hash_buckets(chunk).items():
+                    buckets[bucket] = combine_hashes([
+                        buckets.get(bucket, 0),
+                        hash_
+                    ])
+                yield chunk
+        finally:
+            await sync_to_async(chunks.close)()
+
+        await self.set_buckets(buckets)
+
+    async def set_buckets(self, buckets):
+        buckets = dict(buckets)
+        # It's needed because of Redis architecture
+        buckets[""] = 0
+
+        async with self.redis_cache.pipeline() as pipeline:
+            pipeline.delete(self.key)
+            pipeline.hset(self.key, mapping=buckets)
+            pipeline.expire(name=self.key, time=self.timeout)
+            await pipeline.execute()
+        await self.invalidate(self.key)
+
+        return combine_hashes(buckets.values())
+
+    async def add_to_hash(self, message):
+        await self.run_script(
+            ADD_TO_BUCKET_SCRIPT,
+            [self.key],
+            [
+                hash_bucket(message.time),
+                hash_message(message.id, message.time),
+                HASH_MODULUS
+            ]
         )
+        await self.invalidate(self.key)
+
+    async def drop(self):
+        # The hash is rebuilt from the database when it's needed
+        await self.redis_cache.delete(self.key)
+        await self.invalidate(self.key)
+
+    async def delete(self):
+        await self.redis_cache.delete(self.key)
+        # It's needed because of Redis architecture
+        await self.redis_cache.hset(self.key, "", 0)
+        await self.redis_cache.expire(name=self.key, time=self.timeout)
+        await self.invalidate(self.key)
 
 
-class DialogsIntegrityManager:
+class DialogsIntegrityManager(RedisManager):
     def __init__(self, user_id):
         # It's impossible to import as usually
+        from .models import Dialog
         from .models import Message
 
         self.user_id = user_id
         self.key = "dsi_{}".format(self.user_id)
         self.messages_manager = Message.objects
+        self.dialogs_manager = Dialog.objects
         self.uds_manager = UnreadDialogsManager(self.user_id)
-        self.redis_cache = redis.Redis(
-            decode_responses=True,
-            db=settings.FS_REDIS_DB
-        )
         self.timeout = settings.FS_DIALOGS_INTEGRITY_TIMEOUT
 
     async def get_hash(self):
-        dialogs_hashes = self.redis_cache.hgetall(self.key)
+        dialogs_hashes = await self.get_cached(
+            self.key,
+            lambda: self.redis_cache.hgetall(self.key)
+        )
 
         if dialogs_hashes == {}:
             _, dialogs_hashes, _ = await self.get_dialogs()
 
-        hash_ = 0
-        for dialog_hash in dialogs_hashes.values():
-            hash_ += int(dialog_hash)
-
-        hash_ += await self.uds_manager.get_number()
-
-        return hash_
+        return combine_hashes([
+            *dialogs_hashes.values(),
+            await self.uds_manager.get_number()
+        ])
 
     async def get_dialogs(self):
         dialogs, dialogs_hashes, uds_set = await sync_to_async(
-            self.messages_manager.get_dialogs
+            self.dialogs_manager.get_dialogs
         )(self.user_id)
 
         # It's needed because of Redis architecture
         dialogs_hashes[""] = 0
 
-        self.redis_cache.delete(self.key)
-        self.redis_cache.hset(
-            self.key,
-            mapping=dialogs_hashes
-        )
-        self.redis_cache.expire(name=self.key, time=self.timeout)
+        async with self.redis_cache.pipeline() as pipeline:
+            pipeline.delete(self.key)
+            pipeline.hset(self.key, mapping=dialogs_hashes)
+            pipeline.expire(name=self.key, time=self.timeout)
+            await pipeline.execute()
+        await self.invalidate(self.key)
 
         return dialogs, dialogs_hashes, uds_set
 
     async def consider_new(self, dialog_id, dialog_hash):
         mapping = {dialog_id: dialog_hash}
-        if not self.redis_cache.exists(self.key):
+        if not await self.redis_cache.exists(self.key):
             # It's needed because of Redis architecture
             mapping[""] = 0
 
-        self.redis_cache.hset(
+        await self.redis_cache.hset(
             self.key,
             mapping=mapping
         )
+        await self.invalidate(self.key)
 
     async def mark_as_read(self, dialog_id):
         await sync_to_async(
@@ -230,29 +785,29 @@ class DialogsIntegrityManager:
         await sync_to_async(
             self.messages_manager.mark_dialog_messages_as_deleted
         )(self.user_id, dialog_id)
-        self.redis_cache.hdel(self.key, dialog_id)
+        await self.redis_cache.hdel(self.key, dialog_id)
+        await self.invalidate(self.key)
 
 
-class UnreadDialogsManager:
+class UnreadDialogsManager(RedisManager):
     def __init__(self, user_id):
         # It's impossible to import as usually
-        from .models import Message
+        from .models import Dialog
 
         self.user_id = user_id
         self.key = "uds_{}".format(self.user_id)
-        self.messages_manager = Message.objects
-        self.redis_cache = redis.Redis(
-            decode_responses=True,
-            db=settings.FS_REDIS_DB
-        )
+        self.dialogs_manager = Dialog.objects
         self.timeout = settings.FS_UNREAD_DIALOGS_TIMEOUT
 
     async def get_number(self):
-        pre_uds_number = self.redis_cache.scard(self.key)
+        pre_uds_number = await self.get_cached(
+            self.key,
+            lambda: self.redis_cache.scard(self.key)
+        )
 
         if pre_uds_number == 0:
             uds_set = await sync_to_async(
-                self.messages_manager.get_unread_dialogs_set
+                self.dialogs_manager.get_unread_dialogs_set
             )(self.user_id)
             uds_number = len(uds_set)
 
@@ -263,30 +818,250 @@ class UnreadDialogsManager:
 
         return uds_number
 
+    def exist(self):
+        return self.sync.get_number() != 0
+
     async def reset(self, uds_set, maybe_exists=True):
-        if maybe_exists:
-            self.redis_cache.delete(self.key)
+        async with self.redis_cache.pipeline() as pipeline:
+            if maybe_exists:
+                pipeline.delete(self.key)
 
-        # It's needed because of Redis architecture
-        self.redis_cache.sadd(self.key, "")
+            # It's needed because of Redis architecture
+            pipeline.sadd(self.key, "")
 
-        if len(uds_set) != 0:
-            self.redis_cache.sadd(self.key, *uds_set)
+            if len(uds_set) != 0:
+                pipeline.sadd(self.key, *uds_set)
+            await pipeline.execute()
+        await self.invalidate(self.key)
 
     async def add_dialog(self, id):
-        if not self.redis_cache.exists(self.key):
+        if not await self.redis_cache.exists(self.key):
             # It's needed because of Redis architecture
-            self.redis_cache.sadd(self.key, "")
+            await self.redis_cache.sadd(self.key, "")
 
-        self.redis_cache.sadd(self.key, id)
+        await self.redis_cache.sadd(self.key, id)
+        await self.invalidate(self.key)
+
+    async def has_dialog(self, id):
+        if not await self.redis_cache.exists(self.key):
+            await self.get_number()
+
+        return await self.redis_cache.sismember(self.key, id)
 
     async def mark_as_read(self, id):
-        self.redis_cache.srem(self.key, id)
+        await self.redis_cache.srem(self.key, id)
+        await self.invalidate(self.key)
+
+
+class DeletedUsersManager:
+    # Remembers ids of users which don't exist, so pages of dead
+    # dialogs don't query the users' table again. Ids aren't reused,
+    # so every process keeps its own set and pages of live dialogs
+    # don't wait for Redis
+    expiration_times = dict()
+    lock = threading.Lock()
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.timeout = settings.FS_DELETED_USERS_TIMEOUT
+
+    def exists(self):
+        with self.lock:
+            expiration_time = self.expiration_times.get(self.user_id)
+            if expiration_time is None:
+                return False
+
+            if expiration_time < timezone.now():
+                del self.expiration_times[self.user_id]
+                return False
+
+            return True
+
+    def add(self):
+        now = timezone.now()
+        with self.lock:
+            for user_id, expiration_time in list(
+                self.expiration_times.items()
+            ):
+                if expiration_time < now:
+                    del self.expiration_times[user_id]
+
+            self.expiration_times[self.user_id] = now + timedelta(
+                seconds=self.timeout
+            )
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.expiration_times.clear()
+
+
+class NewMessageManager(RedisManager):
+    def __init__(self, sender_id, receiver_id):
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.i_manager = DialogIntegrityManager(sender_id, receiver_id)
+        self.i_manager2 = DialogIntegrityManager(receiver_id, sender_id)
+        self.dsi_manager = DialogsIntegrityManager(sender_id)
+        self.dsi_manager2 = DialogsIntegrityManager(receiver_id)
+
+    async def prepare(self):
+        # A queued message isn't in the database yet, so missing keys
+        # have to be built before the message is considered
+        await asyncio.gather(
+            self.i_manager.get_hash(),
+            self.i_manager2.get_hash(),
+            self.dsi_manager.get_hash(),
+            self.dsi_manager2.get_hash()
+        )
+
+    async def consider(self, message):
+        keys = [
+            self.i_manager.key,
+            self.dsi_manager.key,
+            self.dsi_manager.uds_manager.key,
+            self.i_manager2.key,
+            self.dsi_manager2.key,
+            self.dsi_manager2.uds_manager.key
+        ]
+        hashes = await self.run_script(
+            NEW_MESSAGE_SCRIPT,
+            keys,
+            [
+                self.sender_id,
+                self.receiver_id,
+                hash_message(message.id, message.time),
+                hash_bucket(message.time),
+                hash_dialog(self.receiver_id, message.time),
+                hash_dialog(self.sender_id, message.time),
+                HASH_MODULUS
+            ]
+        )
+        await self.invalidate(*keys)
+
+        # Keys which were missing are rebuilt from the database
+        managers = [
+            self.i_manager, self.i_manager2,
+            self.dsi_manager, self.dsi_manager2
+        ]
+        missing_indexes = [i for i, hash_ in enumerate(hashes) if hash_ is None]
+        missing_hashes = await asyncio.gather(*[
+            managers[i].get_hash() for i in missing_indexes
+        ])
+        for i, hash_ in zip(missing_indexes, missing_hashes):
+            hashes[i] = hash_
+
+        return hashes
+
+
+def get_conversation_id(user1_id, user2_id):
+    return (
+        min(user1_id, user2_id)*CONVERSATION_ID_SHIFT
+        + max(user1_id, user2_id)
+    )
+
+
+def get_conversation_id_expression():
+    return Case(
+        When(
+            sender_id__lt=F("receiver_id"),
+            then=F("sender_id")*CONVERSATION_ID_SHIFT + F("receiver_id")
+        ),
+        default=F("receiver_id")*CONVERSATION_ID_SHIFT + F("sender_id"),
+        output_field=models.BigIntegerField()
+    )
+
+
+def backfill_conversation_ids(messages, batch_size, last_id=0):
+    # Batches are short and walk the primary key,
+    # so it can run on a large table while it's used
+    ids = list(messages.filter(
+        id__gt=last_id,
+        conversation_id__isnull=True
+    ).order_by("id").values_list("id", flat=True)[:batch_size])
+    if len(ids) == 0:
+        return 0, last_id
+
+    messages.filter(id__in=ids).update(
+        conversation_id=get_conversation_id_expression()
+    )
+
+    return len(ids), ids[-1]
+
+
+def hash_message(message_id, time):
+    return hash_string("m{}_{}".format(message_id, encode_time(time)))
 
 
 def hash_dialog(dialog_id, time):
-    return dialog_id + hash_time(time)
+    return hash_string("d{}_{}".format(dialog_id, encode_time(time)))
+
+
+def hash_string(string):
+    return int.from_bytes(
+        hashlib.blake2b(string.encode(), digest_size=6).digest(),
+        "big"
+    )
+
+
+def combine_hashes(hashes):
+    return sum(int(hash_) for hash_ in hashes) % HASH_MODULUS
+
+
+def hash_bucket(time):
+    return time.astimezone(pytz.utc).strftime(HASH_BUCKET_FORMAT)
+
+
+def decode_bucket(bucket):
+    return timezone.make_aware(
+        timezone.datetime.strptime(str(bucket), HASH_BUCKET_FORMAT),
+        timezone=pytz.utc
+    )
+
+
+def hash_buckets(messages):
+    buckets = dict()
+    for message in messages:
+        bucket = hash_bucket(message.time)
+        buckets[bucket] = combine_hashes([
+            buckets.get(bucket, 0),
+            hash_message(message.id, message.time)
+        ])
+
+    return buckets
+
+
+def summary_as_dict(summary):
+    return {
+        "id": summary["interlocutor_id"],
+        "text": summary["last_text"],
+        "is_unread": summary["unread_count"] > 0,
+        "hash": hash_dialog(
+            summary["interlocutor_id"],
+            summary["last_message_time"]
+        )
+    }
+
+
+def encode_time(time):
+    return time.astimezone(pytz.utc).strftime(CURSOR_TIME_FORMAT)
+
+
+def decode_time(time_str):
+    return timezone.make_aware(
+        timezone.datetime.strptime(str(time_str), CURSOR_TIME_FORMAT),
+        timezone=pytz.utc
+    )
+
+
+def encode_cursor(message):
+    return "{}_{}".format(encode_time(message.time), message.id)
+
 
+def decode_cursor(cursor):
+    try:
+        time_str, id_str = str(cursor).split("_")
 
-def hash_time(time):
-    return time.hour*3600 + time.minute*60 + time.second
+        return decode_time(time_str), int(id_str)
+    except ValueError:
+        raise ValueError("{} isn't a valid cursor".format(cursor))
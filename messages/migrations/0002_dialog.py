@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_messages', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Dialog',
+            fields=[
+                ('id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('owner_id', models.IntegerField(editable=False)),
+                ('interlocutor_id', models.IntegerField(editable=False)),
+                ('last_message_time', models.DateTimeField(editable=False)),
+                ('last_text', models.CharField(editable=False, max_length=400)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('is_deleted', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dialog',
+            index=models.Index(fields=['owner_id', '-last_message_time'], name='dialog_owner_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dialog',
+            index=models.Index(fields=['owner_id', 'updated_at'], name='dialog_owner_updated_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dialog',
+            constraint=models.UniqueConstraint(fields=('owner_id', 'interlocutor_id'), name='unique_dialog_owner_interlocutor'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_messages', '0002_dialog'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender_id', 'receiver_id', 'time'], name='message_sender_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver_id', 'sender_id', 'time'], name='message_receiver_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_deleted_by_receiver', False), ('is_unread', True)), fields=['receiver_id', 'sender_id'], name='message_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations
+from django.db import models
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import When
+
+
+BATCH_SIZE = 1000
+CONVERSATION_ID_SHIFT = 2**32
+
+
+def backfill(apps, schema_editor):
+    Message = apps.get_model("custom_messages", "Message")
+    messages = Message.objects.using(schema_editor.connection.alias)
+
+    conversation_id = Case(
+        When(
+            sender_id__lt=F("receiver_id"),
+            then=F("sender_id")*CONVERSATION_ID_SHIFT + F("receiver_id")
+        ),
+        default=F("receiver_id")*CONVERSATION_ID_SHIFT + F("sender_id"),
+        output_field=models.BigIntegerField()
+    )
+
+    last_id = 0
+    while True:
+        ids = list(messages.filter(
+            id__gt=last_id,
+            conversation_id__isnull=True
+        ).order_by("id").values_list("id", flat=True)[:BATCH_SIZE])
+        if len(ids) == 0:
+            break
+
+        messages.filter(id__in=ids).update(conversation_id=conversation_id)
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    # Every batch is committed on its own
+    atomic = False
+
+    dependencies = [
+        ("custom_messages", "0004_message_conversation_id"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:32
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_messages', '0005_backfill_conversation_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:44
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_messages', '0006_message_time_default'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_sender_receiver_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_receiver_sender_idx',
+        ),
+    ]
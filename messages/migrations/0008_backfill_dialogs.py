@@ -0,0 +1,93 @@
+from django.db import migrations
+from django.db import transaction
+
+
+BATCH_SIZE = 1000
+CHUNK_SIZE = 2000
+
+
+def backfill(apps, schema_editor):
+    Dialog = apps.get_model("custom_messages", "Dialog")
+    Message = apps.get_model("custom_messages", "Message")
+    alias = schema_editor.connection.alias
+    messages = Message.objects.using(alias)
+
+    # Conversations are walked in batches, and every batch
+    # of summaries is committed on its own
+    last_conversation_id = -1
+    while True:
+        conversation_ids = list(messages.filter(
+            conversation_id__gt=last_conversation_id
+        ).order_by("conversation_id").values_list(
+            "conversation_id",
+            flat=True
+        ).distinct()[:BATCH_SIZE])
+        if len(conversation_ids) == 0:
+            break
+
+        summaries = dict()
+        for message in messages.filter(
+            conversation_id__in=conversation_ids
+        ).values(
+            "id", "time", "sender_id", "receiver_id", "text", "is_unread",
+            "is_deleted_by_sender", "is_deleted_by_receiver"
+        ).iterator(chunk_size=CHUNK_SIZE):
+            for owner_id, interlocutor_id, is_visible, is_unread in [
+                (
+                    message["sender_id"],
+                    message["receiver_id"],
+                    not message["is_deleted_by_sender"],
+                    False
+                ),
+                (
+                    message["receiver_id"],
+                    message["sender_id"],
+                    not message["is_deleted_by_receiver"],
+                    message["is_unread"]
+                )
+            ]:
+                if not is_visible:
+                    continue
+
+                summary = summaries.get((owner_id, interlocutor_id))
+                if summary is None:
+                    summary = summaries[(owner_id, interlocutor_id)] = {
+                        "last_message": message,
+                        "unread_count": 0
+                    }
+                elif (
+                    (summary["last_message"]["time"],
+                     summary["last_message"]["id"])
+                    < (message["time"], message["id"])
+                ):
+                    summary["last_message"] = message
+                if is_unread:
+                    summary["unread_count"] += 1
+
+        with transaction.atomic(using=alias):
+            # Summaries which are maintained already are kept
+            Dialog.objects.using(alias).bulk_create([
+                Dialog(
+                    owner_id=owner_id,
+                    interlocutor_id=interlocutor_id,
+                    last_message_time=summary["last_message"]["time"],
+                    last_text=summary["last_message"]["text"],
+                    unread_count=summary["unread_count"]
+                )
+                for (owner_id, interlocutor_id), summary in summaries.items()
+            ], ignore_conflicts=True)
+
+        last_conversation_id = conversation_ids[-1]
+
+
+class Migration(migrations.Migration):
+    # Every batch is committed on its own
+    atomic = False
+
+    dependencies = [
+        ("custom_messages", "0007_remove_message_pair_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -1,15 +1,20 @@
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
-from .managers import hash_time
+from .managers import DialogsManager
+from .managers import get_conversation_id
+from .managers import hash_bucket
+from .managers import hash_message
 from .managers import MessagesManager
 
 
 class Message(models.Model):
     id = models.AutoField(primary_key=True, editable=False)
-    time = models.DateTimeField(auto_now=True, editable=False)
+    time = models.DateTimeField(default=timezone.now, editable=False)
     sender_id = models.IntegerField(editable=False, db_index=True)
     receiver_id = models.IntegerField(editable=False, db_index=True)
+    conversation_id = models.BigIntegerField(editable=False, null=True)
     text = models.CharField(
         max_length=settings.FS_MAX_MESSAGE_LENGTH,
         editable=False
@@ -20,6 +25,31 @@ class Message(models.Model):
 
     objects = MessagesManager()
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["receiver_id", "sender_id"],
+                condition=models.Q(
+                    is_unread=True,
+                    is_deleted_by_receiver=False
+                ),
+                name="message_unread_idx"
+            ),
+            models.Index(
+                fields=["conversation_id", "time"],
+                name="message_conversation_time_idx"
+            )
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.conversation_id is None:
+            self.conversation_id = get_conversation_id(
+                self.sender_id,
+                self.receiver_id
+            )
+
+        super().save(*args, **kwargs)
+
     def as_dict(self, current_user_id):
         if self.sender_id == current_user_id:
             user_owns_message = True
@@ -29,12 +59,51 @@ class Message(models.Model):
             is_unread = self.is_unread
 
         return {
+            "id": self.id,
             "time": self.time.strftime(settings.FS_TIME_FORMAT),
             "user_owns_message": user_owns_message,
             "is_unread": is_unread,
             "text": self.text,
-            "hash": hash_time(self.time)
+            "hash": hash_message(self.id, self.time),
+            "bucket": hash_bucket(self.time)
         }
 
     def __str__(self):
         return self.text
+
+
+class Dialog(models.Model):
+    id = models.AutoField(primary_key=True, editable=False)
+    owner_id = models.IntegerField(editable=False)
+    interlocutor_id = models.IntegerField(editable=False)
+    last_message_time = models.DateTimeField(editable=False)
+    last_text = models.CharField(
+        max_length=settings.FS_MAX_MESSAGE_LENGTH,
+        editable=False
+    )
+    unread_count = models.PositiveIntegerField(default=0)
+    is_deleted = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True, editable=False)
+
+    objects = DialogsManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["owner_id", "interlocutor_id"],
+                name="unique_dialog_owner_interlocutor"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["owner_id", "-last_message_time"],
+                name="dialog_owner_time_idx"
+            ),
+            models.Index(
+                fields=["owner_id", "updated_at"],
+                name="dialog_owner_updated_idx"
+            )
+        ]
+
+    def __str__(self):
+        return "{}-{}".format(self.owner_id, self.interlocutor_id)
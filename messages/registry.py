@@ -0,0 +1,103 @@
+import time
+
+from django.conf import settings
+
+from .cache import RedisManager
+
+
+# KEYS: registry key
+# ARGV: channel name, current time, expiration time, TTL, sessions limit.
+# Channels beyond the limit are removed from the ones
+# which have been refreshed the longest time ago
+ADD_SCRIPT = """
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[2])
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+
+local extra_number = redis.call("ZCARD", KEYS[1]) - tonumber(ARGV[5])
+if extra_number <= 0 then
+    return {}
+end
+
+local extra_channels_names = redis.call("ZRANGE", KEYS[1], 0, extra_number - 1)
+redis.call("ZREM", KEYS[1], unpack(extra_channels_names))
+
+return extra_channels_names
+"""
+
+
+class ConnectionRegistry(RedisManager):
+    # Channels of a group are kept in Redis rather than in the channel
+    # layer, so every worker process sees them. A channel is a member
+    # of the sorted set, its score is the time it expires at
+    def __init__(self, group_name):
+        self.group_name = group_name
+        self.key = "cr_{}".format(group_name)
+        self.ttl = settings.FS_CONNECTION_TTL
+
+    async def get_channels_names(self):
+        await self.redis_cache.zremrangebyscore(self.key, "-inf", time.time())
+
+        return await self.redis_cache.zrange(self.key, 0, -1)
+
+    async def add(self, channel_name, limit):
+        now = time.time()
+
+        return await self.run_script(
+            ADD_SCRIPT,
+            [self.key],
+            [channel_name, now, now + self.ttl, self.ttl, limit]
+        )
+
+    async def refresh(self, channel_name):
+        # An evicted channel isn't added again
+        is_refreshed = await self.redis_cache.zadd(
+            self.key,
+            {channel_name: time.time() + self.ttl},
+            xx=True,
+            ch=True
+        ) != 0
+        if is_refreshed:
+            await self.redis_cache.expire(name=self.key, time=self.ttl)
+
+        return is_refreshed
+
+    async def discard(self, channel_name):
+        await self.redis_cache.zrem(self.key, channel_name)
+
+
+class SessionState(RedisManager):
+    def __init__(self, channel_name):
+        self.channel_name = channel_name
+        self.key = "ss_{}".format(channel_name)
+        self.ttl = settings.FS_CONNECTION_TTL
+
+    async def create(self, user_id, group_name):
+        await self.redis_cache.hset(self.key, mapping={
+            "user_id": user_id,
+            "group_name": group_name,
+            "connected_at": time.time(),
+            "read_at": 0
+        })
+        await self.redis_cache.expire(name=self.key, time=self.ttl)
+
+    async def get(self):
+        return await self.redis_cache.hgetall(self.key)
+
+    async def refresh(self):
+        await self.redis_cache.expire(name=self.key, time=self.ttl)
+
+    async def set_read_at(self, read_at):
+        # A late receipt mustn't overwrite a newer one
+        if read_at > float(
+            await self.redis_cache.hget(self.key, "read_at") or 0
+        ):
+            await self.redis_cache.hset(self.key, "read_at", read_at)
+            await self.redis_cache.expire(name=self.key, time=self.ttl)
+
+            return True
+
+        return False
+
+    async def delete(self):
+        await self.redis_cache.delete(self.key)
@@ -0,0 +1,106 @@
+import json
+
+import msgpack
+from django.conf import settings
+
+from .managers import hash_bucket
+from .managers import hash_dialog
+from .managers import hash_message
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# WebSocket subprotocols which a client can ask for
+BINARY_PROTOCOL = "fs.msgpack"
+JSON_PROTOCOL = "fs.json"
+# Lists of records which are sent column by column in binary frames
+COLUMNAR_FIELDS = ["messages", "dialogs"]
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+
+    return json.dumps(data)
+
+
+def pack(data):
+    columnar_data = dict(data)
+    for field in COLUMNAR_FIELDS:
+        if isinstance(data.get(field), list):
+            columnar_data[field] = to_columns(data[field])
+
+    return msgpack.packb(columnar_data)
+
+
+def unpack(bytes_data):
+    return msgpack.unpackb(bytes_data)
+
+
+def to_columns(records):
+    if len(records) == 0:
+        return {}
+
+    return {
+        key: [record[key] for record in records]
+        for key in records[0]
+    }
+
+
+def make_payload_event(data):
+    # Most sessions use JSON, so it's encoded once for the whole group
+    # and binary sessions pack the data themselves
+    return {
+        "type": "send_payload",
+        "text": dumps(data),
+        "data": data
+    }
+
+
+class NewMessageSerializer:
+    # Fields which are the same for every recipient are built once,
+    # and every group gets an encoded payload
+    def __init__(self, message):
+        self.message = message
+        self.message_fields = {
+            "id": message.id,
+            "time": message.time.strftime(settings.FS_TIME_FORMAT),
+            "text": message.text,
+            "hash": hash_message(message.id, message.time),
+            "bucket": hash_bucket(message.time)
+        }
+
+    def get_dialog_event(self, user_id, integrity_hash):
+        user_owns_message = self.message.sender_id == user_id
+
+        return make_payload_event({
+            "command": "get_new_message",
+            "integrity_hash": integrity_hash,
+            "message": {
+                **self.message_fields,
+                "user_owns_message": user_owns_message,
+                "is_unread": (
+                    not user_owns_message and self.message.is_unread
+                )
+            }
+        })
+
+    def get_dialogs_event(self, user_id, integrity_hash):
+        if self.message.sender_id == user_id:
+            interlocutor_id = self.message.receiver_id
+        else:
+            interlocutor_id = self.message.sender_id
+
+        return make_payload_event({
+            "command": "get_new_message",
+            "dialog": {
+                "id": interlocutor_id,
+                "text": self.message.text,
+                "is_unread": self.message.receiver_id == user_id,
+                "hash": hash_dialog(interlocutor_id, self.message.time)
+            },
+            "integrity_hash": integrity_hash
+        })
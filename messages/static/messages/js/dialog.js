@@ -1,4 +1,6 @@
-import {CustomWebSocket, getWsUrl} from "./utils.js";
+import {
+    CustomWebSocket, combineHashes, getWsUrl, parseCommand
+} from "./utils.js";
 
 
 const wsUrl = getWsUrl();
@@ -7,7 +9,9 @@ let socket;
 const form = document.getElementById("form");
 const textInput = document.getElementById("id_text");
 const dialogHolder = document.getElementById("dialog-messages");
-const m = {unreadMessagesExist: false};
+const m = {unreadMessagesExist: false, hashOffset: 0};
+// More differing days are received as the whole history
+const MAX_MISSING_BUCKETS = 10;
 
 if (form !== null) {
     form.onsubmit = formOnSubmitHandler;
@@ -18,12 +22,12 @@ function formOnSubmitHandler(ev) {
     const messageText = textInput.value;
 
     console.info("Send new message");
-    socket.send(JSON.stringify({
+    socket.sendCommand({
         "command": "get_new_message",
         "message": {
             "text": messageText
         }
-    }));
+    });
     textInput.value = "";
 }
 
@@ -45,7 +49,7 @@ connect();
 
 function socketOnMessageHandler(ev) {
     console.info("ws message", ev);
-    const data = JSON.parse(ev.data);
+    const data = parseCommand(ev.data);
 
     if (!("command" in data)) {
         console.warn("invalid data");
@@ -76,13 +80,105 @@ function socketOnMessageHandler(ev) {
             }
             messagesNodes.push(m.createMessageNode(message));
         }
-        dialogHolder.replaceChildren(...messagesNodes);
+        // History comes in chunks, the first one replaces old messages
+        if (!data["chunk"]) {
+            m.hashOffset = 0;
+            dialogHolder.replaceChildren(...messagesNodes);
+        } else {
+            dialogHolder.append(...messagesNodes);
+        }
+    } else if (command === "get_messages_done") {
+        console.info("messages are received in chunks:", data["chunks"]);
+        if (document.hasFocus() && m.unreadMessagesExist) {
+            m.sendMarkDialogAsRead();
+        }
+    } else if (command === "get_missing_messages") {
+        console.info("missing messages:", data["messages"]);
+        for (const message of data["messages"]) {
+            if (m.messageNodeExists(message["id"])) {
+                continue;
+            }
+            if (message["is_unread"]) {
+                m.unreadMessagesExist = true;
+            }
+            dialogHolder.appendChild(m.createMessageNode(message));
+        }
 
         if (document.hasFocus() && m.unreadMessagesExist) {
             m.sendMarkDialogAsRead();
         }
+        m.checkIntegrity(
+            data["integrity_hash"],
+            data["is_complete"] ? "buckets" : "sync"
+        );
+    } else if (command === "get_integrity_buckets") {
+        const localBuckets = m.getIntegrityBuckets();
+        const serverBuckets = data["buckets"];
+        // Days before the rendered page are counted by the hash offset
+        const firstNode = document.querySelector(".message[data-bucket]");
+        const firstBucket = (
+            m.hashOffset !== 0 && firstNode !== null
+        ) ? firstNode.dataset.bucket : null;
+        const buckets = Object.keys(
+            {...localBuckets, ...serverBuckets}
+        ).filter(
+            bucket => localBuckets[bucket] !== serverBuckets[bucket]
+                && (firstBucket === null || bucket > firstBucket)
+        );
+
+        if (buckets.length > MAX_MISSING_BUCKETS) {
+            // Many days are restored by the chunked history
+            console.info("Send give_messages");
+            socket.sendCommand({
+                "command": "give_messages"
+            });
+        } else if (buckets.length !== 0) {
+            console.info("Send give_buckets_messages");
+            socket.sendCommand({
+                "command": "give_buckets_messages",
+                "buckets": buckets
+            });
+        } else {
+            m.checkIntegrity(data["integrity_hash"], "full");
+        }
+    } else if (command === "get_buckets_messages") {
+        console.info("buckets messages:", data["messages"]);
+        for (const bucket of data["buckets"]) {
+            document.querySelectorAll(
+                `.message[data-bucket="${bucket}"]`
+            ).forEach(messageNode => messageNode.remove());
+        }
+
+        for (const message of data["messages"]) {
+            if (message["is_unread"]) {
+                m.unreadMessagesExist = true;
+            }
+            // Buckets are days, so their names are ordered as time
+            const nextNode = Array.from(
+                document.querySelectorAll(".message[data-bucket]")
+            ).find(
+                messageNode => messageNode.dataset.bucket > message["bucket"]
+            );
+            dialogHolder.insertBefore(
+                m.createMessageNode(message),
+                nextNode || null
+            );
+        }
+
+        if (document.hasFocus() && m.unreadMessagesExist) {
+            m.sendMarkDialogAsRead();
+        }
+        m.checkIntegrity(data["integrity_hash"], "full");
+    } else if (command === "mark_dialog_as_read") {
+        // The dialog has been read in another session
+        m.unreadMessagesExist = false;
     } else if (command === "check_integrity") {
         m.checkIntegrity(data["integrity_hash"]);
+
+        // Rendered messages could be unread before the socket opened
+        if (document.hasFocus() && m.unreadMessagesExist) {
+            m.sendMarkDialogAsRead();
+        }
     } else if (command === "go_home") {
         window.location.href = "/account/";
     } else {
@@ -98,6 +194,12 @@ m.createMessageNode = function(message) {
     messageNode.classList.add("message");
     messageNode.dataset.hash = message["hash"];
     messageNode.dataset.time = message["time"] + "Z";
+    if (message["id"] !== undefined) {
+        messageNode.dataset.id = message["id"];
+    }
+    if (message["bucket"] !== undefined) {
+        messageNode.dataset.bucket = message["bucket"];
+    }
 
     let ownershipStr;
     if (message["user_owns_message"]) {
@@ -131,30 +233,108 @@ m.createMessageNode = function(message) {
 m.sendMarkDialogAsRead = function() {
     console.info("Send mark_dialog_as_read");
     m.unreadMessagesExist = false;
-    socket.send(JSON.stringify({
+    socket.sendCommand({
         "command": "mark_dialog_as_read"
-    }));
+    });
 };
 
 
-m.checkIntegrity = function(serverIntegrityHash) {
+m.messageNodeExists = function(messageId) {
+    return document.querySelector(
+        `.message[data-id="${messageId}"]`
+    ) !== null;
+};
+
+
+m.getLastMessageId = function() {
+    let lastMessageId = null;
+    document.querySelectorAll(".message[data-id]").forEach(
+        messageNode => {
+            const messageId = parseInt(messageNode.dataset.id, 10);
+            if (lastMessageId === null || messageId > lastMessageId) {
+                lastMessageId = messageId;
+            }
+        }
+    );
+
+    return lastMessageId;
+};
+
+
+m.getIntegrityBuckets = function() {
+    const buckets = {};
+    document.querySelectorAll(".message[data-bucket]").forEach(
+        messageNode => {
+            const bucket = messageNode.dataset.bucket;
+            buckets[bucket] = combineHashes(
+                [buckets[bucket] || 0, messageNode.dataset.hash]
+            );
+        }
+    );
+
+    return buckets;
+};
+
+
+// The stage is "sync", "buckets" or "full": every stage tries
+// to restore integrity with less data than the next one
+m.checkIntegrity = function(serverIntegrityHash, stage = "sync") {
     console.info("checkIntegrity");
-    let integrityHash = 0;
-    document.querySelectorAll(".message").forEach(
-        messageNode => integrityHash += parseInt(
-            messageNode.dataset.hash,
-            10
+    const integrityHash = combineHashes([
+        m.hashOffset,
+        ...Array.from(
+            document.querySelectorAll(".message"),
+            messageNode => messageNode.dataset.hash
         )
-    );
+    ]);
 
     if (integrityHash !== serverIntegrityHash) {
-        console.info("Send give_messages");
-        socket.send(JSON.stringify({
-            "command": "give_messages"
-        }));
+        const lastMessageId = m.getLastMessageId();
+
+        if (stage === "sync" && lastMessageId !== null) {
+            console.info("Send sync_messages");
+            socket.sendCommand({
+                "command": "sync_messages",
+                "last_message_id": lastMessageId
+            });
+        } else if (
+            stage !== "full"
+            && document.querySelector(".message[data-bucket]") !== null
+        ) {
+            console.info("Send give_integrity_buckets");
+            socket.sendCommand({
+                "command": "give_integrity_buckets"
+            });
+        } else {
+            console.info("Send give_messages");
+            socket.sendCommand({
+                "command": "give_messages"
+            });
+        }
+    }
+};
+
+
+// The last page is rendered by the server, so it's shown
+// before the socket is opened
+m.renderInitialMessages = function() {
+    const initialNode = document.getElementById("initial-messages");
+    if (initialNode === null) {
+        return;
+    }
+
+    const initialMessages = JSON.parse(initialNode.textContent);
+    m.hashOffset = initialMessages["hash_offset"];
+    for (const message of initialMessages["messages"]) {
+        if (message["is_unread"]) {
+            m.unreadMessagesExist = true;
+        }
+        dialogHolder.appendChild(m.createMessageNode(message));
     }
 };
 
+m.renderInitialMessages();
+
 
 ////////
 /* istanbul ignore next */
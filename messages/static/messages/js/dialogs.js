@@ -1,4 +1,6 @@
-import {CustomWebSocket, getWsUrl} from "./utils.js";
+import {
+    CustomWebSocket, combineHashes, getWsUrl, parseCommand
+} from "./utils.js";
 
 
 const wsUrl = getWsUrl();
@@ -7,7 +9,7 @@ let socket;
 const dialogsHolder = document.getElementById("dialogs");
 const dialogsLink = document.getElementById("dialogs-link");
 dialogsLink.classList.add("in-dialogs");
-const m = {};
+const m = {syncToken: null};
 
 ////////
 function connect() {
@@ -19,7 +21,7 @@ connect();
 
 function socketOnMessageHandler(ev) {
     console.info("ws message", ev);
-    const data = JSON.parse(ev.data);
+    const data = parseCommand(ev.data);
 
     if (!("command" in data)) {
         console.warn("invalid data");
@@ -45,13 +47,35 @@ function socketOnMessageHandler(ev) {
         m.updateDialogsLink();
         m.checkIntegrity(data["integrity_hash"]);
     } else if (command === "get_dialogs") {
-        const dialogs = data["dialogs"];
-        const dialogsNodes = [];
-        for (var dialog of dialogs) {
-            dialogsNodes.push(m.createDialogNode(dialog));
+        m.renderDialogs(data);
+    } else if (command === "get_changed_dialogs") {
+        for (const dialogId of data["deleted_dialogs_ids"]) {
+            const dialogNode = document.getElementById(dialogId);
+            if (dialogNode !== null) {
+                dialogNode.parentNode.removeChild(dialogNode);
+            }
         }
-        dialogsHolder.replaceChildren(...dialogsNodes);
+
+        // Dialogs come from the newest one, so they're prepended
+        // from the oldest one
+        for (const dialog of data["dialogs"].slice().reverse()) {
+            const dialogNode = document.getElementById(dialog["id"]);
+
+            if (
+                dialogNode !== null
+                && dialogNode.dataset.hash === String(dialog["hash"])
+            ) {
+                dialogNode.replaceWith(m.createDialogNode(dialog));
+            } else {
+                if (dialogNode !== null) {
+                    dialogNode.parentNode.removeChild(dialogNode);
+                }
+                dialogsHolder.prepend(m.createDialogNode(dialog));
+            }
+        }
+        m.syncToken = data["sync_token"];
         m.updateDialogsLink();
+        m.checkIntegrity(data["integrity_hash"], false);
     } else if (command === "mark_dialog_as_read") {
         const dialog = document.getElementById(data["dialog_id"]);
         dialog.firstChild.classList.remove("is-unread");
@@ -71,10 +95,10 @@ function socketOnMessageHandler(ev) {
 m.sendDeleteDialog = function(ev) {
     console.info("Send delete_dialog");
     ev.preventDefault();
-    socket.send(JSON.stringify({
+    socket.sendCommand({
         "command": "delete_dialog",
         "dialog_id": ev["srcElement"].id
-    }));
+    });
 };
 
 
@@ -111,26 +135,42 @@ m.createDialogNode = function(dialog) {
 };
 
 
-m.checkIntegrity = function(serverIntegrityHash) {
+m.checkIntegrity = function(serverIntegrityHash, syncIsAllowed = true) {
     console.info("checkIntegrity");
-    let integrityHash = 0;
-    document.querySelectorAll(".dialog").forEach(
-        dialogNode => {
-            integrityHash += parseInt(
-                dialogNode.dataset.hash,
-                10
-            );
-        }
-    );
     const unreadDialogsNumber = document.querySelectorAll(".is-unread").length;
-    integrityHash += unreadDialogsNumber;
+    const integrityHash = combineHashes([
+        ...Array.from(
+            document.querySelectorAll(".dialog"),
+            dialogNode => dialogNode.dataset.hash
+        ),
+        unreadDialogsNumber
+    ]);
 
     if (integrityHash !== serverIntegrityHash) {
-        console.info("Send give_dialogs");
-        socket.send(JSON.stringify({
-            "command": "give_dialogs"
-        }));
+        if (syncIsAllowed && m.syncToken) {
+            console.info("Send sync_dialogs");
+            socket.sendCommand({
+                "command": "sync_dialogs",
+                "since": m.syncToken
+            });
+        } else {
+            console.info("Send give_dialogs");
+            socket.sendCommand({
+                "command": "give_dialogs"
+            });
+        }
+    }
+};
+
+
+m.renderDialogs = function(data) {
+    const dialogsNodes = [];
+    for (const dialog of data["dialogs"]) {
+        dialogsNodes.push(m.createDialogNode(dialog));
     }
+    dialogsHolder.replaceChildren(...dialogsNodes);
+    m.syncToken = data["sync_token"];
+    m.updateDialogsLink();
 };
 
 
@@ -152,6 +192,18 @@ m.updateDialogsLink = function() {
 };
 
 
+// Dialogs are rendered by the server, so they're shown
+// before the socket is opened
+m.renderInitialDialogs = function() {
+    const initialNode = document.getElementById("initial-dialogs");
+    if (initialNode !== null) {
+        m.renderDialogs(JSON.parse(initialNode.textContent));
+    }
+};
+
+m.renderInitialDialogs();
+
+
 ////////
 /* istanbul ignore next */
 if (navigator.userAgent.includes("jsdom")) {
@@ -1,6 +1,13 @@
+// WebSocket subprotocols in order of preference
+const BINARY_PROTOCOL = "fs.msgpack";
+const JSON_PROTOCOL = "fs.json";
+// Lists of records which are sent column by column in binary frames
+const COLUMNAR_FIELDS = ["messages", "dialogs"];
+
 class CustomWebSocket extends WebSocket {
     constructor(url, connect) {
-        super(url);
+        super(url, [BINARY_PROTOCOL, JSON_PROTOCOL]);
+        this.binaryType = "arraybuffer";
 
         this.onopen = function(e) {
             console.info("ws open", e);
@@ -16,6 +23,250 @@ class CustomWebSocket extends WebSocket {
             console.error("ws error", e);
         };
     }
+
+    sendCommand(data) {
+        if (this.protocol === BINARY_PROTOCOL) {
+            this.send(encodeMsgpack(data));
+        } else {
+            this.send(JSON.stringify(data));
+        }
+    }
+}
+
+function parseCommand(data) {
+    if (typeof data === "string") {
+        return JSON.parse(data);
+    }
+
+    const command = decodeMsgpack(data);
+    for (const field of COLUMNAR_FIELDS) {
+        const columns = command[field];
+        if (columns !== null && typeof columns === "object"
+                && !Array.isArray(columns)) {
+            command[field] = fromColumns(columns);
+        }
+    }
+
+    return command;
+}
+
+function fromColumns(columns) {
+    const keys = Object.keys(columns);
+    const length = keys.length === 0 ? 0 : columns[keys[0]].length;
+    const records = [];
+    for (let i = 0; i < length; i++) {
+        const record = {};
+        for (const key of keys) {
+            record[key] = columns[key][i];
+        }
+        records.push(record);
+    }
+
+    return records;
+}
+
+// MessagePack encoder of the types which commands consist of
+function encodeMsgpack(value) {
+    const bytes = [];
+    const textEncoder = new TextEncoder();
+
+    function pushUint(number, size) {
+        for (let i = size - 1; i >= 0; i--) {
+            bytes.push(Math.floor(number / 2 ** (8 * i)) % 256);
+        }
+    }
+
+    function pushHeader(length, fixPrefix, fixMax, prefix16, prefix32) {
+        if (length <= fixMax) {
+            bytes.push(fixPrefix | length);
+        } else if (length < 2 ** 16) {
+            bytes.push(prefix16);
+            pushUint(length, 2);
+        } else {
+            bytes.push(prefix32);
+            pushUint(length, 4);
+        }
+    }
+
+    function encode(x) {
+        if (x === null || x === undefined) {
+            bytes.push(0xc0);
+        } else if (x === false) {
+            bytes.push(0xc2);
+        } else if (x === true) {
+            bytes.push(0xc3);
+        } else if (typeof x === "number") {
+            if (Number.isSafeInteger(x) && x >= 0) {
+                if (x < 128) {
+                    bytes.push(x);
+                } else if (x < 2 ** 32) {
+                    bytes.push(0xce);
+                    pushUint(x, 4);
+                } else {
+                    bytes.push(0xcf);
+                    pushUint(x, 8);
+                }
+            } else if (Number.isSafeInteger(x) && x >= -32) {
+                bytes.push(x & 0xff);
+            } else if (Number.isSafeInteger(x) && x >= -(2 ** 31)) {
+                bytes.push(0xd2);
+                pushUint(x >>> 0, 4);
+            } else {
+                const view = new DataView(new ArrayBuffer(8));
+                view.setFloat64(0, x);
+                bytes.push(0xcb);
+                new Uint8Array(view.buffer).forEach((byte) => bytes.push(byte));
+            }
+        } else if (typeof x === "string") {
+            const encoded = textEncoder.encode(x);
+            if (encoded.length < 2 ** 5) {
+                bytes.push(0xa0 | encoded.length);
+            } else if (encoded.length < 2 ** 8) {
+                bytes.push(0xd9, encoded.length);
+            } else if (encoded.length < 2 ** 16) {
+                bytes.push(0xda);
+                pushUint(encoded.length, 2);
+            } else {
+                bytes.push(0xdb);
+                pushUint(encoded.length, 4);
+            }
+            encoded.forEach((byte) => bytes.push(byte));
+        } else if (Array.isArray(x)) {
+            pushHeader(x.length, 0x90, 15, 0xdc, 0xdd);
+            x.forEach(encode);
+        } else {
+            const keys = Object.keys(x);
+            pushHeader(keys.length, 0x80, 15, 0xde, 0xdf);
+            for (const key of keys) {
+                encode(key);
+                encode(x[key]);
+            }
+        }
+    }
+
+    encode(value);
+
+    return new Uint8Array(bytes);
+}
+
+function decodeMsgpack(buffer) {
+    const view = new DataView(
+        buffer instanceof ArrayBuffer ? buffer : buffer.buffer,
+        buffer instanceof ArrayBuffer ? 0 : buffer.byteOffset
+    );
+    const textDecoder = new TextDecoder();
+    let offset = 0;
+
+    function readUint(size) {
+        let number = 0;
+        for (let i = 0; i < size; i++) {
+            number = number * 256 + view.getUint8(offset++);
+        }
+
+        return number;
+    }
+
+    function readStr(length) {
+        const bytes = new Uint8Array(
+            view.buffer, view.byteOffset + offset, length
+        );
+        offset += length;
+
+        return textDecoder.decode(bytes);
+    }
+
+    function readArray(length) {
+        const array = [];
+        for (let i = 0; i < length; i++) {
+            array.push(decode());
+        }
+
+        return array;
+    }
+
+    function readMap(length) {
+        const map = {};
+        for (let i = 0; i < length; i++) {
+            const key = decode();
+            map[key] = decode();
+        }
+
+        return map;
+    }
+
+    function decode() {
+        const byte = view.getUint8(offset++);
+        if (byte < 0x80) {
+            return byte;
+        } else if (byte < 0x90) {
+            return readMap(byte & 0x0f);
+        } else if (byte < 0xa0) {
+            return readArray(byte & 0x0f);
+        } else if (byte < 0xc0) {
+            return readStr(byte & 0x1f);
+        } else if (byte >= 0xe0) {
+            return byte - 0x100;
+        }
+
+        let value;
+        switch (byte) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xca:
+                value = view.getFloat32(offset);
+                offset += 4;
+                return value;
+            case 0xcb:
+                value = view.getFloat64(offset);
+                offset += 8;
+                return value;
+            case 0xcc: return readUint(1);
+            case 0xcd: return readUint(2);
+            case 0xce: return readUint(4);
+            // Hashes are smaller than 2^53, so they are exact
+            case 0xcf: return readUint(8);
+            case 0xd0:
+                value = view.getInt8(offset);
+                offset += 1;
+                return value;
+            case 0xd1:
+                value = view.getInt16(offset);
+                offset += 2;
+                return value;
+            case 0xd2:
+                value = view.getInt32(offset);
+                offset += 4;
+                return value;
+            case 0xd3:
+                value = Number(view.getBigInt64(offset));
+                offset += 8;
+                return value;
+            case 0xd9: return readStr(readUint(1));
+            case 0xda: return readStr(readUint(2));
+            case 0xdb: return readStr(readUint(4));
+            case 0xdc: return readArray(readUint(2));
+            case 0xdd: return readArray(readUint(4));
+            case 0xde: return readMap(readUint(2));
+            case 0xdf: return readMap(readUint(4));
+            default:
+                throw new Error("Unsupported MessagePack type " + byte);
+        }
+    }
+
+    return decode();
+}
+
+// Hashes are summed as doubles, which are exact only up to 2^53
+const HASH_MODULUS = 2 ** 48;
+
+function combineHashes(hashes) {
+    let hash = 0;
+    for (const x of hashes) {
+        hash = (hash + parseInt(x, 10)) % HASH_MODULUS;
+    }
+
+    return hash;
 }
 
 function getWsUrl() {
@@ -30,6 +281,14 @@ function getWsUrl() {
 
 ////////
 export {
+    BINARY_PROTOCOL,
     CustomWebSocket,
-    getWsUrl
+    HASH_MODULUS,
+    JSON_PROTOCOL,
+    combineHashes,
+    decodeMsgpack,
+    encodeMsgpack,
+    fromColumns,
+    getWsUrl,
+    parseCommand
 };
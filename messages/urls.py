@@ -1,9 +1,12 @@
 from django.urls import path
 from django.urls import re_path
 
+from .views import dialog_messages_api_view
 from .views import dialog_view
+from .views import dialogs_api_view
 from .views import dialogs_view
 from .views import main_page_view
+from .views import metrics_view
 
 
 urlpatterns = [
@@ -14,4 +17,11 @@ urlpatterns = [
         dialog_view,
         name="dialog"
     ),
+    path(r"api/dialogs/", dialogs_api_view, name="api_dialogs"),
+    re_path(
+        r"^api/dialogs/u(?P<interlocutor_id>[1-9]\d*)/messages/$",
+        dialog_messages_api_view,
+        name="api_dialog_messages"
+    ),
+    path(r"metrics/", metrics_view, name="metrics"),
 ]
@@ -1,17 +1,50 @@
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
+from django.utils import timezone
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.http import require_safe
+from django.views.decorators.vary import vary_on_cookie
 
+from .cache import get_local_cache_stats
+from .cache import get_pool_stats
 from .forms import MessagesForm
+from .managers import combine_hashes
+from .managers import DeletedUsersManager
+from .managers import DialogIntegrityManager
+from .managers import DialogsIntegrityManager
+from .managers import encode_time
+from .managers import HASH_MODULUS
+from .managers import UnreadDialogsManager
+from .models import Dialog
 from .models import Message
 
 
 @login_required
 def dialogs_view(request):
+    current_user = request.user
+
+    # The same data as give_dialogs sends, so the first integrity
+    # check of the socket succeeds
+    sync_token = encode_time(timezone.now())
+    dialogs, _, uds_set = DialogsIntegrityManager(
+        current_user.id
+    ).sync.get_dialogs()
+    UnreadDialogsManager(current_user.id).sync.reset(uds_set)
+
     return TemplateResponse(
         request,
         "messages/dialogs.html",
+        {
+            "initial_dialogs": {
+                "dialogs": dialogs,
+                "sync_token": sync_token
+            }
+        }
     )
 
 
@@ -23,31 +56,124 @@ def dialog_view(request, interlocutor_id):
     if current_user.id == interlocutor_id:
         return redirect("dialogs")
 
+    deleted_users_manager = DeletedUsersManager(interlocutor_id)
+    if not deleted_users_manager.exists():
+        try:
+            interlocutor = get_user_model().objects.get(id=interlocutor_id)
+
+            return TemplateResponse(
+                request,
+                "messages/dialog.html",
+                {
+                    "form": MessagesForm(),
+                    "interlocutor": interlocutor,
+                    "initial_messages": get_initial_messages(
+                        current_user.id,
+                        interlocutor_id
+                    )
+                }
+            )
+        except get_user_model().DoesNotExist:
+            deleted_users_manager.add()
+
+    if not Message.objects.dialog_has_visible_messages(
+        current_user.id,
+        interlocutor_id
+    ):
+        return redirect("dialogs")
+
+    return TemplateResponse(
+        request,
+        "messages/dialog_with_deleted_interlocutor.html"
+    )
+
+
+def get_initial_messages(user_id, interlocutor_id):
+    # The hash is read first, so a message which is saved meanwhile
+    # makes the first integrity check fail instead of being lost
+    integrity_hash = DialogIntegrityManager(
+        user_id,
+        interlocutor_id
+    ).sync.get_hash()
+    messages, _ = Message.objects.get_dialog_messages_page(
+        user_id,
+        interlocutor_id
+    )
+    messages_as_dict = [message.as_dict(user_id) for message in messages]
+
+    # Older messages aren't rendered, so their hash is sent instead
+    return {
+        "messages": messages_as_dict,
+        "hash_offset": (
+            integrity_hash - combine_hashes(
+                message["hash"] for message in messages_as_dict
+            )
+        ) % HASH_MODULUS
+    }
+
+
+def get_dialogs_etag(request):
+    return str(DialogsIntegrityManager(request.user.id).sync.get_hash())
+
+
+def get_dialog_messages_etag(request, interlocutor_id):
+    user_id = request.user.id
+    interlocutor_id = int(interlocutor_id)
+
+    # Hashes of messages don't change when they're read
+    return "{}-{}".format(
+        DialogIntegrityManager(user_id, interlocutor_id).sync.get_hash(),
+        int(UnreadDialogsManager(user_id).sync.has_dialog(interlocutor_id))
+    )
+
+
+# Responses are revalidated by hashes of Redis,
+# so unchanged data is answered without the database
+@login_required
+@require_safe
+@vary_on_cookie
+@cache_control(no_cache=True)
+@condition(etag_func=get_dialogs_etag)
+def dialogs_api_view(request):
+    dialogs, _, _ = Dialog.objects.get_dialogs(request.user.id)
+
+    return JsonResponse({
+        "dialogs": dialogs
+    })
+
+
+@login_required
+@require_safe
+@vary_on_cookie
+@cache_control(no_cache=True)
+@condition(etag_func=get_dialog_messages_etag)
+def dialog_messages_api_view(request, interlocutor_id):
+    current_user = request.user
     try:
-        interlocutor = get_user_model().objects.get(id=interlocutor_id)
-
-        return TemplateResponse(
-            request,
-            "messages/dialog.html",
-            {
-                "form": MessagesForm(),
-                "interlocutor": interlocutor
-            }
-        )
-    except get_user_model().DoesNotExist:
-        messages = Message.objects.get_dialog_messages(
+        messages, next_cursor = Message.objects.get_dialog_messages_page(
             current_user.id,
-            interlocutor_id
+            int(interlocutor_id),
+            before=request.GET.get("before"),
+            after=request.GET.get("after")
         )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
-        if not messages:
-            return redirect("dialogs")
-
-        return TemplateResponse(
-            request,
-            "messages/dialog_with_deleted_interlocutor.html"
-        )
+    return JsonResponse({
+        "messages": [
+            message.as_dict(current_user.id) for message in messages
+        ],
+        "next_cursor": next_cursor
+    })
 
 
 def main_page_view(request):
     return redirect("dialogs")
+
+
+@staff_member_required
+def metrics_view(request):
+    return JsonResponse({
+        "redis_pools": get_pool_stats(),
+        "local_cache": get_local_cache_stats()
+    })
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import uuid
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from .cache import RedisManager
+from .managers import decode_time
+from .managers import DialogIntegrityManager
+from .managers import encode_time
+from .managers import get_conversation_id
+
+
+logger = logging.getLogger(__name__)
+
+# Every loop of a worker process flushes the queue with its own task
+_flush_tasks = weakref.WeakKeyDictionary()
+# The id sequence is raised when a process starts to use it
+_is_id_raised = False
+
+# KEYS: id sequence key
+# ARGV: the biggest id of saved messages
+RAISE_ID_SCRIPT = """
+local last_id = tonumber(redis.call("GET", KEYS[1]) or 0)
+local max_id = tonumber(ARGV[1])
+if last_id >= max_id then
+    return last_id
+end
+redis.call("SET", KEYS[1], max_id)
+
+return max_id
+"""
+
+# KEYS: lock key
+# ARGV: token of the owner
+RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+
+return 0
+"""
+
+# KEYS: queue key
+# ARGV: items of the saved batch
+TRIM_SCRIPT = """
+local items = redis.call("LRANGE", KEYS[1], 0, #ARGV - 1)
+if #items ~= #ARGV then
+    return 0
+end
+for i = 1, #ARGV do
+    if items[i] ~= ARGV[i] then
+        return 0
+    end
+end
+redis.call("LTRIM", KEYS[1], #ARGV, -1)
+
+return 1
+"""
+
+
+class MessagesQueue(RedisManager):
+    # New messages are journaled in a Redis list and saved in batches.
+    # A batch is removed from the journal only after its transaction,
+    # so a crashed flush is replayed by the next one
+    def __init__(self):
+        # It's impossible to import as usually
+        from .models import Message
+
+        self.key = "wb_messages"
+        self.id_key = "wb_message_id"
+        self.lock_key = "wb_lock"
+        self.messages_manager = Message.objects
+        self.batch_size = settings.FS_WRITE_BEHIND_BATCH_SIZE
+        self.max_size = settings.FS_WRITE_BEHIND_MAX_QUEUE_SIZE
+        self.lock_timeout = settings.FS_WRITE_BEHIND_LOCK_TIMEOUT
+
+    async def put(self, sender_id, receiver_id, text):
+        message = self.messages_manager.model(
+            id=await self.get_next_id(),
+            time=timezone.now(),
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            conversation_id=get_conversation_id(sender_id, receiver_id),
+            text=text
+        )
+
+        if await self.redis_cache.llen(self.key) >= self.max_size:
+            # The queue is full, so the message is written through
+            await sync_to_async(self.messages_manager.save_messages)(
+                [message]
+            )
+        else:
+            await self.redis_cache.rpush(self.key, encode_message(message))
+            ensure_flush_task()
+
+        return message
+
+    async def get_next_id(self):
+        if (
+            not _is_id_raised
+            or not await self.redis_cache.exists(self.id_key)
+        ):
+            await self.raise_id()
+
+        return await self.redis_cache.incr(self.id_key)
+
+    async def raise_id(self):
+        global _is_id_raised
+
+        # Messages could be saved outside the queue,
+        # so the sequence is moved past their ids
+        max_id = await sync_to_async(
+            lambda: self.messages_manager.aggregate(
+                max_id=Max("id")
+            )["max_id"]
+        )()
+
+        last_id = await self.run_script(
+            RAISE_ID_SCRIPT,
+            [self.id_key],
+            [max_id or 0]
+        )
+        _is_id_raised = True
+
+        return last_id
+
+    async def get_size(self):
+        return await self.redis_cache.llen(self.key)
+
+    async def flush(self):
+        # Only one process flushes at once. The lock could expire
+        # during a slow flush, so only its owner releases it
+        token = uuid.uuid4().hex
+        if not await self.redis_cache.set(
+            self.lock_key, token,
+            nx=True, ex=self.lock_timeout
+        ):
+            return 0
+
+        try:
+            await self.raise_id()
+            items = await self.redis_cache.lrange(
+                self.key,
+                0,
+                self.batch_size - 1
+            )
+            if len(items) != 0:
+                messages = [decode_message(item) for item in items]
+                queued_ids = [message.id for message in messages]
+                await sync_to_async(self.messages_manager.save_messages)(
+                    messages
+                )
+                # The batch could be flushed by another process
+                # after the lock had expired
+                await self.run_script(TRIM_SCRIPT, [self.key], items)
+                await self.consider_new_ids(messages, queued_ids)
+        finally:
+            await self.run_script(
+                RELEASE_LOCK_SCRIPT,
+                [self.lock_key],
+                [token]
+            )
+
+        return len(items)
+
+    async def consider_new_ids(self, messages, queued_ids):
+        # Hashes of messages which have got new ids are wrong,
+        # so they're rebuilt and clients resync their dialogs
+        changed_messages = [
+            message for message, queued_id in zip(messages, queued_ids)
+            if message.id != queued_id
+        ]
+        if len(changed_messages) == 0:
+            return
+
+        await self.raise_id()
+        for message in changed_messages:
+            await asyncio.gather(
+                DialogIntegrityManager(
+                    message.sender_id,
+                    message.receiver_id
+                ).drop(),
+                DialogIntegrityManager(
+                    message.receiver_id,
+                    message.sender_id
+                ).drop()
+            )
+
+
+def encode_message(message):
+    return json.dumps({
+        "id": message.id,
+        "time": encode_time(message.time),
+        "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id,
+        "conversation_id": message.conversation_id,
+        "text": message.text
+    })
+
+
+def decode_message(item):
+    # It's impossible to import as usually
+    from .models import Message
+
+    fields = json.loads(item)
+    fields["time"] = decode_time(fields["time"])
+
+    return Message(**fields)
+
+
+async def flush_periodically():
+    queue = MessagesQueue()
+    while True:
+        await asyncio.sleep(settings.FS_WRITE_BEHIND_FLUSH_INTERVAL)
+        try:
+            while await queue.flush() == queue.batch_size:
+                pass
+        except Exception:
+            # Messages stay in the journal until the next flush
+            logger.exception("write-behind flush failed")
+
+
+def ensure_flush_task():
+    loop = asyncio.get_running_loop()
+    task = _flush_tasks.get(loop)
+    if task is None or task.done():
+        _flush_tasks[loop] = loop.create_task(flush_periodically())